@@ -36,23 +36,61 @@ class Animal(object):
         """Write to self's tree buffer"""
         self.treebuf.write(string)
 
-    def load(self, tracknames=None):
+    def load(self, tracknames=None, nthreads=None):
+        """Load all tracks, or just those in tracknames. nthreads is passed on to
+        Track.load"""
         treestr = self.level*TAB + self.id + '/'
         # print string to tree hierarchy and screen
         self.writetree(treestr + '\n')
         print(treestr)
         if tracknames != None:
             tracknames = tolist(tracknames)
-            dirnames = tracknames
+        self.tracknames = tracknames # for reload()
+        for dirname in self.list_tracknames():
+            self.load_track(dirname, nthreads=nthreads)
+
+    def list_tracknames(self):
+        """Return sorted names of track folders to load, either all of them or only those
+        specified to load()"""
+        if self.tracknames != None:
+            dirnames = list(self.tracknames)
         else:
             # all track folder names for this animal:
             dirnames = [ dirname for dirname in os.listdir(self.path)
                          if os.path.isdir(os.path.join(self.path, dirname))
                          and dirname.lower().startswith('tr') ]
         dirnames.sort() # alphabetical order
+        return dirnames
+
+    def load_track(self, dirname, nthreads=None):
+        """Load track in folder dirname and add it to self"""
+        path = os.path.join(self.path, dirname)
+        track = Track(path, animal=self)
+        track.load(nthreads=nthreads)
+        self.tr[track.id] = track
+        self.__setattr__('tr' + str(track.id), track) # add shortcut attrib
+        return track
+
+    def reload(self):
+        """Reload changed recordings in all tracks, see Track.reload(). Load any new
+        tracks, and drop any that have been removed. Return dict of ids of reloaded
+        recordings, indexed by track id. All recordings in new tracks count as reloaded"""
+        dirnames = self.list_tracknames()
+        for tid, track in self.tr.items():
+            if track.name not in dirnames: # track folder has been removed
+                del self.tr[tid]
+                self.__delattr__('tr' + str(tid))
+        loaded = [ track.name for track in self.tr.values() ]
+        rids = {}
+        for tid in sorted(self.tr):
+            rids[tid] = self.tr[tid].reload()
         for dirname in dirnames:
-            path = os.path.join(self.path, dirname)
-            track = Track(path, animal=self)
-            track.load()
-            self.tr[track.id] = track
-            self.__setattr__('tr' + str(track.id), track) # add shortcut attrib
+            if dirname not in loaded:
+                track = self.load_track(dirname)
+                rids[track.id] = sorted(track.r)
+        # rebuild tree buffer, in track id order:
+        self.treebuf = StringIO.StringIO()
+        self.treebuf.write(self.level*TAB + self.id + '/\n')
+        for tid in sorted(self.tr):
+            self.treebuf.write(self.tr[tid].treebuf.getvalue())
+        return rids
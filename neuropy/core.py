@@ -12,6 +12,11 @@ import re
 import random
 import math
 import datetime
+import hashlib
+import cPickle
+import tempfile
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 
 from copy import copy
 from pprint import pprint
@@ -91,17 +96,65 @@ class dictattr(dict):
             self.__dict__[key] = val # make the key show up as an attrib upon dir()
 
 
+class BufferReader(object):
+    """Minimal read-only file-like object over a uint8 array buffer, such as an entire
+    file read in one go, or a memmap of it. Fixed layout fields are decoded straight from
+    the buffer with struct, and arrays are returned as zero-copy views into it"""
+    def __init__(self, buf, name=None):
+        self.buf = buf
+        self.name = name # name of buffered file, if any
+        self.pos = 0
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=0):
+        if whence == 0: # absolute
+            self.pos = offset
+        elif whence == 1: # relative to current position
+            self.pos += offset
+        elif whence == 2: # relative to end
+            self.pos = len(self.buf) + offset
+        else:
+            raise ValueError('invalid whence: %r' % whence)
+
+    def read(self, nbytes):
+        """Return the next nbytes as a string"""
+        s = self.buf[self.pos:self.pos+nbytes].tostring()
+        self.pos += nbytes
+        return s
+
+    def unpack(self, fmt):
+        """Decode the next fields according to struct format string fmt"""
+        vals = struct.unpack_from(fmt, self.buf, self.pos)
+        self.pos += struct.calcsize(fmt)
+        return vals
+
+    def view(self, offset, dtype, count):
+        """Return zero-copy view of count items of dtype starting at byte offset"""
+        nbytes = count * np.dtype(dtype).itemsize
+        return self.buf[offset:offset+nbytes].view(dtype)
+
+    def array(self, dtype, count):
+        """Return zero-copy view of the next count items of dtype"""
+        a = self.view(self.pos, dtype, count)
+        self.pos += a.nbytes
+        return a
+
+
 class PTCSHeader(object):
     """Polytrode clustered spikes file header"""
     def __init__(self):
-        self.VER2FUNC = {1: self.read_ver_1, 2: self.read_ver_2} # call the appropriate method
+        self.VER2FUNC = {1: self.read_ver_1, 2: self.read_ver_2,
+                         3: self.read_ver_3} # call the appropriate method
 
     def read(self, f):
-        """Read in format version, followed by rest according to verison
+        """Read in format version, followed by rest according to verison. f is a
+        BufferReader
 
         formatversion: int64 (currently version 1)
         """
-        self.FORMATVERSION = int(np.fromfile(f, dtype=np.int64, count=1)) # formatversion
+        self.FORMATVERSION, = f.unpack('<q') # formatversion
         self.VER2FUNC[self.FORMATVERSION](f) # call the appropriate method
         
     def read_ver_1(self, f):
@@ -136,27 +189,24 @@ class PTCSHeader(object):
             (human readable string representation of datetime, preferrably ISO 8601,
              padded with null bytes if needed for 8 byte alignment)
         """
-        self.ndescrbytes = int(np.fromfile(f, dtype=np.uint64, count=1)) # ndescrbytes
+        self.ndescrbytes, = f.unpack('<Q') # ndescrbytes
         self.descr = f.read(self.ndescrbytes).rstrip('\0 ') # descr
         try:
             self.descr = eval(self.descr) # should come out as a dict
         except: pass
         
-        self.nneurons = int(np.fromfile(f, dtype=np.uint64, count=1)) # nneurons
-        self.nspikes = int(np.fromfile(f, dtype=np.uint64, count=1)) # nspikes
-        self.nsamplebytes = int(np.fromfile(f, dtype=np.uint64, count=1)) # nsamplebytes
-        self.samplerate = int(np.fromfile(f, dtype=np.uint64, count=1)) # samplerate
-
-        self.npttypebytes = int(np.fromfile(f, dtype=np.uint64, count=1)) # npttypebytes
+        # nneurons, nspikes, nsamplebytes, samplerate (Hz), npttypebytes:
+        (self.nneurons, self.nspikes, self.nsamplebytes, self.samplerate,
+         self.npttypebytes) = f.unpack('<5Q')
         self.pttype = f.read(self.npttypebytes).rstrip('\0 ') # pttype
-        self.nptchans = int(np.fromfile(f, dtype=np.uint64, count=1)) # nptchans
-        self.chanpos = np.fromfile(f, dtype=np.float64, count=self.nptchans*2) # chanpos
+        self.nptchans, = f.unpack('<Q') # nptchans
+        self.chanpos = f.array(np.float64, self.nptchans*2) # chanpos
         self.chanpos.shape = self.nptchans, 2 # reshape into rows of (x, y) coords
-        self.nsrcfnamebytes = int(np.fromfile(f, dtype=np.uint64, count=1)) # nsrcfnamebytes
+        self.nsrcfnamebytes, = f.unpack('<Q') # nsrcfnamebytes
         self.srcfname = f.read(self.nsrcfnamebytes).rstrip('\0 ') # srcfname
         # maybe convert this to a proper Python datetime object in the Neuron:
-        self.datetime = float(np.fromfile(f, dtype=np.float64, count=1)) # datetime (days)
-        self.ndatetimestrbytes = int(np.fromfile(f, dtype=np.uint64, count=1)) # ndatetimestrbytes
+        # datetime (days), ndatetimestrbytes:
+        self.datetime, self.ndatetimestrbytes = f.unpack('<dQ')
         self.datetimestr = f.read(self.ndatetimestrbytes).rstrip('\0 ') # datetimestr
 
     def read_ver_2(self, f):
@@ -164,18 +214,57 @@ class PTCSHeader(object):
         incremented to version 2 for the correctly exported ones"""
         return self.read_ver_1(f)
 
+    def read_ver_3(self, f):
+        """Same as version 1. Version 3 only differs in its neuron records"""
+        return self.read_ver_1(f)
+
 
 class PTCSNeuronRecord(object):
-    """Polytrode clustered spikes file neuron record"""
+    """Polytrode clustered spikes file neuron record. Array fields are zero-copy views
+    into the buffer being read from, so if that's a memmap of the file, they're only read
+    from disk on first access"""
     def __init__(self, header):
-        self.VER2FUNC = {1: self.read_ver_1, 2:self.read_ver_2} # call the appropriate method
+        self.VER2FUNC = {1: self.read_ver_1, 2:self.read_ver_2,
+                         3: self.read_ver_3} # call the appropriate method
         self.header = header
         nsamplebytes = self.header.nsamplebytes
         self.wavedtype = {2: np.float16, 4: np.float32, 8: np.float64}[nsamplebytes]
 
     def read(self, f):
+        """Read in the next neuron record from BufferReader f"""
+        self.offset = f.tell() # start of this record in the file
         self.VER2FUNC[self.header.FORMATVERSION](f) # call the appropriate method
-        
+
+    def read_index(self, f, index, i):
+        """Fill in this record from entry i in a PTCSIndex instead of parsing it from
+        BufferReader f. Fields that aren't in the index are parsed on first access"""
+        self.reader = f
+        entry = index.records[i]
+        for name in index.records.dtype.names:
+            self.__setattr__(name, entry[name].item())
+        self.wavedata = self.view_wave(f, self.wavedataoffset, self.nwavedatabytes)
+        self.wavestd = self.view_wave(f, self.wavestdoffset, self.nwavestdbytes)
+        if self.header.FORMATVERSION >= 3:
+            f.seek(self.spikesoffset)
+            self.read_spikeblocks(f)
+        else:
+            self.spikes = f.view(self.spikesoffset, np.int64, self.nspikes)
+
+    def __getattr__(self, name):
+        """Only called when name isn't found the usual way. For records built from a
+        PTCSIndex, seek straight to the record and parse it to get the fields missing
+        from the index. For delta-encoded spikes, decode them on first access"""
+        if name == 'spikes' and 'spikedeltas' in self.__dict__:
+            self.spikes = decode_spikes(self.spikebases, self.spikestarts,
+                                        self.spikedeltas)
+            return self.spikes
+        if name in ['ndescrbytes', 'descr', 'chans'] and 'reader' in self.__dict__:
+            self.reader.seek(self.offset)
+            self.read(self.reader)
+            return self.__dict__[name]
+        raise AttributeError('%r object has no attribute %r'
+                             % (self.__class__.__name__, name))
+
     def read_ver_1(self, f):
         """Read in neuron record of .ptcs file version 1
 
@@ -202,46 +291,321 @@ class PTCSNeuronRecord(object):
         nspikes: uint64 (number of spikes in this neuron)
         spike timestamps: nspikes * uint64 (us, should be sorted)
         """
-        self.nid = int(np.fromfile(f, dtype=np.int64, count=1)) # nid
-        self.ndescrbytes = int(np.fromfile(f, dtype=np.uint64, count=1)) # ndescrbytes
+        self.nid, self.ndescrbytes = f.unpack('<qQ') # nid, ndescrbytes
         self.descr = f.read(self.ndescrbytes).rstrip('\0 ') # descr
         if self.descr:
             try:
                 self.descr = eval(self.descr) # might be a dict
             except: pass
-        self.clusterscore = float(np.fromfile(f, dtype=np.float64, count=1)) # clusterscore
-        self.xpos = float(np.fromfile(f, dtype=np.float64, count=1)) # xpos (um)
-        self.ypos = float(np.fromfile(f, dtype=np.float64, count=1)) # ypos (um)
-        self.zpos = float(np.fromfile(f, dtype=np.float64, count=1)) # zpos (um)
-        self.nchans = int(np.fromfile(f, dtype=np.uint64, count=1)) # nchans
-        self.chans = np.fromfile(f, dtype=np.uint64, count=self.nchans) # chanids
-        self.maxchan = int(np.fromfile(f, dtype=np.uint64, count=1)) # maxchanid
-        self.nt = int(np.fromfile(f, dtype=np.uint64, count=1)) # nt
-        self.nwavedatabytes, self.wavedata = self.read_wave(f)
-        self.nwavestdbytes, self.wavestd = self.read_wave(f)
-        self.nspikes = int(np.fromfile(f, dtype=np.uint64, count=1)) # nspikes
-        # spike timestamps (us):
-        self.spikes = np.fromfile(f, dtype=np.uint64, count=self.nspikes)
-        # convert from unsigned to signed int for calculating intervals:
-        self.spikes = np.asarray(self.spikes, dtype=np.int64)
+        # clusterscore, xpos, ypos, zpos (um), nchans:
+        (self.clusterscore, self.xpos, self.ypos, self.zpos,
+         self.nchans) = f.unpack('<4dQ')
+        self.chans = f.array(np.uint64, self.nchans) # chanids
+        self.maxchan, self.nt = f.unpack('<2Q') # maxchanid, nt
+        self.nwavedatabytes, self.wavedataoffset, self.wavedata = self.read_wave(f)
+        self.nwavestdbytes, self.wavestdoffset, self.wavestd = self.read_wave(f)
+        self.nspikes, = f.unpack('<Q') # nspikes
+        self.spikesoffset = f.tell()
+        if self.header.FORMATVERSION >= 3:
+            self.read_spikeblocks(f)
+            return
+        # spike timestamps (us). These are stored as uint64, but are always < 2**63, so
+        # view them as signed int for calculating intervals:
+        self.spikes = f.array(np.int64, self.nspikes)
+
+    def read_spikeblocks(self, f):
+        """Read in delta-encoded spike timestamps of .ptcs file version 3, which replace
+        the raw spike timestamps of version 1. Spikes are split into blocks, each spanning
+        less than 2**32 us. Each spike is stored as a uint32 delta from the base time of
+        its block. Decoding to int64 is deferred until first access of self.spikes
+
+        nblocks: uint64
+        blockbases: nblocks * int64 (us, time of first spike in each block)
+        blockstarts: nblocks * uint64 (index of first spike in each block)
+        deltas: nspikes * uint32
+            (us, relative to the base of each spike's block, padded with null bytes if
+             needed for 8 byte alignment)
+        """
+        nblocks, = f.unpack('<Q') # nblocks
+        self.spikebases = f.array(np.int64, nblocks)
+        self.spikestarts = f.array(np.uint64, nblocks).view(np.int64)
+        self.spikedeltas = f.array(np.uint32, self.nspikes)
+        f.seek(pad8(f.tell())) # skip any pad bytes
+        self.__dict__.pop('spikes', None) # decode again on next access
+
+    def loadspikes(self):
+        """Copy spikes out of the buffer into memory, so that they don't have to be read
+        from disk on each access when the buffer is a memmap"""
+        self.spikes = np.array(self.spikes)
 
     def read_wave(self, f):
-        """Read wavedata/wavestd bytes"""
-        # nwavedata/nwavestd bytes, padded:
-        nbytes = int(np.fromfile(f, dtype=np.uint64, count=1))
-        fp = f.tell()
-        count = nbytes // self.header.nsamplebytes # trunc to ignore any pad bytes
-        X = np.fromfile(f, dtype=self.wavedtype, count=count) # wavedata/wavestd (uV)
-        if nbytes != 0:
-            X.shape = self.nchans, self.nt # reshape
-        f.seek(fp + nbytes) # skip any pad bytes
-        return nbytes, X
+        """Read wavedata/wavestd, return nbytes, offset and data"""
+        nbytes, = f.unpack('<Q') # nwavedata/nwavestd bytes, padded
+        offset = f.tell()
+        X = self.view_wave(f, offset, nbytes)
+        f.seek(offset + nbytes) # skip any pad bytes
+        return nbytes, offset, X
+
+    def view_wave(self, f, offset, nbytes):
+        """Return zero-copy view of wavedata/wavestd (uV) at offset in f. nbytes includes
+        any pad bytes, so the number of samples comes from nchans and nt instead"""
+        if nbytes == 0:
+            return f.view(offset, self.wavedtype, 0)
+        count = self.nchans * self.nt
+        if count * self.header.nsamplebytes > nbytes:
+            raise ValueError("%d bytes of wave data at offset %d is too short for %d chans "
+                             "and %d timepoints" % (nbytes, offset, self.nchans, self.nt))
+        X = f.view(offset, self.wavedtype, count)
+        X.shape = self.nchans, self.nt # reshape
+        return X
 
     def read_ver_2(self, f):
         """Same as version 1. NVS created some version 1 files incorrectly, and
         incremented to version 2 for the correctly exported ones"""
         return self.read_ver_1(f)
 
+    def read_ver_3(self, f):
+        """Same as version 1, but with delta-encoded spikes, see read_spikeblocks"""
+        return self.read_ver_1(f)
+
+
+class PTCSIndex(object):
+    """Sidecar index of all the neuron records in a .ptcs file, stored in a .ptcs.idx
+    file next to it. Holds the byte offsets of each record and its variable length fields,
+    and enough per-neuron info to build a Sort's neurons without reading any spikes. The
+    size and modification time of the .ptcs file are stored to check for staleness"""
+    VERSION = 1
+    DTYPE = np.dtype([('nid', np.int64),
+                      ('offset', np.int64), # start of record in .ptcs file
+                      ('clusterscore', np.float64),
+                      ('xpos', np.float64),
+                      ('ypos', np.float64),
+                      ('zpos', np.float64),
+                      ('nchans', np.int64),
+                      ('maxchan', np.int64),
+                      ('nt', np.int64),
+                      ('nwavedatabytes', np.int64),
+                      ('wavedataoffset', np.int64),
+                      ('nwavestdbytes', np.int64),
+                      ('wavestdoffset', np.int64),
+                      ('nspikes', np.int64),
+                      ('spikesoffset', np.int64),
+                      ('t0', np.int64), # first spike time (us)
+                      ('t1', np.int64)]) # last spike time (us)
+
+    def __init__(self, fname):
+        self.fname = fname # .ptcs file
+        self.idxfname = fname + '.idx'
+
+    def stat(self):
+        """Return size and modification time of .ptcs file"""
+        st = os.stat(self.fname)
+        return st.st_size, st.st_mtime
+
+    def build(self, records):
+        """Build index from a list of PTCSNeuronRecords"""
+        self.records = np.zeros(len(records), dtype=self.DTYPE)
+        for i, rec in enumerate(records):
+            entry = self.records[i]
+            for name in self.DTYPE.names:
+                if name == 't0':
+                    entry[name] = rec.spikes[0]
+                elif name == 't1':
+                    entry[name] = rec.spikes[-1]
+                else:
+                    entry[name] = getattr(rec, name)
+        self.size, self.mtime = self.stat()
+
+    def save(self):
+        with open(self.idxfname, 'wb') as f:
+            np.savez(f, version=self.VERSION, size=self.size, mtime=self.mtime,
+                     records=self.records)
+
+    def load(self, nneurons=None):
+        """Load index from .ptcs.idx file. Return False if it doesn't exist, or if it's
+        stale, ie if it doesn't match the current .ptcs file"""
+        try:
+            with open(self.idxfname, 'rb') as f:
+                d = np.load(f)
+                version, size = int(d['version']), int(d['size'])
+                mtime, records = float(d['mtime']), d['records']
+        except IOError:
+            return False
+        if version != self.VERSION or (size, mtime) != self.stat():
+            return False
+        if nneurons != None and len(records) != nneurons:
+            return False
+        self.size, self.mtime, self.records = size, mtime, records
+        return True
+
+
+class PTCSWriter(object):
+    """Streaming writer of version 2 .ptcs files, laid out as documented in PTCSHeader
+    and PTCSNeuronRecord, or of version 3 files with delta-encoded spikes if compress.
+    Neuron records are written one at a time as they're passed in, and the nneurons and
+    nspikes header fields are patched on close() to match what was actually written"""
+    def __init__(self, fname, pttype, chanpos, samplerate, days, nsamplebytes=4,
+                 srcfname='', descr='', compress=False):
+        """days is the datetime of t=0, in days since EPOCH"""
+        self.fname = fname
+        self.FORMATVERSION = {False: 2, True: 3}[compress]
+        self.wavedtype = {2: np.float16, 4: np.float32, 8: np.float64}[nsamplebytes]
+        self.nneurons = 0
+        self.nspikes = 0
+        self.f = open(fname, 'wb')
+        self.f.write(struct.pack('<q', self.FORMATVERSION))
+        self.write_text(descr)
+        self.countsoffset = self.f.tell() # patched on close
+        chanpos = np.asarray(chanpos, dtype=np.float64)
+        self.f.write(struct.pack('<4Q', 0, 0, nsamplebytes, samplerate))
+        self.write_text(pttype)
+        self.f.write(struct.pack('<Q', len(chanpos)))
+        self.f.write(chanpos.tostring())
+        self.write_text(srcfname)
+        self.f.write(struct.pack('<d', days))
+        self.write_text((EPOCH + datetime.timedelta(days=days)).isoformat())
+
+    def write_text(self, text):
+        """Write ndescrbytes-style field: nbytes, then text padded with null bytes"""
+        if type(text) != str:
+            text = repr(text) # e.g. a dict
+        nbytes = pad8(len(text))
+        self.f.write(struct.pack('<Q', nbytes))
+        self.f.write(text + '\0' * (nbytes - len(text)))
+
+    def write_wave(self, wave):
+        """Write nwavebytes, then wave data padded with null bytes"""
+        data = np.asarray(wave, dtype=self.wavedtype).tostring()
+        nbytes = pad8(len(data))
+        self.f.write(struct.pack('<Q', nbytes))
+        self.f.write(data + '\0' * (nbytes - len(data)))
+
+    def write(self, nid, spikes, chans, maxchan, wavedata, wavestd, pos, descr='',
+              clusterscore=np.nan):
+        """Write the next neuron record. wavedata and wavestd are (nchans, nt) arrays
+        (uV), and can be empty. pos is (x, y) or (x, y, z) (um). spikes (us) must be
+        sorted"""
+        spikes = np.asarray(spikes, dtype=np.int64)
+        assert (np.diff(spikes) >= 0).all() # should be sorted
+        chans = np.asarray(chans, dtype=np.uint64)
+        wavedata, wavestd = np.asarray(wavedata), np.asarray(wavestd)
+        nt = 0
+        if wavedata.size != 0:
+            nt = wavedata.shape[1]
+            assert wavedata.shape == (len(chans), nt)
+        if len(pos) == 2:
+            pos = tuple(pos) + (np.nan,) # zpos defaults to NaN
+        self.f.write(struct.pack('<q', nid))
+        self.write_text(descr)
+        self.f.write(struct.pack('<4dQ', clusterscore, pos[0], pos[1], pos[2], len(chans)))
+        self.f.write(chans.tostring())
+        self.f.write(struct.pack('<2Q', maxchan, nt))
+        self.write_wave(wavedata)
+        self.write_wave(wavestd)
+        self.f.write(struct.pack('<Q', len(spikes)))
+        if self.FORMATVERSION >= 3:
+            bases, starts, deltas = encode_spikes(spikes)
+            self.f.write(struct.pack('<Q', len(bases)))
+            self.f.write(bases.tostring())
+            self.f.write(starts.astype(np.uint64).tostring())
+            self.f.write(deltas.tostring())
+            self.f.write('\0' * (pad8(deltas.nbytes) - deltas.nbytes))
+        else:
+            self.f.write(spikes.astype(np.uint64).tostring())
+        self.nneurons += 1
+        self.nspikes += len(spikes)
+
+    def close(self):
+        """Patch nneurons and nspikes in header, and close file"""
+        self.f.seek(self.countsoffset)
+        self.f.write(struct.pack('<2Q', self.nneurons, self.nspikes))
+        self.f.close()
+
+
+class RecordingCache(object):
+    """Flat, memory-mappable cache file of everything a Recording loads from its source
+    files: sorts, experiment din and textheaders, and neuron mean rates. Stored as a
+    .cache file in the recording's folder. Laid out as:
+
+    version: uint64
+    nmetabytes: uint64
+    meta: nmetabytes of ASCII text
+        (repr of a dict of scalar and string fields, including a table of the name,
+         offset, dtype and shape of each array, padded with null bytes for 8 byte
+         alignment)
+    arrays: each padded with null bytes for 8 byte alignment
+
+    The names, sizes and modification times of all the recording's source files are
+    stored in meta to check for staleness"""
+    VERSION = 1
+    SOURCEEXTS = '.ptcs', '.din', '.textheader', '.lfp.zip', '.sort'
+
+    def __init__(self, path):
+        self.path = path # recording folder
+        name = os.path.split(path)[-1]
+        self.fname = os.path.join(path, name + '.cache')
+
+    def sources(self):
+        """Return sorted list of (name, size, mtime) of all source files in recording,
+        including the .spk files in any .sort folders"""
+        srcs = []
+        for fdname in sorted(os.listdir(self.path)):
+            if fdname.endswith(self.SOURCEEXTS):
+                fullname = os.path.join(self.path, fdname)
+                st = os.stat(fullname)
+                srcs.append((fdname, st.st_size, st.st_mtime))
+                if os.path.isdir(fullname):
+                    for fname in sorted(os.listdir(fullname)):
+                        if fname.endswith('.spk'):
+                            st = os.stat(os.path.join(fullname, fname))
+                            srcs.append((os.path.join(fdname, fname), st.st_size,
+                                         st.st_mtime))
+        return srcs
+
+    def save(self, meta, arrays):
+        """Save meta dict and (name, array) pairs to .cache file"""
+        meta = meta.copy()
+        meta['sources'] = self.sources()
+        table = {}
+        offset = 0 # relative to end of meta
+        for name, a in arrays:
+            # only keep field info for record arrays, so they can be eval'd back:
+            dtype = a.dtype.descr if a.dtype.names else a.dtype.str
+            table[name] = offset, dtype, a.shape
+            offset += pad8(a.nbytes)
+        meta['arrays'] = table
+        metastr = repr(meta)
+        metastr += '\0' * (pad8(len(metastr)) - len(metastr))
+        with open(self.fname, 'wb') as f:
+            f.write(struct.pack('<2Q', self.VERSION, len(metastr)))
+            f.write(metastr)
+            for name, a in arrays:
+                f.write(np.ascontiguousarray(a).tostring())
+                f.write('\0' * (pad8(a.nbytes) - a.nbytes))
+
+    def load(self):
+        """Memory-map .cache file, and bind its meta dict and array views to self. Return
+        False if it doesn't exist, or if it's stale, ie if any source files have changed"""
+        try:
+            buf = np.memmap(self.fname, dtype=np.uint8, mode='r')
+        except (IOError, ValueError): # missing or empty
+            return False
+        f = BufferReader(buf, name=self.fname)
+        version, nmetabytes = f.unpack('<2Q')
+        if version != self.VERSION:
+            return False
+        meta = eval(f.read(nmetabytes).rstrip('\0'))
+        if meta['sources'] != self.sources():
+            return False
+        data0 = f.tell() # start of arrays
+        arrays = {}
+        for name, (offset, dtype, shape) in meta['arrays'].items():
+            a = f.view(data0+offset, np.dtype(dtype), int(np.prod(shape)))
+            a.shape = shape
+            arrays[name] = a
+        self.meta, self.arrays = meta, arrays
+        return True
+
 
 class SPKHeader(object):
     """Represents a folder containing neurons in .spk files. Similar to a
@@ -253,18 +617,38 @@ class SPKHeader(object):
                    and fname.endswith('.spk') ] # spike filenames
         self.spkfnames = sorted(fnames)
         self.nspikes = 0
+        # look for neuron2pos.py file, which contains a dict mapping neuron id to (x, y)
+        # position. Exec it in its own namespace, instead of changing the working
+        # directory and importing it, which isn't thread safe, and only ever imports the
+        # first one encountered:
+        self.neuron2pos = None
+        n2pfname = os.path.join(self.path, 'neuron2pos.py')
+        if os.path.isfile(n2pfname):
+            ns = {}
+            execfile(n2pfname, ns)
+            self.neuron2pos = ns['neuron2pos']
 
     def read(self, neuron):
         neuron.loadspk() # load the neuron
-        self.nspikes += neuron.nspikes
-        # look for neuron2pos.py file, which contains a dict mapping neuron id to (x, y)
-        # position
-        if 'neuron2pos.py' in os.listdir(self.path):
-            oldpath = os.getcwd()
-            os.chdir(self.path)
-            from neuron2pos import neuron2pos
-            neuron.record.xpos, neuron.record.ypos = neuron2pos[neuron.id]
-            os.chdir(oldpath)
+        if self.neuron2pos != None:
+            neuron.record.xpos, neuron.record.ypos = self.neuron2pos[neuron.id]
+
+    def readall(self, neurons, nthreads=1):
+        """Read all neurons, concurrently in a pool of nthreads threads if nthreads != 1,
+        or one per CPU core if nthreads is None"""
+        if nthreads == None:
+            nthreads = multiprocessing.cpu_count()
+        if nthreads == 1 or len(neurons) < 2:
+            for neuron in neurons:
+                self.read(neuron)
+        else:
+            pool = ThreadPool(processes=min(nthreads, len(neurons)))
+            try:
+                pool.map(self.read, neurons)
+            finally:
+                pool.close()
+                pool.join()
+        self.nspikes = sum([ neuron.nspikes for neuron in neurons ])
             
 
 class SPKNeuronRecord(object):
@@ -660,6 +1044,202 @@ class LFP(object):
         self.data[chanis] = data
 
 
+class DinIndex(object):
+    """Run-length encoded index of an Experiment's din. Each block is a run of consecutive
+    screen refreshes with the same sweep index. Blocks are also grouped by sweep index in a
+    CSR layout, so all of one condition's blocks can be found without searching the din"""
+    def __init__(self, din):
+        self.ndin = len(din)
+        times, sweepis = din[:, 0], din[:, 1]
+        # din indices of the first and last (inclusive) refresh of each block:
+        starts = np.flatnonzero(np.diff(sweepis) != 0) + 1
+        self.i0s = np.hstack(([0], starts))
+        self.i1s = np.hstack((starts - 1, [self.ndin - 1]))
+        self.t0s = times[self.i0s] # block start times
+        self.t1s = times[self.i1s] # block last refresh times
+        # block end times, taken as the start of the following refresh, except at very end:
+        self.tends = np.hstack((self.t0s[1:], times[-1:]))
+        self.sweepis = sweepis[self.i0s] # sweep index of each block
+        # CSR: block indices sorted stably by sweep index, so each condition's blocks
+        # remain in temporal order, and offsets into them for each unique sweep index:
+        self.blockis = self.sweepis.argsort(kind='mergesort')
+        self.usweepis, counts = np.unique(self.sweepis, return_counts=True)
+        self.offsets = np.hstack(([0], np.cumsum(counts)))
+
+    def __len__(self):
+        return len(self.i0s)
+
+    def blocks(self, sweepi):
+        """Return indices of all blocks of sweepi, in temporal order"""
+        i = self.usweepis.searchsorted(sweepi)
+        if i == len(self.usweepis) or self.usweepis[i] != sweepi:
+            return np.array([], dtype=np.int64)
+        return self.blockis[self.offsets[i]:self.offsets[i+1]]
+
+    def tranges(self, endinclusive=False, tdelay=0):
+        """Return tranges of all blocks, in CSR order. If endinclusive, each trange ends at
+        the start of the following refresh (clipped to the last din) instead of at the
+        block's last refresh. Condition usweepis[i]'s tranges are
+        tranges[offsets[i]:offsets[i+1]]"""
+        blockis = self.blockis
+        t0s = self.t0s[blockis]
+        if endinclusive:
+            t1s = self.tends[blockis]
+        else:
+            t1s = self.t1s[blockis]
+        return np.column_stack((t0s, t1s)) + tdelay
+
+
+class TrangeSet(object):
+    """A set of time ranges (us), stored as a sorted n x 2 array of disjoint, non-adjacent,
+    half-open [t0, t1) intervals. Supports union (|), intersection (&) and difference (-),
+    all vectorized. Can be passed as tranges to Codes, SpikeCorr and Recording.mua() to
+    restrict them to the times within the set"""
+    def __init__(self, tranges=None):
+        if tranges is None:
+            tranges = np.empty((0, 2), dtype=np.int64)
+        tranges = np.asarray(tranges, dtype=np.int64).reshape(-1, 2)
+        tranges = tranges[tranges[:, 1] > tranges[:, 0]] # drop empty tranges
+        tranges = tranges[tranges[:, 0].argsort(kind='mergesort')]
+        if len(tranges) > 1:
+            # merge tranges that overlap or abut any earlier one: a new trange starts
+            # wherever its t0 is beyond all preceding t1s
+            tmax = np.maximum.accumulate(tranges[:, 1])
+            newis = np.hstack(([0], np.flatnonzero(tranges[1:, 0] > tmax[:-1]) + 1))
+            endis = np.hstack((newis[1:] - 1, [len(tranges) - 1]))
+            tranges = np.column_stack((tranges[newis, 0], tmax[endis]))
+        self.tranges = tranges
+
+    def __repr__(self):
+        return 'TrangeSet(%r)' % self.tranges.tolist()
+
+    def __len__(self):
+        return len(self.tranges)
+
+    def __iter__(self):
+        return iter(self.tranges)
+
+    def __getitem__(self, i):
+        return self.tranges[i]
+
+    def duration(self):
+        """Total duration of all tranges (us)"""
+        return (self.tranges[:, 1] - self.tranges[:, 0]).sum()
+
+    def contains(self, t):
+        """Return boolean array of which times in t fall within the set"""
+        t = np.asarray(t)
+        return (self.tranges[:, 0].searchsorted(t, side='right') -
+                self.tranges[:, 1].searchsorted(t, side='right')) == 1
+
+    def _combine(self, other, op):
+        """Apply boolean op elementwise to membership of self and other over all elementary
+        intervals between their combined edges, and return the resulting TrangeSet"""
+        if not isinstance(other, TrangeSet):
+            other = TrangeSet(other)
+        edges = np.unique(np.hstack((self.tranges.ravel(), other.tranges.ravel())))
+        if len(edges) < 2:
+            return TrangeSet()
+        t0s, t1s = edges[:-1], edges[1:]
+        keep = op(self.contains(t0s), other.contains(t0s))
+        return TrangeSet(np.column_stack((t0s[keep], t1s[keep])))
+
+    def union(self, other):
+        return self._combine(other, np.logical_or)
+
+    def intersection(self, other):
+        return self._combine(other, np.logical_and)
+
+    def difference(self, other):
+        return self._combine(other, lambda a, b: a & ~b)
+
+    __or__ = union
+    __and__ = intersection
+    __sub__ = difference
+
+    def split(self, width, tres):
+        """Split each trange into lots of smaller ones, with width and tres (us), as in
+        split_tranges(). tranges shorter than width contribute none. Returns an n x 2 array,
+        since the smaller tranges generally overlap"""
+        t0s, t1s = self.tranges[:, 0], self.tranges[:, 1]
+        # number of left edges in np.arange(t0, t1-width, tres) for each trange:
+        ns = np.maximum(-((t0s - (t1s - width)) // tres), 0)
+        offsets = np.cumsum(ns) - ns
+        ledges = np.repeat(t0s, ns) + (np.arange(ns.sum()) - np.repeat(offsets, ns)) * tres
+        return np.column_stack((ledges, ledges + width))
+
+
+class TrialSpikes(object):
+    """Spike times of many neurons aligned to many trials. tranges is an ntrials x 2 array
+    of absolute trial start and end times (us), and t0s are the times (us) each trial is
+    aligned to, defaulting to trial start times. After calc(), relative spike times (us) of
+    all neurons and trials are stored flat in t, in CSR layout: neuron nii's spikes in
+    trial triali are t[ptr[nii*ntrials+triali]:ptr[nii*ntrials+triali+1]]. If tres (us) is
+    given, spikes are also binned into counts, an nneurons x ntrials x nbins array"""
+    def __init__(self, neurons=None, tranges=None, t0s=None, tres=None):
+        self.neurons = neurons
+        self.nids = [ neuron.id for neuron in neurons ]
+        self.tranges = np.asarray(tranges, dtype=np.int64).reshape(-1, 2)
+        if t0s is None:
+            t0s = self.tranges[:, 0]
+        self.t0s = np.asarray(t0s, dtype=np.int64)
+        assert len(self.t0s) == len(self.tranges)
+        self.tres = tres
+
+    def calc(self):
+        tranges, t0s, tres = self.tranges, self.t0s, self.tres
+        nn, ntrials = len(self.neurons), len(tranges)
+        if tres != None:
+            # relative bin edges spanning the longest trial extents on either side of t0s:
+            rt0, rt1 = (tranges - t0s[:, None]).min(), (tranges - t0s[:, None]).max()
+            nbins = max(int(np.ceil((rt1 - rt0) / tres)), 1)
+            self.bins = rt0 + np.arange(nbins + 1) * tres
+            self.counts = np.zeros((nn, ntrials, nbins), dtype=np.int64)
+        trialis = np.arange(ntrials)
+        nspikes = np.zeros((nn, ntrials), dtype=np.int64)
+        ts = []
+        for nii, neuron in enumerate(self.neurons):
+            spikes = neuron.spikes
+            # one searchsorted call for all trial start and end times:
+            lohis = spikes.searchsorted(tranges)
+            n = lohis[:, 1] - lohis[:, 0]
+            nspikes[nii] = n
+            # gather indices of all spikes within all trials, in trial order:
+            offsets = np.cumsum(n) - n
+            spikeis = np.arange(n.sum()) + np.repeat(lohis[:, 0] - offsets, n)
+            t = spikes[spikeis] - np.repeat(t0s, n)
+            ts.append(t)
+            if tres != None:
+                binis = (t - self.bins[0]) // tres
+                binis = np.minimum(binis, nbins-1) # in case of float rounding at very end
+                flatis = np.repeat(trialis, n) * nbins + binis
+                self.counts[nii] = np.bincount(flatis, minlength=ntrials*nbins).reshape(
+                                   ntrials, nbins)
+        self.nspikes = nspikes # nneurons x ntrials
+        self.t = np.hstack(ts) if ts else np.array([], dtype=np.int64)
+        self.ptr = np.hstack(([0], np.cumsum(nspikes.ravel())))
+
+    def spikes(self, nid, triali):
+        """Return relative spike times (us) of neuron nid in trial triali"""
+        k = self.nids.index(nid) * len(self.tranges) + triali
+        return self.t[self.ptr[k]:self.ptr[k+1]]
+
+    def raster(self, nid):
+        """Return relative spike times (us) and 0-based trial indices of all of neuron nid's
+        spikes, for a raster plot"""
+        nii = self.nids.index(nid)
+        ntrials = len(self.tranges)
+        t = self.t[self.ptr[nii*ntrials]:self.ptr[(nii+1)*ntrials]]
+        trialis = np.repeat(np.arange(ntrials), self.nspikes[nii])
+        return t, trialis
+
+    def psth(self):
+        """Return bin midpoints (us) and trial-averaged rates (Hz), nneurons x nbins"""
+        midbins = (self.bins[:-1] + self.bins[1:]) / 2
+        rates = self.counts.mean(axis=1) / (self.tres / 1e6)
+        return midbins, rates
+
+
 class DensePopulationRaster(object):
     """Population spike raster plot, with dense vertical spacing according to neuron depth
     rank, and colour proportional to neuron depth"""
@@ -885,11 +1465,22 @@ class SpatialPopulationRaster(object):
 class Codes(object):
     """A 2D array where each row is a neuron code, and each column
     is a binary population word for that time bin, sorted LSB to MSB from top to bottom.
-    neurons is a list of Neurons, also from LSB to MSB. Order in neurons is preserved."""
-    def __init__(self, neurons=None, tranges=None, shufflecodes=False):
+    neurons is a list of Neurons, also from LSB to MSB. Order in neurons is preserved.
+    format is 'dense', 'packed' or 'sparse', see CODEFORMAT"""
+    def __init__(self, neurons=None, tranges=None, shufflecodes=False, format=None):
         self.neurons = neurons
+        if isinstance(tranges, TrangeSet):
+            tranges = tranges.tranges.tolist()
         self.tranges = tolist(tranges)
         self.shufflecodes = shufflecodes
+        uns = get_ipython().user_ns
+        if format == None:
+            format = uns['CODEFORMAT']
+        if format not in ['dense', 'packed', 'sparse']:
+            raise ValueError("unknown code format %r" % format)
+        if format != 'dense' and uns['CODEVALS'] != [0, 1]:
+            raise ValueError("%s codes require CODEVALS = [0, 1]" % format)
+        self.format = format
         self.nids = [ neuron.id for neuron in self.neurons ]
         self.nneurons = len(self.neurons)
         # make a dict from keys:self.nids, vals:range(self.nneurons). This converts from nids
@@ -905,32 +1496,156 @@ class Codes(object):
             return self.nids2niisdict[nids]
 
     def calc(self):
-        self.c = [] # stores the 2D code array
+        c = [] # stores the 2D code array, or the packed version of each of its rows
         # append neurons in their order in self.neurons, store them LSB to MSB from top to
         # bottom
         for neuron in self.neurons:
-            codeo = neuron.code(tranges=self.tranges)
+            # each neuron's code is kept in the same format:
+            codeo = neuron.code(tranges=self.tranges, format=self.format)
             # build up nested list (ie, 2D) of spike times, each row will have different
             # length:
-            if self.shufflecodes:
-                c = codeo.c.copy() # make a copy (leave the codeo's codetrain untouched)
-                np.random.shuffle(c) # shuffle each neuron's codetrain separately, in-place
+            if self.format == 'packed':
+                nc = codeo.p # just a pointer
+                if self.shufflecodes: # shuffle a temporarily unpacked copy
+                    nc = unpackcodes(nc, codeo.nbins)
+                    np.random.shuffle(nc)
+                    nc = packcode(nc)
+            elif self.format == 'sparse':
+                nc = codeo.i # just a pointer
+                if self.shufflecodes: # move high bins to random distinct bins
+                    nc = np.sort(np.int64(random.sample(xrange(codeo.nbins), len(nc))))
+            elif self.shufflecodes:
+                nc = codeo.c.copy() # make a copy (leave the codeo's codetrain untouched)
+                np.random.shuffle(nc) # shuffle each neuron's codetrain separately, in-place
             else:
-                c = codeo.c # just a pointer
-            self.c.append(c) # flat list
+                nc = codeo.c # just a pointer
+            c.append(nc) # flat list
         # store the bin edges, for reference. All bin times should be the same for all
         # neurons, because they're all given the same trange. use the bin times of the last
         # neuron
         self.t = codeo.t
-        nneurons = len(self.neurons)
-        nbins = len(self.c[0]) # all entries in the list should be the same length
-        self.c = np.concatenate(self.c).reshape(nneurons, nbins)
+        self.nbins = codeo.nbins
+        if self.format == 'packed':
+            self.p = np.vstack(c) # nneurons x nwords uint64 array
+        elif self.format == 'sparse':
+            # high bin indices of neuron nii are self.i[self.ptr[nii]:self.ptr[nii+1]]:
+            self.i = np.int64(np.hstack(c))
+            self.ptr = np.cumsum([0] + map(len, c))
+        else:
+            self.c = np.vstack(c) # nneurons x nbins int8 array
+
+    def get_hash(self):
+        """Return characteristic hash of the codes and their bin times"""
+        h = hashlib.md5()
+        h.update(self.format)
+        if self.format == 'packed':
+            h.update(self.p)
+        elif self.format == 'sparse':
+            h.update(self.i)
+            h.update(self.ptr)
+        else:
+            h.update(self._c)
+        h.update(self.t)
+        return h.hexdigest()
+
+    hash = property(get_hash)
+
+    def unsparse(self, niis):
+        """Return int8 array of the sparse codes of the neurons at niis, one per row"""
+        c = np.zeros((len(niis), self.nbins), dtype=np.int8)
+        for row, nii in enumerate(niis):
+            c[row, self.i[self.ptr[nii]:self.ptr[nii+1]]] = 1
+        return c
+
+    def get_c(self):
+        """Return the 2D int8 code array. Packed codes are unpacked on the fly, which is
+        slow and undoes their memory savings, so use rows() or the methods below where
+        possible"""
+        if self.format == 'packed':
+            return unpackcodes(self.p, self.nbins)
+        elif self.format == 'sparse':
+            return self.unsparse(range(self.nneurons))
+        return self._c
+
+    def set_c(self, c):
+        self._c = c
+
+    c = property(get_c, set_c)
+
+    def rows(self, niis):
+        """Return the rows of the 2D code array at niis, unpacking only those if packed or
+        sparse"""
+        if self.format == 'packed':
+            return unpackcodes(self.p[niis], self.nbins)
+        elif self.format == 'sparse':
+            if np.isscalar(niis):
+                return self.unsparse([niis])[0]
+            return self.unsparse(niis)
+        return self._c[niis]
+
+    def nhigh(self):
+        """Return the number of high bins in each neuron's code"""
+        if self.format == 'packed':
+            return self.coincidences().diagonal().copy()
+        elif self.format == 'sparse':
+            return np.diff(self.ptr)
+        return (self._c == get_ipython().user_ns['CODEVALS'][1]).sum(axis=1)
+
+    def coincidences(self):
+        """Return nneurons x nneurons array of the number of coincident high bins of each
+        pair of neurons. The diagonal is the number of high bins of each neuron"""
+        if self.format == 'packed':
+            return util.coincidences(self.p)
+        elif self.format == 'sparse':
+            return util.sparse_coincidences(self.i, self.ptr)
+        high = np.int64(self._c == get_ipython().user_ns['CODEVALS'][1])
+        return np.dot(high, high.T)
+
+    def intcodes(self):
+        """Return the integer representation of the population word in each time bin"""
+        if self.format == 'packed':
+            return util.packedints(self.p, self.nbins)
+        elif self.format == 'sparse':
+            bis, words = self.words()
+            intcodes = np.zeros(self.nbins, dtype=np.int64)
+            intcodes[bis] = words
+            return intcodes
+        return binarray2int(self._c)
+
+    def words(self):
+        """Return indices of the bins in which at least one neuron is high, and the integer
+        representation of the population word in each of them"""
+        if self.format != 'sparse':
+            intcodes = self.intcodes()
+            bis = intcodes.nonzero()[0]
+            return bis, intcodes[bis]
+        if self.nneurons > 63:
+            raise ValueError("can't represent words of more than 63 neurons as int64")
+        # merge all neurons' high bin indices, OR together the bits of those that coincide:
+        bits = np.repeat(np.int64(1) << np.arange(self.nneurons), np.diff(self.ptr))
+        sortis = self.i.argsort(kind='mergesort')
+        allbis = self.i[sortis]
+        bis, starts = np.unique(allbis, return_index=True)
+        if len(bis) == 0:
+            return bis, np.zeros(0, dtype=np.int64)
+        return bis, np.bitwise_or.reduceat(bits[sortis], starts)
 
     def syncis(self):
         """Returns synch indices, ie the indices of the bins for which all the
         neurons in this Codes object have a 1 in them"""
+        if self.format == 'packed':
+            # AND down all rows, only synchronous events across all cells will survive:
+            return unpackcodes(np.bitwise_and.reduce(self.p, axis=0),
+                               self.nbins).nonzero()[0]
+        elif self.format == 'sparse':
+            # intersect all rows' high bin indices:
+            syncis = self.i[self.ptr[0]:self.ptr[1]]
+            for nii in range(1, self.nneurons):
+                syncis = np.intersect1d(syncis, self.i[self.ptr[nii]:self.ptr[nii+1]],
+                                        assume_unique=True)
+            return syncis
         # take product down all rows, only synchronous events across all cells will survive:
-        return self.c.prod(axis=0).nonzero()[0]
+        return self._c.prod(axis=0).nonzero()[0]
 
     def syncts(self):
         """Returns synch times, ie times of the left bin edges for which
@@ -1015,9 +1730,15 @@ class SpikeCorr(object):
             self.tranges = split_tranges(self.tranges, self.width, self.tres)
             uns = get_ipython().user_ns
             highval = uns['CODEVALS'][1]
-            c, t = self.codes.c, self.codes.t
-            corrs, counts = util.sct(c, t, self.tranges, highval)
-            nneurons = len(c)
+            t = self.codes.t
+            if self.codes.format == 'packed':
+                corrs, counts = util.sct_packed(self.codes.p, t, self.tranges)
+            elif self.codes.format == 'sparse':
+                corrs, counts = util.sct_sparse(self.codes.i, self.codes.ptr, t,
+                                                self.tranges)
+            else:
+                corrs, counts = util.sct(self.codes.c, t, self.tranges, highval)
+            nneurons = self.codes.nneurons
             pairs = np.asarray(np.triu_indices(nneurons, k=1)).T
         else:
             # compute correlation coefficients once across entire set of tranges:
@@ -1031,9 +1752,7 @@ class SpikeCorr(object):
         """Calculate one spike correlation value for each cell pair, given codes spanning
         some subset of self.tranges, contrained to torus described by self.R, weighted by
         self.weights"""
-        c = codes.c # nneurons x nbins array
-        c = np.float64(c) # prevent int8 overflow somewhere
-        nneurons, nbins = c.shape
+        nneurons, nbins = codes.nneurons, codes.nbins
         nids = self.nids
         '''
         # calculate bin weights:
@@ -1057,18 +1776,27 @@ class SpikeCorr(object):
                 binw[ti0:ti1] = w[i]
         meanw = np.mean(binw)
         '''
-        # precalculate mean and std of each cell's codetrain, rows correspond to nids:
-        means = c.mean(axis=1)
-        stds = c.std(axis=1)
-
-        # precalculate number of high states in each neuron's code:
-        nhigh = np.zeros(nneurons, dtype=np.int64)
         uns = get_ipython().user_ns
         if uns['CODEVALS'] != [0, 1]:
             raise RuntimeError("counting of high states assumes CODEVALS = [0, 1]")
-        for nii0 in range(nneurons):
-            nhigh[nii0] = c[nii0].sum()
-        
+        packed = codes.format != 'dense' # packed or sparse
+        if packed:
+            # means, stds and dot products of binary codes all follow from the number of
+            # high and coincident high bins of each cell pair, no need to unpack:
+            dots = codes.coincidences()
+            nhigh = dots.diagonal().copy()
+            means = nhigh / nbins
+            stds = np.sqrt(means - means**2)
+        else:
+            c = np.float64(codes.c) # prevent int8 overflow somewhere
+            # precalculate mean and std of each cell's codetrain, rows correspond to nids:
+            means = c.mean(axis=1)
+            stds = c.std(axis=1)
+            # precalculate number of high states in each neuron's code:
+            nhigh = np.zeros(nneurons, dtype=np.int64)
+            for nii0 in range(nneurons):
+                nhigh[nii0] = c[nii0].sum()
+
         #shift, shiftcorrect = self.shift, self.shiftcorrect
         #if shift and shiftcorrect:
         #    raise ValueError("only one of shift or shiftcorrect can be nonzero")
@@ -1090,11 +1818,13 @@ class SpikeCorr(object):
                 # potentially shift only the second code train of each pair:
                 #c0 = self.r.n[ni0].code(tranges=tranges).c
                 #c1 = self.r.n[ni1].code(tranges=tranges, shift=shift).c
-                c0 = c[nii0]
-                c1 = c[nii1]
+                if packed:
+                    dot = dots[nii0, nii1]
+                else:
+                    dot = np.dot(c[nii0], c[nii1])
                 # (mean of product - product of means) / product of stds:
                 #numer = (c0 * c1 * binw).mean() - means[nii0] * means[nii1] * meanw
-                numer = np.dot(c0, c1) / nbins - means[nii0] * means[nii1]
+                numer = dot / nbins - means[nii0] * means[nii1]
                 denom = stds[nii0] * stds[nii1]
                 if numer == 0.0:
                     sc = 0.0 # even if denom is also 0
@@ -2477,44 +3207,99 @@ def pad0s(val, ndigits=2):
     val = '0'*nzerostoadd + val
     return val
 
-def txtdin2binarydin(fin, fout):
-    """Converts a csv text .din file to an int64 binary .din file"""
-    fi = file(fin, 'r') # open the din file for reading in text mode
+def readtxtchunks(f, chunksize=2**24):
+    """Generate successive chunks of roughly chunksize bytes of complete lines of text file
+    f, stripped of surrounding newlines"""
+    rem = ''
+    while True:
+        buf = f.read(chunksize)
+        if not buf:
+            break
+        buf = rem + buf
+        i = buf.rfind('\n') + 1 # end of last complete line in buf
+        buf, rem = buf[:i], buf[i:]
+        buf = buf.replace('\r', '').strip('\n')
+        if buf:
+            yield buf
+    rem = rem.replace('\r', '').strip('\n')
+    if rem:
+        yield rem
+
+def parsetxtchunk(chunk, ncols, dtype=np.int64):
+    """Parse a chunk of comma delimited text with ncols values per line into an nlines x
+    ncols array, with a single vectorized call"""
+    nlines = chunk.count('\n') + 1
+    a = np.fromstring(chunk.replace('\n', ','), dtype=dtype, sep=',')
+    if len(a) != nlines * ncols: # fromstring stops silently at the first unparsable value
+        raise ValueError("can't parse %d lines of %d values in chunk starting with %r"
+                         % (nlines, ncols, chunk[:50]))
+    return a.reshape(nlines, ncols)
+
+def checkmonotonic(t, tlast, name, nrows, rowis=None):
+    """Raise a ValueError if timestamps t, following tlast, aren't strictly increasing.
+    nrows is the number of rows that precede t, for reporting. If t doesn't come from
+    consecutive rows, rowis gives the row index of each of its timestamps instead"""
+    dt = np.diff(np.hstack(([tlast], t)))
+    if (dt <= 0).any():
+        i = np.flatnonzero(dt <= 0)[0]
+        if rowis is None:
+            rowi = nrows + i
+        else:
+            rowi = rowis[i]
+        raise ValueError("non-monotonic timestamp %d in row %d of %r" % (t[i], rowi, name))
+
+def txtdin2binarydin(fin, fout, chunksize=2**24):
+    """Converts a csv text .din file to an int64 binary .din file, streaming it through in
+    chunks of roughly chunksize bytes"""
+    fi = file(fin, 'rb') # open the din file for reading, newlines are handled per chunk
     fo = file(fout, 'wb') # for writing in binary mode
-    for line in fi:
-        line = line.split(',')
+    tlast, nrows = -1, 0
+    for chunk in readtxtchunks(fi, chunksize):
+        din = parsetxtchunk(chunk, 2)
         '''
         # for old NVS display, converts from NVS condition numbers (which increment with
         # repeats) to dimstim sweepis (which don't)
         nruns = 18
-        line[1] = int(line[1]) % nruns
+        din[:, 1] %= nruns
         '''
-        # write both values out as a C long longs, using the system's native ('@') byte order:
-        fo.write( struct.pack('@qq', int(line[0]), int(line[1])) )
+        checkmonotonic(din[:, 0], tlast, fin, nrows)
+        tlast, nrows = din[-1, 0], nrows + len(din)
+        # write both columns out as C long longs, using the system's native byte order:
+        fo.write(din.tostring())
     fi.close()
     fo.close()
     print 'Converted ascii din: %r to binary din: %r' % (fin, fout)
 
-def convertalltxtdin2binarydin(path=None):
-    """Converts all text .csv din files in path (or cwd) to 64 bit binary .din files of the
-    same name"""
+def _txtdin2binarydin(args):
+    """Single argument version of txtdin2binarydin(), for multiprocessing.Pool.map()"""
+    return txtdin2binarydin(*args)
+
+def convertalltxtdin2binarydin(path=None, recursive=False, nprocs=1):
+    """Converts all text .csv din files in path (or cwd), and in all its subfolders if
+    recursive, to 64 bit binary .din files of the same name. Files are converted in nprocs
+    processes in parallel. 1 converts them serially, None uses one process per CPU core"""
     if path == None:
         path = os.getcwd()
 
-    listing = os.listdir(path)
-    dinfnames = []
-
-    for fname in listing:
-        if fname.endswith('.csv'):
-            # text din filenames without the .csv extension
-            dinfnames.append(fname[:-len('.csv')])
-
-    for dinfname in dinfnames:
-        fin = os.path.join(path, dinfname) + '.csv'
-        fout = os.path.join(path, dinfname) + '.din'
-        #os.rename(fout, fin) # rename the csv .din file to .din.txt extension
-        txtdin2binarydin(fin, fout) # convert the text .csv file to binary .din file
-        #os.remove(fin) # delete the .din.txt file
+    args = []
+    for dirpath, dirnames, fnames in os.walk(path):
+        for fname in sorted(fnames):
+            if fname.endswith('.csv'):
+                # text din filename without the .csv extension
+                dinfname = os.path.join(dirpath, fname[:-len('.csv')])
+                args.append((dinfname + '.csv', dinfname + '.din'))
+        if not recursive:
+            break
+
+    if nprocs == 1:
+        map(_txtdin2binarydin, args)
+    else:
+        pool = multiprocessing.Pool(nprocs)
+        try:
+            pool.map(_txtdin2binarydin, args, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
 
 def renameSpikeFiles(path, newname):
     """Renames all .spk files in path to newname, retaining their '_t##.spk' ending"""
@@ -2526,30 +3311,18 @@ def renameSpikeFiles(path, newname):
                 print newfname
                 os.rename(os.path.join(path, fname), os.path.join(path, newfname))
 
-def csv2binary(fin, multiplier=1e6, skipfirstline=True):
+def csv2binary(fin, multiplier=1e6, skipfirstline=True, chunksize=2**24):
     """Converts spike data in a csv file, with cells in the columns and times down the rows,
     into int64 binary files, one for each neuron. Takes csv values and multiplies them by
-    multiplier before saving"""
+    multiplier before saving. The csv file is streamed through in chunks of roughly
+    chunksize bytes, and each neuron's spike times are checked to be increasing"""
     fin = os.path.normpath(fin)
-    fi = file(fin, 'r') # open csv file for reading in text mode
+    fi = file(fin, 'rb') # open csv file for reading, newlines are handled per chunk
     print 'Exporting %s to:' % fi.name
-    firstline = fi.next()
+    firstline = fi.readline()
     nneurons = len(firstline.split(','))
     if not skipfirstline: # ie first line isn't just column headers
         fi.seek(0)
-    data = [] # nested list, one entry per neuron
-    for ni in range(nneurons):
-        data.append([]) # init each neuron's list
-    for line in fi:
-        line = line.replace('\n', '') # strip the newline character
-        line = line.split(',')
-        for ni, strval in enumerate(line): # going horizontally across the line
-            try:
-                data[ni].append(intround(float(strval)*multiplier))
-            except ValueError: # strval is empty string
-                pass
-    fi.close()
-    #return data
     path = os.path.splitext(fi.name)[0] # extensionless path + filename
     try:
         os.mkdir(path) # make a dir with that name
@@ -2557,16 +3330,41 @@ def csv2binary(fin, multiplier=1e6, skipfirstline=True):
         pass
     # just the extensionless filename, replace spaces with underscores:
     tail = os.path.split(path)[-1].replace(' ', '_')
-    for ni, neuron in enumerate(data):
+    fos = []
+    for ni in range(nneurons):
         fname = (os.path.join(path, tail) + '_t' +
                  pad0s(ni, ndigits=len(str(nneurons))) + '.spk')
-        fo = file(fname, 'wb') # for writing in binary mode
-        print fo.name
-        for spiketime in neuron:
-            # write each spiketime to the file, there should be a more streamlined way
-            # to do this. Write the value out as a C long long, using the system's native
-            # ('@') byte order
-            fo.write( struct.pack('@q', spiketime) )
+        fos.append(file(fname, 'wb')) # for writing in binary mode
+        print fname
+    # count rows from the start of the file, including any header line, for reporting:
+    tlasts, nrows = [-1] * nneurons, int(skipfirstline)
+    for chunk in readtxtchunks(fi, chunksize):
+        # strip whitespace around values, so whitespace-only values count as empty:
+        chunk = re.sub(r'[ \t]*([,\n])[ \t]*', r'\1', chunk).strip(' \t')
+        if chunk.count(',') != (chunk.count('\n') + 1) * (nneurons - 1):
+            # pad lines with missing trailing values with empty ones:
+            chunk = '\n'.join([ line + ',' * (nneurons - 1 - line.count(','))
+                                for line in chunk.split('\n') ])
+        # fill empty values, where columns of shorter spike trains have run out, with nan:
+        chunk = re.sub(r'(?<![^,\n])(?![^,\n])', 'nan', chunk)
+        data = parsetxtchunk(chunk, nneurons, dtype=np.float64) * multiplier
+        for ni, fo in enumerate(fos): # going horizontally across the lines
+            spikes = data[:, ni]
+            rowis = np.flatnonzero(~np.isnan(spikes)) # rows in chunk with a spike time
+            spikes = spikes[rowis]
+            if len(spikes) == 0:
+                continue
+            # round half away from zero, as intround() does for scalars:
+            spikes = np.sign(spikes) * np.floor(np.abs(spikes) + 0.5)
+            spikes = spikes.astype(np.int64)
+            checkmonotonic(spikes, tlasts[ni], '%s column %d' % (fin, ni), nrows,
+                           rowis=nrows+rowis)
+            tlasts[ni] = spikes[-1]
+            # write spike times out as C long longs, using the system's native byte order:
+            fo.write(spikes.tostring())
+        nrows += len(data)
+    fi.close()
+    for fo in fos:
         fo.close()
 
 def warn(msg, level=2, exit_val=1):
@@ -2750,6 +3548,26 @@ def binslow(i, minbits=8):
     return s
 
 # an alternative would be to use int('10110', base=2) for each column, probably slower though
+def packcode(c):
+    """Pack 1D binary code array c into a 1D uint64 array, with bin i stored in bit i%64 of
+    word i//64. Padding bits in the last word are 0"""
+    nbins = len(c)
+    nwords = (nbins + 63) // 64
+    b = np.zeros(nwords*64, dtype=np.uint8)
+    b[:nbins] = c
+    # packbits fills each byte MSB first, reverse bits within each byte to get LSB first:
+    p = np.packbits(b.reshape(-1, 8)[:, ::-1]).view('<u8')
+    return p.astype(np.uint64, copy=False)
+
+def unpackcodes(p, nbins):
+    """Inverse of packcode(). Unpack uint64 array p, 1D or 2D with one packed code per row,
+    into an int8 array of codes nbins long"""
+    p = np.asarray(p).astype('<u8', copy=False)
+    shape = p.shape[:-1] + (nbins,)
+    b = np.unpackbits(p.reshape(-1, p.shape[-1]).view(np.uint8), axis=1)
+    b = b.reshape(len(b), -1, 8)[:, :, ::-1].reshape(len(b), -1) # LSB first
+    return b[:, :nbins].astype(np.int8).reshape(shape)
+
 def binarray2int(bin):
     """Takes a 2D binary array (only 1s and 0s, with rows LSB to MSB from top to bottom)
     and returns the base 10 integer representations of the columns"""
@@ -3070,6 +3888,31 @@ def mean_accum(data):
     result /= len(data)
     return result
 
+def framesums(frames, rowis, frameis, nrows, chunksize=1024):
+    """Return nrows x npixels array of sums of the frames at frameis, with each frame index
+    assigned to the row at the same position in rowis. Instead of gathering frames, count
+    how many times each frame occurs in each row, and multiply the count matrix by the
+    frames reshaped to nframes x npixels, in chunks of chunksize frames. Frame indices out
+    of range are ignored. Also return the number of frames in each row"""
+    nframes = len(frames)
+    npix = int(np.prod(frames.shape[1:]))
+    # sort by frame index, so that each chunk of frames is a contiguous slice:
+    sortis = frameis.argsort(kind='mergesort')
+    frameis = frameis[sortis]
+    rowis = rowis[sortis]
+    sums = np.zeros((nrows, npix), dtype=np.float64)
+    for f0 in range(0, nframes, chunksize):
+        f1 = min(f0 + chunksize, nframes)
+        nf = f1 - f0
+        lo, hi = frameis.searchsorted([f0, f1])
+        # nrows x nf frame counts, in a single bincount call:
+        counts = np.bincount(rowis[lo:hi]*nf + frameis[lo:hi] - f0, minlength=nrows*nf)
+        counts = counts.reshape(nrows, nf).astype(np.float64)
+        sums += counts.dot(np.float64(frames[f0:f1]).reshape(nf, npix))
+    lo, hi = frameis.searchsorted([0, nframes])
+    nperrow = np.bincount(rowis[lo:hi], minlength=nrows)
+    return sums, nperrow
+
 def mean_accum2(data, indices):
     """A variant of mean_accum(), where you provide all the data and the indices into it
     to average over. This was Tim Hochberg's version"""
@@ -3258,6 +4101,89 @@ def pathdecomp(path):
     filesystem root"""
     return path.split(os.path.sep)
 
+def pad8(nbytes):
+    """Return nbytes rounded up to the nearest multiple of 8"""
+    return (nbytes + 7) // 8 * 8
+
+def cachekey(*args):
+    """Return hex digest of repr of args, for use as a disk cache key"""
+    return hashlib.md5(repr(args)).hexdigest()
+
+def loadcache(kind, key):
+    """Return object saved to the disk cache in CACHEPATH under kind and key, or None on a
+    miss, or if caching is disabled by setting CACHEPATH to None"""
+    CACHEPATH = get_ipython().user_ns['CACHEPATH']
+    if CACHEPATH == None:
+        return None
+    fname = os.path.join(CACHEPATH, kind, key + '.pickle')
+    try:
+        with open(fname, 'rb') as f:
+            return cPickle.load(f)
+    except (IOError, EOFError, cPickle.UnpicklingError, AttributeError, ImportError):
+        return None
+
+def savecache(kind, key, obj):
+    """Save obj to the disk cache in CACHEPATH under kind and key. Return whether it was
+    saved, which it isn't if caching is disabled, or if obj can't be pickled"""
+    CACHEPATH = get_ipython().user_ns['CACHEPATH']
+    if CACHEPATH == None:
+        return False
+    try:
+        data = cPickle.dumps(obj, 2)
+    except (cPickle.PicklingError, TypeError, AttributeError):
+        return False
+    path = os.path.join(CACHEPATH, kind)
+    fname = os.path.join(path, key + '.pickle')
+    try:
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        # write to a temp file first, then rename, so that concurrent loads never see a
+        # partially written file:
+        fd, tmpfname = tempfile.mkstemp(dir=path)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.rename(tmpfname, fname)
+    except (IOError, OSError):
+        warn("couldn't write cache file %r" % fname)
+        return False
+    return True
+
+def encode_spikes(spikes, blocksize=2**16):
+    """Delta-encode sorted int64 spike times (us) into blocks of at most blocksize spikes,
+    each spanning less than 2**32 us. Return int64 block base times, int64 block start
+    indices, and uint32 deltas of each spike from the base of its block"""
+    spikes = np.asarray(spikes, dtype=np.int64)
+    nspikes = len(spikes)
+    starts = []
+    i = 0
+    while i < nspikes:
+        starts.append(i)
+        # end block at blocksize spikes, or before first spike that overflows a uint32:
+        i = min(i + blocksize, spikes.searchsorted(spikes[i] + 2**32))
+    starts = np.asarray(starts, dtype=np.int64)
+    bases = spikes[starts]
+    counts = np.diff(np.append(starts, nspikes))
+    deltas = (spikes - np.repeat(bases, counts)).astype(np.uint32)
+    return bases, starts, deltas
+
+def decode_spikes(bases, starts, deltas, trange=None):
+    """Decode delta-encoded spike blocks from encode_spikes() into int64 spike times (us).
+    If trange is given, only decode the blocks that overlap it, and return only the spikes
+    that fall within it, end inclusive"""
+    stops = np.append(starts[1:], len(deltas))
+    if trange != None:
+        t0, t1 = trange
+        b0 = max(bases.searchsorted(t0, side='right') - 1, 0) # block containing t0
+        b1 = bases.searchsorted(t1, side='right')
+        bases, starts, stops = bases[b0:b1], starts[b0:b1], stops[b0:b1]
+    spikes = np.repeat(bases, stops - starts)
+    if len(starts) > 0:
+        spikes += deltas[starts[0]:stops[-1]]
+    if trange != None:
+        lo, hi = spikes.searchsorted(t0), spikes.searchsorted(t1, side='right')
+        spikes = spikes[lo:hi]
+    return spikes
+
 def eof(f):
     """Return whether file pointer is a end of file"""
     orig = f.tell()
@@ -3303,6 +4229,8 @@ def sample_uquadratic(a=0, b=1, size=None):
 
 def split_tranges(tranges, width, tres):
     """Split up tranges into lots of smaller ones, with width and tres"""
+    if isinstance(tranges, TrangeSet):
+        return tranges.split(width, tres)
     newtranges = []
     for trange in tranges:
         t0, t1 = trange
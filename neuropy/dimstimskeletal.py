@@ -177,28 +177,14 @@ class SweepTable(object):
             d.random = var.random
 
     def builddimitable(self):
-        """Build the dimension index table"""
-        # Can't figure out how to use a recursive generator/function to do this, see Apress Beginning Python p192
-        # HACK!!: generate and exec the appropriate Python code to build the ordered (unshuffled/unrandomized) dimension index table
-        dimi = [None]*len(self.dimensions) # stores the index we're currently on in each dimension
-        self.dimitable = [] # ordered dimension index table, these are indices into the values in dimensions, dimensions are in columns, sweeps are in rows
-        # generate code with the right number of nested for loops
-        code = ''
-        tabs = ''
-        for dimension in self.dimensions: # generate ndim nested for loops...
-            i = str(dimension.dim)
-            code += tabs+'for dimi['+i+'] in range(len(self.dimensions['+i+'])):\n'
-            tabs += TAB # add a tab to tabs in preparation for the next for loop, or the innermost part of the last one
-        code += tabs+'self.dimitable.append(copy(dimi))\n' # innermost part of the nested for loops, copying dimi is important
-        exec(code) # run the generated code, this builds the ordered dimitable with all the permutations
-        '''
-        # example of what the generated code looks like for 3 dimensions:
-        for dimi[0] in range(len(self.dimensions[0])):
-            for dimi[1] in range(len(self.dimensions[1])):
-                for dimi[2] in range(len(self.dimensions[2])):
-                    self.dimitable.append(copy(dimi))
-        '''
-        self.dimitable = np.asarray(self.dimitable)
+        """Build the dimension index table, ordered (unshuffled/unrandomized), as a vectorized
+        Cartesian product of the indices into the values of each dimension. Dimensions are
+        in columns, sweeps are in rows, and the last dimension changes on every sweep"""
+        lengths = [ len(dimension) for dimension in self.dimensions ]
+        ndims = len(lengths)
+        # eg, for 3 dimensions, rows are [i0, i1, i2] for i0 in range(lengths[0]), for i1
+        # in range(lengths[1]), for i2 in range(lengths[2]):
+        self.dimitable = np.indices(lengths).reshape(ndims, int(np.prod(lengths))).T
 
     def pprint(self, i=None):
         """Print out the sweep table at sweep table indices i,
@@ -258,54 +244,64 @@ class BlankScreen(Experiment):
 
 
 class Movie(Experiment):
+    def __getstate__(self):
+        """Don't pickle frames, such as when sending self to another process. Call load()
+        there to memory-map them again"""
+        d = self.__dict__.copy()
+        d.pop('frames', None)
+        return d
+
     def load(self, asarray=False, flip=True):
-        """Load movie frames"""
+        """Load movie frames as a read-only memory-mapped array, shared by all Movies of the
+        same file. If not asarray, frames is a list of 2D frames instead. Flipping is done
+        with a view, without copying"""
         # figure out the local path to the same movie file:
         pathparts = core.pathdecomp(self.static.fname) # as it existed on the stim computer
         movi = pathparts.index('mov')
         tail = os.path.join(pathparts[movi+1:]) # everything after 'mov' folder
         MOVIEPATH = get_ipython().user_ns['MOVIEPATH']
         fullfname = os.path.join(MOVIEPATH, *tail) # full fname with local MOVIEPATH
-        self.f = file(fullfname, 'rb') # open the movie file for reading in binary format
-        headerstring = self.f.read(5)
-        if headerstring == 'movie': # a header has been added to the start of the file
-            self.ncellswide, = struct.unpack('H', self.f.read(2)) # 'H'== unsigned short int
-            self.ncellshigh, = struct.unpack('H', self.f.read(2))
-            self.nframes, = struct.unpack('H', self.f.read(2))
-            if self.nframes == 0: # this was used in Cat 15 mseq movies to indicate 2**16 frames, shouldn't really worry about this, cuz we're using slightly modified mseq movies now that don't have the extra frame at the end that the Cat 15 movies had (see comment in Experiment module), and therefore never have a need to indicate 2**16 frames
-                self.nframes = 2**16
-            self.offset = self.f.tell() # header is 11 bytes long
-        else: # there's no header at the start of the file, set the file pointer back to the beginning and use these hard coded values:
-            self.f.seek(0)
-            self.ncellswide = self.ncellshigh = 64
-            self.nframes = 6000
-            self.offset = self.f.tell() # header is 0 bytes long
+        self.fullfname = fullfname
+        (self.ncellswide, self.ncellshigh, self.nframes, self.offset,
+         frames) = memmapmovie(fullfname)
         self.framesize = self.ncellshigh*self.ncellswide
-
-        # read in all of the frames
-        # maybe check first to see if file is > 1GB, if so, _loadaslist() to prevent trying to allocate one huge piece of contiguous memory and raising a MemoryError, or worse, segfaulting
+        if flip:
+            frames = frames[::, ::-1, ::] # flip all frames vertically for OpenGL's bottom left origin
         if asarray:
-            self._loadasarray(flip=flip)
+            self.frames = frames
         else:
-            self._loadaslist(flip=flip)
-        leftover = self.f.read() # check if there are any leftover bytes in the file
-        if leftover != '':
-            pprint(leftover)
-            print self.ncellswide, self.ncellshigh, self.nframes
-            raise RuntimeError('There are unread bytes in movie file %r. Width, height, or nframes is incorrect in the movie file header.' % self.static.fname)
-        self.f.close() # close the movie file
-
-    def _loadasarray(self, flip=True):
-        self.frames = np.fromfile(self.f, dtype=np.uint8, count=self.nframes*self.framesize)
-        self.frames.shape = (self.nframes, self.ncellshigh, self.ncellswide)
-        if flip:
-            self.frames = self.frames[::, ::-1, ::] # flip all frames vertically for OpenGL's bottom left origin
-
-    def _loadaslist(self, flip=True):
-        self.frames = []
-        for framei in xrange(self.nframes): # one frame at a time...
-            frame = np.fromfile(self.f, dtype=np.uint8, count=self.framesize) # load the next frame
-            frame.shape = (self.ncellshigh, self.ncellswide)
-            if flip:
-                frame = frame[::-1, ::] # flip all frames vertically for OpenGL's bottom left origin
-            self.frames.append(frame)
+            self.frames = list(frames) # views of each frame
+
+
+_MOVIEFRAMES = {} # memory-mapped movie frames and header values, indexed by full file name
+
+def memmapmovie(fullfname):
+    """Return width, height, nframes, header offset and read-only memory-mapped frames
+    of movie file fullfname. The memmap is shared by all callers in this process, and the
+    OS shares its pages with any other process that maps the same file"""
+    try:
+        return _MOVIEFRAMES[fullfname]
+    except KeyError:
+        pass
+    f = file(fullfname, 'rb') # open the movie file for reading in binary format
+    headerstring = f.read(5)
+    if headerstring == 'movie': # a header has been added to the start of the file
+        ncellswide, = struct.unpack('H', f.read(2)) # 'H'== unsigned short int
+        ncellshigh, = struct.unpack('H', f.read(2))
+        nframes, = struct.unpack('H', f.read(2))
+        if nframes == 0: # this was used in Cat 15 mseq movies to indicate 2**16 frames, shouldn't really worry about this, cuz we're using slightly modified mseq movies now that don't have the extra frame at the end that the Cat 15 movies had (see comment in Experiment module), and therefore never have a need to indicate 2**16 frames
+            nframes = 2**16
+        offset = f.tell() # header is 11 bytes long
+    else: # there's no header at the start of the file, use these hard coded values:
+        ncellswide = ncellshigh = 64
+        nframes = 6000
+        offset = 0 # header is 0 bytes long
+    f.close()
+    nbytes = os.path.getsize(fullfname)
+    if nbytes != offset + nframes*ncellshigh*ncellswide:
+        print ncellswide, ncellshigh, nframes
+        raise RuntimeError('Movie file %r is %d bytes long. Width, height, or nframes is incorrect in the movie file header.' % (fullfname, nbytes))
+    frames = np.memmap(fullfname, dtype=np.uint8, mode='r', offset=offset,
+                       shape=(nframes, ncellshigh, ncellswide))
+    _MOVIEFRAMES[fullfname] = ncellswide, ncellshigh, nframes, offset, frames
+    return _MOVIEFRAMES[fullfname]
@@ -11,8 +11,9 @@ import matplotlib as mpl
 import core
 from core import getargstr, TAB, warn, rstrip, dictattr, intround, toiter
 from core import joinpath, lastcmd
-from core import Codes, RevCorrWindow
+from core import Codes, RevCorrWindow, DinIndex, TrangeSet
 import neuron
+from neuron import calc_stas
 
 # many of these are required when eval'ing the textheader:
 from dimstimskeletal import deg2pix, InternalParams, StaticParams, DynamicParams
@@ -24,6 +25,8 @@ MSEQ16 = 'MSEQ16' # formerly mseq16.m
 MSEQ32 = 'MSEQ32' # formerly mseq32.m
 
 _MOVIES = dictattr()
+# bump whenever what's cached from parsing a textheader changes:
+TEXTHEADERCACHEVERSION = 1
 
 
 class BaseExperiment(object):
@@ -55,18 +58,46 @@ class BaseExperiment(object):
         self.treebuf.write(string)
         self.r.writetree(string)
 
-    def load(self):
-        f = open(self.path, 'rb')
-        self.din = np.fromfile(f, dtype=np.int64).reshape(-1, 2) # reshape to nrows x 2 cols
-        f.close()
+    def get_dinindex(self):
+        """Return run-length encoded index of the din, building it on first call"""
         try:
-            txthdrpath = rstrip(self.path, '.din') + '.textheader'
-            f = open(txthdrpath, 'rU') # use universal newline support
-            self.textheader = f.read() # read it all in
+            return self._dinindex
+        except AttributeError:
+            self._dinindex = DinIndex(self.din)
+            return self._dinindex
+
+    dinindex = property(get_dinindex)
+
+    def stimon(self):
+        """Return TrangeSet of times when stimuli were on the screen, ie excluding
+        NULLDIN periods"""
+        NULLDIN = get_ipython().user_ns['NULLDIN']
+        dinindex = self.dinindex
+        tends = dinindex.tends.copy()
+        tends[-1] = self.trange[1] # screen turns off one refresh after last din
+        on = dinindex.sweepis != NULLDIN
+        return TrangeSet(np.column_stack((dinindex.t0s[on], tends[on])))
+
+    def load(self, din=None, textheader=None):
+        """Load din and textheader from .din and .textheader files, or use the ones passed
+        in, such as from a RecordingCache"""
+        if din is None:
+            f = open(self.path, 'rb')
+            din = np.fromfile(f, dtype=np.int64).reshape(-1, 2) # reshape to nrows x 2 cols
             f.close()
-        except IOError:
-            warn("couldn't load text header associated with '%s'" % self.name)
-            self.textheader = '' # set to empty
+        self.din = din
+        self.__dict__.pop('_dinindex', None) # any existing index is stale
+        if textheader is None:
+            try:
+                txthdrpath = rstrip(self.path, '.din') + '.textheader'
+                f = open(txthdrpath, 'rU') # use universal newline support
+                textheader = f.read() # read it all in
+                f.close()
+            except IOError:
+                warn("couldn't load text header associated with '%s'" % self.name)
+                textheader = '' # set to empty
+        self.textheader = textheader
+        self.rawtextheader = textheader # as read from file, for RecordingCache
 
         treestr = self.level*TAB + self.name + '/'
         # print string to tree hierarchy and screen
@@ -76,22 +107,33 @@ class BaseExperiment(object):
         if self.textheader != '':
             # comment out all lines starting with "from dimstim"
             self.textheader = self.textheader.replace('from dimstim', '#from dimstim')
-            names1 = locals().copy() # namespace before execing the textheader
-            exec(self.textheader)
-            names2 = locals().copy() # namespace after
-            # names that were added to the namespace, excluding the 'names1' name itself:
-            newnames = [ n2 for n2 in names2 if n2 not in names1 and n2 != 'names1' ]
-            try:
+            key = core.cachekey(TEXTHEADERCACHEVERSION, self.textheader)
+            params = core.loadcache('textheader', key) # cached parsed params, if any
+            if params != None:
+                self.__dict__.update(params)
+            else:
+                names = self.exec_textheader()
                 # dimstim up to Cat 15 didn't have a version, neither did NVS display
-                self.__version__ = eval('__version__')
-            except NameError:
-                self.__version__ = 0.0
-            if self.__version__ >= 0.16: # after major refactoring of dimstim
-                for newname in newnames:
-                    # bind each variable in the textheader as an attrib of self
-                    self.__setattr__(newname, eval(newname))
-                self.sweeptable = SweepTable(experiment=self.e) # build the sweep table
-                self.st = self.sweeptable.data # synonym, used a lot by experiment subclasses
+                self.__version__ = names.get('__version__', 0.0)
+                if self.__version__ >= 0.16: # after major refactoring of dimstim
+                    for newname, val in names.items():
+                        # bind each variable in the textheader as an attrib of self
+                        self.__setattr__(newname, val)
+                    self.sweeptable = SweepTable(experiment=self.e) # build the sweep table
+                    # synonym, used a lot by experiment subclasses:
+                    self.st = self.sweeptable.data
+                    params = dict([ (name, self.__dict__[name]) for name in
+                                    names.keys() + ['__version__', 'sweeptable', 'st'] ])
+                    core.savecache('textheader', key, params)
+                else:
+                    # Cat 15 params end up bound to movie objects that refer back to self,
+                    # and depend on MOVIEPATH, so they aren't cached
+                    self.oldparams = dictattr()
+                    for newname, val in names.items():
+                        # bind each variable in the textheader to oldparams
+                        self.oldparams[newname] = val
+                    self.loadCat15exp()
+            if self.__version__ >= 0.16:
                 # this doesn't work for textheaders generated by dimstim 0.16, since
                 # xorigDeg and yorigDeg were accidentally omitted from all the experiment
                 # scripts and hence the textheaders too:
@@ -106,13 +148,7 @@ class BaseExperiment(object):
                     if fname not in _MOVIES:
                         # add movie experiment, indexed according to movie data file name,
                         # to prevent from ever loading its frames more than once
-                        _MOVIES[fname] = e
-            else:
-                self.oldparams = dictattr()
-                for newname in newnames:
-                    # bind each variable in the textheader to oldparams
-                    self.oldparams[newname] = eval(newname)
-                self.loadCat15exp()
+                        _MOVIES[fname] = self.e
         else:
             # use the time difference between the first two din instead
             self.REFRESHTIME = self.din[1, 0] - self.din[0, 0]
@@ -120,6 +156,15 @@ class BaseExperiment(object):
         # add an extra refresh time after last din, that's when screen actually turns off
         self.trange = (self.din[0, 0], self.din[-1, 0] + self.REFRESHTIME)
 
+    def exec_textheader(self):
+        """Exec textheader, return dict of the names it defines"""
+        names1 = locals().copy() # namespace before execing the textheader
+        exec(self.textheader)
+        names2 = locals().copy() # namespace after
+        # names that were added to the namespace, excluding the 'names1' name itself:
+        newnames = [ n2 for n2 in names2 if n2 not in names1 and n2 != 'names1' ]
+        return dict([ (newname, eval(newname)) for newname in newnames ])
+
     def loadCat15exp(self):
         ## TODO: - fake a .e dimstim.Experiment object, to replace what used to be the
         ## .stims object for movie experiments
@@ -386,39 +431,20 @@ class BaseExperiment(object):
         #    print dimlist[dim]
         #print
 
-        # Build the ordered (unshuffled/unrandomized) indextable
-        vali = [None]*ndims # stores the index we're on in each dimension
-        indextable = [] # stores the ordered table of indices for all dimensions over all sweeps
-        # generate code with the right number of nested for loops
-        code = ''
-        tabs = ''
-        for dim in range(ndims): # here come the nested for loops...
-
-            code += tabs+'for vali['+str(dim)+'] in xrange(dimlengths['+str(dim)+']):\n' # val index for this dim, used for all vars in this dim
-            tabs +='\t'
-
-        code += tabs+'indextable.append(vali[:])\n' # here's the innermost part of the nested for loops, val[:] returns a copy (important!)
-        #print code
-        #print
-        exec(code) # run the generated code, this builds the ordered indextable with all the permutations
-
-        # example of what the generated code looks like for 3 dimensions:
-        #for vali[0] in range(dimlengths[0]):
-        #    for vali[1] in range(dimlengths[1]):
-        #        for vali[2] in range(dimlengths[2]):
-        #            indextable.append(vali[:])
-
+        # Build the ordered (unshuffled/unrandomized) indextable of all the permutations, a
+        # vectorized Cartesian product. Dims are in columns, sweeps in rows, and the last
+        # dim changes on every sweep:
+        indextable = np.indices(dimlengths).reshape(ndims, int(np.prod(dimlengths))).T
         nsweeps = len(indextable)
 
         # Now use indextable to build the sweeptable
         sweeptable = {}
-        for var in varlist:
-            sweeptable[var] = [None]*nsweeps # init with all the var names as the key names
         for dimi in range(ndims):
             for var in dimvars[dimi]:
-                evalvar = eval(var)
-                for sweepi in range(nsweeps):
-                    sweeptable[var][sweepi] = evalvar[ indextable[sweepi][dimi] ] # eg sweeptable['ori'][sweepi]=ori[ indextable[sweepi][dimi] ]
+                # eg sweeptable['ori'] = ori[indextable[:, dimi]], index the list instead of
+                # an array of it to keep the type of each value, ie don't coerce ints to floats:
+                vals = eval(var)
+                sweeptable[var] = [ vals[i] for i in indextable[:, dimi] ]
 
         #sweeptable['sweepi'] = range(nsweeps) # add ordered sweep indices to a new key in sweeptable called 'sweepi'
 
@@ -430,71 +456,58 @@ class BaseExperiment(object):
             nshuffles = 1 # shuffle sweeplist only once, use same sweeplist for each run
             ncopies = nruns # make sweeplist ncopies of itself long after shuffling
 
-        #t1 = time.clock()
-        sweeplistlist = [None]*nsweeps*nshuffles # init list of concatenated sweeplists for speed
+        sweeplists = [] # one sweeplist per shuffle
         for shufflei in range(nshuffles):
-            sweeplist = range(nsweeps) # init with an ordered sweeplist for each shuffle run
+            sweeplist = np.arange(nsweeps) # init with an ordered sweeplist for each shuffle run
 
             # Do the appropriate shuffling by overwriting the appropriate entries in sweeplist in the appropriate way
 
             # check if all dims are set to shuffle/randomize, if so, do it the fast way
-            allshuffled = 1
-            allrandomized = 1
-            for dimi in range(ndims):
-                allshuffled *= (dimshuffles[dimi]==1)
-                allrandomized *= (dimshuffles[dimi]==2)
+            allshuffled = ndims > 0 and (np.asarray(dimshuffles) == 1).all()
+            allrandomized = ndims > 0 and (np.asarray(dimshuffles) == 2).all()
+            # use core.shuffle and core.randomize throughout, in the same order as always, so
+            # that sweep orders from a given np.random.seed() stay the same:
             if allshuffled:
-                sweeplist = core.shuffle(sweeplist)
+                sweeplist = np.asarray(core.shuffle(range(nsweeps)))
             elif allrandomized:
-                sweeplist = core.randomize(sweeplist)
-            else: # shuffle/randomize each dim individually (slower)
+                sweeplist = np.asarray(core.randomize(range(nsweeps)))
+            else: # shuffle/randomize each dim individually
                 for dimi in xrange(ndims):
-                    if dimshuffles[dimi] in (1, 2): # if flag is set to shuffle or randomize
-                        col = [None]*nsweeps # init for speed
-                        for sweepi in sweeplist: # extract column from indextable for dimi
-                            col[sweepi] = indextable[sweepi][dimi]
-                        #col = [ indextable[sweepi][dimi] for sweepi in sweeplist ]
-                        # use numpy's argsort instead: !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
-                        colvi = [ (v, i) for i, v in enumerate(col) ] # load up col values and indices into a list of tuples
-                        colvi.sort() # sort the pair according to v (first entry in (v,i) tuple), the indices will go along for the ride
-                        sortindices = [ i for v, i in colvi ] # unload the sorted indices, these are the indices into sweeplist that would get you a sorted sweeplist
-                        sortedsweeplist = [None]*nsweeps # init for speed
-                        for i, si in enumerate(sortindices): # create sweeplist sorted in order of dimi
-                            sortedsweeplist[i] = sweeplist[si]
-                        #sortedsweeplist = [ sweeplist[si] for si in sortindices ]
-
-                        offset = 1 # offset is the product of the lengths of all dims other than dimi
-                        for dimj in xrange(ndims):
-                            if dimj != dimi: # for all dims other than dimi
-                                offset *= dimlengths[dimj]
-
-                        ldimi = dimlengths[dimi] # length of dimi, including pre-shuffle repeats
-                        if nsweeps % ldimi != 0:
-                            raise ValueError("Somehow, nsweeps isn't an integer multiple of "
-                                             "length (including pre-shuffle repeats) of dim "
-                                             "%d" % dimi)
-                        ncollections = nsweeps // ldimi # can safely divide now
-
-                        for colli in xrange(ncollections):
-                            # collis is a collection of indices to shuffle over, made up of every offset'th index, starting from colli
-                            collis = [None]*ldimi # init for speed
-                            for i, j in enumerate(xrange(colli, offset*ldimi, offset)):
-                                collis[i] = j
-                            #collis = [ j for j in xrange(colli,offset*ldimi,offset) ]
-                            if dimshuffles[dimi] == 1: # shuffle this dim
-                                shuffcollis = core.shuffle(collis)
-                            elif dimshuffles[dimi] == 2: # randomize this dim
-                                shuffcollis = core.randomize(collis)
-                            for i in xrange(len(collis)):
-                                sweeplist[sortindices[collis[i]]] = sortedsweeplist[shuffcollis[i]] # update sweeplist appropriately, this is the trickiest bit
-            for i, j in enumerate(range(nsweeps*shufflei, nsweeps*(shufflei+1))):
-                sweeplistlist[j] = sweeplist[i] # enters a copy of sweeplist for this shuffle into the concatenated list of sweeplists
-
-        sweeplist = sweeplistlist # rename it now that we're done the shuffle loop
-        #t2 = time.clock()
-        #print 'shuffling took', t2-t1
-
-        sweeplist *= ncopies # does nothing if shuffleRuns==1 (ncopies is 1), make nruns copies of sweeplist if shuffleRuns==0 (ncopies is nruns)
+                    if dimshuffles[dimi] not in (1, 2): # flag isn't set to shuffle or randomize
+                        continue
+                    # dimi's index of each sweep in sweeplist. If an earlier dim was
+                    # randomized, sweeplist has repeats, and the sweeps missing from it
+                    # always sorted first, so give them -1:
+                    col = np.tile(-1, nsweeps)
+                    col[sweeplist] = indextable[sweeplist, dimi]
+                    # indices into sweeplist that would sort it in order of dimi:
+                    sortindices = col.argsort(kind='mergesort') # stable
+                    sortedsweeplist = sweeplist[sortindices]
+                    ldimi = dimlengths[dimi] # length of dimi, including pre-shuffle repeats
+                    if nsweeps % ldimi != 0:
+                        raise ValueError("Somehow, nsweeps isn't an integer multiple of "
+                                         "length (including pre-shuffle repeats) of dim "
+                                         "%d" % dimi)
+                    # offset is the product of the lengths of all dims other than dimi:
+                    offset = nsweeps // ldimi # can safely divide now
+                    # each row is a collection of indices to shuffle over, made up of every
+                    # offset'th index, starting from the row index:
+                    collis = np.arange(offset)[:, None] + offset * np.arange(ldimi)
+                    rows = np.arange(offset)[:, None]
+                    if dimshuffles[dimi] == 1: # shuffle each row of this dim
+                        f = core.shuffle
+                    else: # randomize each row of this dim
+                        f = core.randomize
+                    # column indices of each row, in row order:
+                    cols = np.asarray([ f(range(ldimi)) for colli in xrange(offset) ])
+                    shuffcollis = collis[rows, cols]
+                    # update sweeplist appropriately, this is the trickiest bit:
+                    sweeplist[sortindices[collis.ravel()]] = sortedsweeplist[shuffcollis.ravel()]
+            sweeplists.append(sweeplist)
+
+        # concatenate the sweeplists of all shuffles, then make nruns copies of it if
+        # shuffleRuns==0 (ncopies is nruns), does nothing if shuffleRuns==1 (ncopies is 1):
+        sweeplist = np.tile(np.concatenate(sweeplists), ncopies)
 
         nuniquesweeps = nsweeps
         nsweeps = len(sweeplist) # now nsweeps includes repeats (if any)
@@ -508,19 +521,24 @@ class BaseExperiment(object):
                 nsweeps += addsweeps
                 addedsweeps += addsweeps
                 addsweeps = nsweeps // blankSweep[0] - addedsweeps
-            stimOn = [1]*nsweeps # init stimOn to all 1s (stim is on for all sweeps)
-            for sweepi in xrange(nsweeps):
-                if (sweepi+1) % blankSweep[0] == 0: # if 1 based sweepi is multiple of blankSweep[0]
-                    stimOn[sweepi] = 0 # stimulus will be off on sweepi
+            stimOn = np.ones(nsweeps, dtype=bool) # init stimOn to stimulus on for all sweeps
+            # stimulus is off on every 1 based sweepi that's a multiple of blankSweep[0]:
+            stimOn[blankSweep[0]-1::blankSweep[0]] = False
             if shuffleBlankSweeps == 1:
-                stimOn = core.shuffle(stimOn) # shuffle the stimulus state list
-            #print 'stimOn is', stimOn
-            # insert blank sweeps into sweeplist, according to stimulus state list
-            for sweepi in xrange(nsweeps): # for all sweeps (values) in stimulus table
-                if stimOn[sweepi] == 0: # if we're on a blank sweep
-                    insertioni = min(sweepi, len(sweeplist)-1) # insert at the lesser of sweepi or what's currently the last index in sweeplist. This prevents the case where many of the zeros in a shuffled stimOn are clustered at the end, and you end up trying to insert a repeat at an index value that's out of range of sweeplist
-                    sweeplist.insert(insertioni, None) # insert a 'None' value into sweeplist at insertioni, this indicates a blank sweep
-        #print 'sweeplist is', sweeplist
+                # shuffle the stimulus state list:
+                stimOn = np.asarray(core.shuffle(stimOn.tolist()))
+            # any blank sweeps after the last stimulus sweep end up just before it instead,
+            # so that sweeplist always ends with a stimulus sweep:
+            if stimOn.any():
+                lasti = np.where(stimOn)[0][-1]
+                stimOn[lasti] = False
+                stimOn[-1] = True
+            # insert blank sweeps into sweeplist, according to stimulus state list. A None
+            # value indicates a blank sweep:
+            withblanks = np.empty(nsweeps, dtype=object)
+            withblanks[stimOn] = sweeplist
+            sweeplist = withblanks
+        sweeplist = sweeplist.tolist()
 
         # Print sweeptable as formatted text to string
         if makeSweepTableText:
@@ -620,6 +638,19 @@ class ExperimentRate(BaseExperiment):
     ratepdf.__doc__ += '\nNeuron.rate: '+getargstr(neuron.Neuron.rate)
     ratepdf.__doc__ += neuron.Neuron._rateargs
 
+    def trialspikes(self, nids=None, tdelay=0, tres=None):
+        """Returns a calculated TrialSpikes object with one trial per block of identical
+        din values, excluding NULLDIN, ordered by sweep index, then by time. Trials are
+        shifted by tdelay (us), and their sweep indices are stored as .sweepis"""
+        NULLDIN = get_ipython().user_ns['NULLDIN']
+        dinindex = self.dinindex
+        tranges = dinindex.tranges(tdelay=tdelay)
+        sweepis = dinindex.sweepis[dinindex.blockis]
+        keep = sweepis != NULLDIN
+        ts = self.r.trialspikes(nids=nids, tranges=tranges[keep], tres=tres)
+        ts.sweepis = sweepis[keep]
+        return ts
+
 
 class RevCorrs(object):
     """Base class for doing reverse correlation of multiple neurons to a simulus"""
@@ -636,14 +667,15 @@ class RevCorrs(object):
                     for ti in self.tis ] # revcorr timepoint values, in ms
 
     def plot(self, interp='nearest', normed=True, title='RevCorrWindow', scale=2.0):
-        """Plots the RFs as bitmaps in a window. normed = 'global'|True|False"""
+        """Plots the RFs of all RevCorr objects in self.rcs as bitmaps in a window.
+        normed = 'global'|True|False"""
         rfs = [] # list of receptive fields to pass to ReceptiveFieldFrame object
         if normed == 'global': # normalize across all timepoints for all neurons
-            vmin = min([ sta.rf.min() for sta in self.stas ]) # global min
-            vmax = max([ sta.rf.max() for sta in self.stas ]) # global max
-        for ni, sta in enumerate(self.stas):
+            vmin = min([ rc.rf.min() for rc in self.rcs ]) # global min
+            vmax = max([ rc.rf.max() for rc in self.rcs ]) # global max
+        for ni, rc in enumerate(self.rcs):
             # create a copy to manipulate for display purposes, (nt, width, height):
-            rf = sta.rf.copy()
+            rf = rc.rf.copy()
             if normed: # either 'global' or True
                 if normed == True: # normalize across the timepoints for this Neuron
                     vmin, vmax = rf.min(), rf.max()
@@ -663,12 +695,30 @@ class RevCorrs(object):
 
 class STAs(RevCorrs):
     """Just a container class for multiple Neuron.STA objects. The plot() method is unique
-    though: it plots all the Neuron.STA objects in a single window"""
+    though: it plots all the Neuron.STA objects in a single window. Shuffle args are passed
+    on to each Neuron.STA"""
+    def __init__(self, neurons=None, experiment=None, trange=None, nt=10, nshuffles=0,
+                 shuffle='circular', jitter=50000, seed=0, nprocs=1):
+        RevCorrs.__init__(self, neurons=neurons, experiment=experiment, trange=trange,
+                          nt=nt)
+        self.shuffleargs = dict(nshuffles=nshuffles, shuffle=shuffle, jitter=jitter,
+                                seed=seed, nprocs=nprocs)
+
     def calc(self):
         self.stas = [] # store STAs in a list
+        pending = [] # STAs that neurons haven't already calculated
         for neuron in self.neurons:
-            stao = neuron.sta(experiment=self.experiment, trange=self.trange, nt=self.nt)
+            stao = neuron.sta(experiment=self.experiment, trange=self.trange, nt=self.nt,
+                              calc=False, **self.shuffleargs)
             self.stas.append(stao)
+            if not stao.done:
+                pending.append(stao)
+        # calculate all pending STAs together, much faster than one at a time:
+        calc_stas(pending)
+        for stao in pending:
+            stao.neuron._stas[stao.key] = stao
+            stao.savecache()
+        self.rcs = self.stas # for RevCorrs.plot()
 
     def plot(self, interp='nearest', normed=True, scale=2.0):
         win = RevCorrs.plot(self, interp=interp, normed=normed,
@@ -685,11 +735,12 @@ class STCs(RevCorrs):
         for neuron in self.neurons:
             stco = neuron.stc(experiment=self.experiment, trange=self.trange, nt=self.nt)
             self.stcs.append(stco)
+        self.rcs = self.stcs # for RevCorrs.plot()
 
     def plot(self, interp='nearest', normed=True, scale=2.0):
-        super(STCs, self).plot(interp=interp, normed=normed,
-                               title=lastcmd(),
-                               scale=scale)
+        win = RevCorrs.plot(self, interp=interp, normed=normed,
+                            title=lastcmd(), scale=scale)
+        return win # necessary in IPython
     plot.__doc__ = RevCorrs.plot.__doc__
 
 
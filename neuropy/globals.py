@@ -8,9 +8,27 @@ import os
 
 DATAPATH = os.path.expanduser('~/data')
 MOVIEPATH = os.path.expanduser('~/data/mov')
+# folder to cache parsed and calculated results in, such as stimulus textheaders. Set to
+# None to disable caching:
+CACHEPATH = os.path.expanduser('~/.neuropy/cache')
 
 # for each recording, load all Sorts, or just the most recent one?
 LOADALLSORTS = False
+# memory-map spikes and template waveforms in .ptcs files, reading them from disk only on
+# first access, instead of reading them all in at load time?
+LAZYPTCS = False
+# memory-map only the template waveforms in .ptcs files, reading them from disk only on
+# first access, but read in all spikes at load time? Ignored if LAZYPTCS is set:
+LAZYWAVES = False
+# when lazy loading, write a .ptcs.idx index file next to each .ptcs file, so that later
+# lazy loads can skip scanning through the .ptcs file for the offsets of each neuron record?
+PTCSINDEX = True
+# load each recording from the .cache file in its folder, if it has an up to date one? See
+# Recording.save_cache():
+RECORDINGCACHE = True
+# number of threads to load a track's recordings with in parallel, and likewise the .spk
+# files in a .sort folder. 1 loads them serially, None uses one thread per CPU core:
+NLOADTHREADS = 1
 
 """Mean spike rate that delineates normal vs "quiet" neurons. 0.1 Hz seems reasonable if you
 plot mean spike rate distributions for all the neurons in a given track. But, if you want a
@@ -33,6 +51,14 @@ CODEVALS = [0, 1]
 CODETRES = 20000 # us
 CODEPHASE = 0 # deg
 CODEWORDLEN = 10 # in bits
+# how Codes objects store their 2D code array: 'dense' stores one int8 per neuron per bin,
+# 'packed' stores one bit per neuron per bin in uint64 words, which needs 8x less memory,
+# 'sparse' stores the sorted indices of each neuron's high bins, which needs memory
+# proportional to the number of spikes instead. 'packed' and 'sparse' require CODEVALS = [0, 1]
+CODEFORMAT = 'dense'
+# constrain network state codes to when stimuli are on the screen during their experiments,
+# excluding NULLDIN periods?
+CODESTIMON = False
 
 """LFP synchrony index time range windows"""
 SIWIDTH = 32.768 # sec (2**15 ms)
@@ -6,6 +6,8 @@ import os
 import StringIO
 import time
 import hashlib
+import multiprocessing
+from collections import OrderedDict
 
 import numpy as np
 import pyximport
@@ -18,9 +20,9 @@ from pylab import get_current_fig_manager as gcfm
 
 import core
 from core import rstrip, getargstr, iterable, toiter, tolist, intround
-from core import mean_accum, lastcmd, RevCorrWindow
+from core import mean_accum, framesums, lastcmd, RevCorrWindow, packcode
 from core import PTCSNeuronRecord, SPKNeuronRecord
-from dimstimskeletal import Movie
+from dimstimskeletal import Movie, memmapmovie
 
 
 class BaseNeuron(object):
@@ -74,12 +76,20 @@ class BaseNeuron(object):
             self.loadspk()
     '''
     def loadptcs(self, f, header):
-        """Read in the next neuron record in an open .ptcs file"""
+        """Read in the next neuron record from a buffered .ptcs file"""
         nrec = PTCSNeuronRecord(header)
         nrec.read(f)
         self.record = nrec
         self.post_load()
 
+    def loadptcsindex(self, f, header, index, i):
+        """Build the neuron record from entry i in a .ptcs index, without parsing it from
+        the buffered .ptcs file"""
+        nrec = PTCSNeuronRecord(header)
+        nrec.read_index(f, index, i)
+        self.record = nrec
+        self.post_load()
+
     def loadspk(self):
         """Read in a .spk file containing purely spike times"""
         nrec = SPKNeuronRecord(self.path)
@@ -90,7 +100,10 @@ class BaseNeuron(object):
     def post_load(self):
         if self.nspikes == 0:
             raise RuntimeError('neuron %d in %s has no spikes' % (self.id, self.path))
-        self.trange = self.spikes[0], self.spikes[-1]
+        try: # records built from a .ptcs index know their trange without any spikes
+            self.trange = self.record.t0, self.record.t1
+        except AttributeError:
+            self.trange = self.spikes[0], self.spikes[-1]
         self.dt = self.trange[1] - self.trange[0]
         self.dtsec = self.dt / 1e6
         self.dtmin = self.dtsec / 60
@@ -237,14 +250,56 @@ class NeuronXCorr(object):
         return xco
 
 
+MAXCODEBINS = 8 # max number of sets of code bin times to keep in _CODEBINS
+# most recently used code bin times, indexed by tranges, tres and phase:
+_CODEBINS = OrderedDict()
+
+
+def clear_codebins():
+    """Clear cache of code bin times. Bin times still in use by codes aren't freed until
+    those codes are"""
+    _CODEBINS.clear()
+
+def codebins(tranges, tres, phase):
+    """Return left bin edges in us of binary codes over tranges with time resolution tres
+    and phase, and the index of the first bin of each trange, with the total number of bins
+    appended. These are shared by all codes with the same tranges, tres and phase, instead of
+    each one holding its own copy. Only the MAXCODEBINS most recently used are cached"""
+    key = (tuple([ tuple(trange) for trange in tranges ]), tres, phase)
+    try:
+        _CODEBINS[key] = _CODEBINS.pop(key) # move to most recently used end
+        return _CODEBINS[key]
+    except KeyError:
+        pass
+    ts = []
+    for trange in tranges:
+        # make the start of the timepoints be an even multiple of tres. Round down to the
+        # nearest multiple. This way, timepoints will line up for different code objects
+        # left edge of first code bin:
+        tstart = trange[0] - (trange[0] % tres)
+        if phase: # add phase offset relative to tstart
+            tstart += phase / 360.0 * tres
+        tstart = intround(tstart) # keep it int
+        tend = intround(trange[1]) # ditto
+        # t sequence demarcates left bin edges, add extra tres to end to make t end
+        # inclusive, keep 'em in us integers:
+        ts.append(np.arange(tstart, tend+tres, tres)) # should come out as int64
+    t = np.hstack(ts)
+    offsets = np.cumsum([0] + map(len, ts))
+    _CODEBINS[key] = t, offsets
+    while len(_CODEBINS) > MAXCODEBINS:
+        _CODEBINS.popitem(last=False) # drop least recently used
+    return t, offsets
+
+
 class BinaryCode(object):
     """Quantize a spike train, cut according to tranges in us, shifted by shift ms,
     into a binary signal with values CODEVALS and time resolution CODETRES in us.
     CODEPHASE specifies where to start the codetrain in time, relative to the nearest
     multiple of CODETRES before each trange. Phase is in degrees of a single bin period. -ve
     phase is leading (codetrain starts earlier in time), +ve is lagging (codetrain starts
-    later in time)"""
-    def __init__(self, spikes=None, tranges=None, shift=0):
+    later in time). format is 'dense', 'packed' or 'sparse', see CODEFORMAT"""
+    def __init__(self, spikes=None, tranges=None, shift=0, format='dense'):
         uns = get_ipython().user_ns
         self.kind = 'binary'
         self.spikes = spikes
@@ -252,6 +307,7 @@ class BinaryCode(object):
             tranges = [ self.neuron.trange ] # just the one full trange
         self.tranges = tranges
         self.shift = shift
+        self.format = format
         self.codevals = uns['CODEVALS']
         self.tres = uns['CODETRES']
         self.phase = uns['CODEPHASE']
@@ -259,7 +315,7 @@ class BinaryCode(object):
     def get_hash(self):
         """Return characteristic hash of everything that affects calc output"""
         h = hashlib.md5()
-        for thing in [self.kind, self.spikes, self.tranges, self.shift,
+        for thing in [self.kind, self.spikes, self.tranges, self.shift, self.format,
                       self.codevals, self.tres, self.phase]:
             if type(thing) in [int, list]:
                 thing = np.asarray(thing) # ints and lists can't be hashed
@@ -269,45 +325,41 @@ class BinaryCode(object):
     hash = property(get_hash)
 
     def calc(self):
-        """.t and .s attribs are commented out to save substantial memory"""
-        self.t = [] # bin times
+        """.s attrib is commented out to save substantial memory"""
         #self.s = [] # relevant spike times, potentially shifted by self.shift
-        self.c = [] # code values for each bin
         shift = intround(self.shift * 1000) # convert self.shift in ms to int us
-        for trange in self.tranges:
-            # make the start of the timepoints be an even multiple of self.tres. Round down
-            # to the nearest multiple. This way, timepoints will line up for different code
-            # objects
-            # left edge of first code bin:
-            tstart = trange[0] - (trange[0] % self.tres)
-            if self.phase: # add phase offset relative to tstart
-                tstart += self.phase / 360.0 * self.tres
-            tstart = intround(tstart) # keep it int
-            tend = intround(trange[1]) # ditto
-            # t sequence demarcates left bin edges, add extra tres to end to make t end
-            # inclusive, keep 'em in us integers:
-            t = np.arange(tstart, tend+self.tres, self.tres) # should come out as int64
+        # bin times, shared with all other codes with the same tranges:
+        self.t, offsets = codebins(self.tranges, self.tres, self.phase)
+        self.nbins = len(self.t)
+        highis = [] # indices of bins with at least 1 spike in them
+        for trangei, trange in enumerate(self.tranges):
+            t = self.t[offsets[trangei]:offsets[trangei+1]] # bin times of this trange
             # get relevant spike times s, cut over originally specified trange, not from
             # start to end of newly generated code bin timepoints:
             lo, hi = self.spikes.searchsorted(trange)
             s = self.spikes[lo:hi] + shift
-            c = np.empty(len(t), dtype=np.int8) # init binary code array
-            c[:] = self.codevals[0] # init code to low value
             # searchsorted returns indices where s fits into t. Sometimes more than one
             # spike will fit into the same time bin, which means searchsorted will return
-            # multiple occurences of the same index. You can set c at these indices to 1 a
-            # multiple number of times, or more efficiently, do an np.unique on it to
-            # only set each index to 1 once.
-            # dec index by 1 so that you get indices that point to the most recent bin edge.
-            # For each bin that has at least 1 spike in it, set its value to high:
-            c[np.unique(t.searchsorted(s)) - 1] = self.codevals[1]
-            self.t.append(t)
+            # multiple occurences of the same index. Do an np.unique on it to only keep
+            # each index once. dec index by 1 so that you get indices that point to the
+            # most recent bin edge. An index of -1 refers to the last bin of this trange:
+            i = np.unique(t.searchsorted(s)) - 1
+            highis.append(np.unique(i % len(t)) + offsets[trangei])
             #self.s.append(s)
-            self.c.append(c)
         # horizontally concatenate results from each trange:
-        self.t = np.hstack(self.t)
+        highis = np.hstack(highis)
         #self.s = np.hstack(self.s)
-        self.c = np.hstack(self.c)
+        if self.format == 'sparse':
+            self.i = highis
+            del self.spikes
+            return
+        c = np.empty(self.nbins, dtype=np.int8) # init binary code array
+        c[:] = self.codevals[0] # init code to low value
+        c[highis] = self.codevals[1] # for each bin with at least 1 spike, set it to high
+        if self.format == 'packed':
+            self.p = packcode(c)
+        else:
+            self.c = c
         del self.spikes # no need for spikes any more, save memory
 
     def plot(self):
@@ -317,7 +369,7 @@ class BinaryCode(object):
 
 class NeuronCode(object):
     """Mix-in class that defines the spike code related Neuron methods"""
-    def code(self, tranges=None, shift=0):
+    def code(self, tranges=None, shift=0, format='dense'):
         """Returns an existing Code object, or creates and calcs a new one if necessary"""
         try:
             self._codes
@@ -325,7 +377,7 @@ class NeuronCode(object):
             self._codes = {} # create a dict that'll hold Code objects for this Neuron
         kind = get_ipython().user_ns['CODEKIND']
         if kind == 'binary': # init a new BinaryCode object
-            co = BinaryCode(self.spikes, tranges, shift)
+            co = BinaryCode(self.spikes, tranges, shift, format)
             co_hash = co.hash
         else:
             raise ValueError('Unknown kind: %r' % kind)
@@ -642,8 +694,14 @@ class NeuronRate(object):
     ratepdf.__doc__ += _rateargs
 
 
+# bump whenever what's cached from calculating a RevCorr changes:
+REVCORRCACHEVERSION = 1
+
+
 class RevCorr(object):
     """Base class for doing reverse correlation of spikes to stimulus"""
+    PARAMS = [] # names of subclass specific attribs that affect calc() output
+    CACHEATTRS = ['rf'] # names of attribs that calc() generates, to save to disk cache
     def __init__(self, neuron=None, experiment=None, trange=None, nt=10):
         self.neuron = neuron
         self.experiment = experiment
@@ -657,7 +715,7 @@ class RevCorr(object):
             self.movie.frames # check if movie frames have been loaded from file
         except AttributeError:
             # Load as 3D array instead of as a list of 2D arrays, more convenient for
-            # analysis, although will cause memory problems for really big (>1GB movies).
+            # analysis. The array is memory-mapped, so even really big movies are fine.
             # Don't flip the movie frames vertically for OpenGL's bottom left origin, since
             # we aren't using OpenGL for analysis:
             self.movie.load(asarray=True, flip=False)
@@ -680,7 +738,8 @@ class RevCorr(object):
         # delete their rcdini and rf attribs, if they exist, to prevent comparing them below,
         # since those attribs may not have yet been calculated:
         [ d.__delitem__(key) for d in [selfd, otherd]
-            for key in ['rcdini', 'rf', 'done'] if d.has_key(key) ]
+            for key in ['rcdini', 'rf', 'done', 'mean', 'eigvals', 'eigvecs', 'nullmean',
+                        'nullstd', 'zrf', '_key', '_fingerprinted'] if d.has_key(key) ]
         if type(self) == type(other) and selfd == otherd:
             return True
         else:
@@ -694,6 +753,69 @@ class RevCorr(object):
         self.rcdini = self.experiment.din[:, 0].searchsorted(spikes) - 1
         #self.din = self.experiment.din[rcdini, 1] # get the din (frame indices) at the rcdini
 
+    def get_key(self):
+        """Return key that identifies self's calc() output, for both the in-memory and disk
+        caches. Depends on the source files of the neuron's recording"""
+        try:
+            return self._key
+        except AttributeError:
+            pass
+        r = self.experiment.r
+        sources = getattr(r, 'sources', None) # fingerprint of recording's source files
+        self._fingerprinted = sources != None
+        self._key = core.cachekey(REVCORRCACHEVERSION, type(self).__name__, r.path, sources,
+                                  self.neuron.sort.name, self.neuron.id, self.experiment.id,
+                                  [ int(t) for t in self.trange ], self.nt,
+                                  self.movie.static.fname,
+                                  [ getattr(self, name) for name in self.PARAMS ])
+        return self._key
+
+    key = property(get_key)
+
+    def loadcache(self):
+        """Load calc() output from disk cache, if there's an entry for self. Return whether
+        there was"""
+        if not (self.key and self._fingerprinted):
+            return False
+        d = core.loadcache('revcorr', self.key)
+        if d == None:
+            return False
+        self.__dict__.update(d)
+        self.done = True
+        return True
+
+    def savecache(self):
+        """Save calc() output to disk cache"""
+        if not (self.key and self._fingerprinted):
+            return False
+        d = dict([ (name, self.__dict__[name]) for name in self.CACHEATTRS
+                   if name in self.__dict__ ])
+        return core.savecache('revcorr', self.key, d)
+
+    def frameis(self, ti):
+        """Return the din values (frame indices) of all spikes at timepoint ti. Requires
+        calc() to have been run"""
+        # this can unintentionally introduce -ve valued indices at the left boundary:
+        rcdini = self.rcdini - ti*self.ndinperframe
+        rcdini = rcdini[rcdini >= 0] # remove any -ve valued indices
+        # get the din values (frame indices) at the rcdini for this timepoint:
+        return self.cleanframeis(self.experiment.din[rcdini, 1])
+
+    def cleanframeis(self, frameis):
+        """Remove erroneous mseq frame indices from frameis.
+
+        In ptc15, we erroneously duplicated the first frame of the mseq movies at the
+        end, giving us one more frame (0 to 65535 for mseq32) than we should have had (0
+        to 65534 for mseq32). We're now using the correct movies, but the din for Cat 15
+        mseq experiments still have those erroneous frame indices (65535 and 16383 for
+        mseq32 and mseq16 respectively), so we'll just ignore them for revcorr purposes.
+        """
+        if 'mseq32' in self.movie.static.fname.lower():
+            frameis = frameis[frameis != 65535] # remove all occurences of 65535
+        elif 'mseq16' in self.movie.static.fname.lower():
+            frameis = frameis[frameis != 16383] # remove all occurences of 16383
+        return frameis
+
     def plot(self, interp='nearest', normed=True, title='RevCorrWindow', scale=2.0):
         """Plots the spatiotemporal RF as bitmaps in a wx.Frame"""
         # create a copy to manipulate for display purposes, (nt, width, height):
@@ -760,45 +882,62 @@ class RevCorr(object):
     '''
 
 class STA(RevCorr):
-    """Spike-triggered average revcorr object"""
+    """Spike-triggered average revcorr object. If nshuffles, also find the null
+    distribution of the STA from that many shuffled spike trains, either circularly shifted
+    by a random amount within trange ('circular'), or each spike jittered uniformly by up to
+    +/- jitter us ('jitter'). Shuffles are run in nprocs processes, with each shuffle seeded
+    by its index and seed, so results don't depend on nprocs. zrf is then the STA as z-scores
+    relative to the null distribution"""
+    PARAMS = ['nshuffles', 'shuffle', 'jitter', 'seed']
+    CACHEATTRS = ['rf', 'nullmean', 'nullstd', 'zrf']
+
+    def __init__(self, neuron=None, experiment=None, trange=None, nt=10, nshuffles=0,
+                 shuffle='circular', jitter=50000, seed=0, nprocs=1):
+        RevCorr.__init__(self, neuron=neuron, experiment=experiment, trange=trange, nt=nt)
+        if shuffle not in ['circular', 'jitter']:
+            raise ValueError('Unknown shuffle: %r' % shuffle)
+        self.nshuffles = nshuffles
+        self.shuffle = shuffle
+        self.jitter = jitter
+        self.seed = seed
+        self.nprocs = nprocs
+
     def calc(self):
-        RevCorr.calc(self) # run the base calc() steps first
-        #sys.stdout.write('n%d' % self.neuron.id) # prevents trailing space and newline
-        # init a 3D matrix to store the STA at each timepoint. rf == 'receptive field'
-        self.rf = np.zeros([self.nt, self.height, self.width], dtype=np.float64)
-        # converting from uint8 to float64 seems to speed up mean() method a bit:
-        #frames = np.float64(self.movie.frames)
-        frames = self.movie.frames
-        tstart = time.clock()
-        for ti in self.tis:
-            # this can unintentionally introduce -ve valued indices at the left boundary:
-            rcdini = self.rcdini - ti*self.ndinperframe
-            rcdini = rcdini[rcdini >= 0] # remove any -ve valued indices
-            # get the din values (frame indices) at the rcdini for this timepoint:
-            frameis = self.experiment.din[rcdini, 1]
-            """
-            In ptc15, we erroneously duplicated the first frame of the mseq movies at the
-            end, giving us one more frame (0 to 65535 for mseq32) than we should have had (0
-            to 65534 for mseq32). We're now using the correct movies, but the din for Cat 15
-            mseq experiments still have those erroneous frame indices (65535 and 16383 for
-            mseq32 and mseq16 respectively), so we'll just ignore them for revcorr purposes.
-            """
-            if 'mseq32' in self.movie.static.fname.lower():
-                frameis = frameis[frameis != 65535] # remove all occurences of 65535
-            elif 'mseq16' in self.movie.static.fname.lower():
-                frameis = frameis[frameis != 16383] # remove all occurences of 16383
-            # take the mean of all the frames at this timepoint:
-            # slowest way:
-            #self.rf[ti] = frames[frameis].mean(axis=0)
-            # faster way:
-            #self.rf[ti] = frames.mean(axis=0)
-            # much faster way:
-            # collect the relevant frames for this timepoint, take is much faster than
-            # direct indexing
-            pickedframes = frames.take(frameis, axis=0)
-            self.rf[ti] = mean_accum(pickedframes)
-            #self.rf[ti] = mean_accum2(frames, frameis)
-        self.done = True
+        calc_stas([self])
+
+    def calc_null(self):
+        """Calculate mean and std of the null distribution of the STA, and z-scored STA"""
+        spikes = self.neuron.cut(self.trange)
+        badframei = self.cleanframeis(np.array([65535, 16383]))
+        # frame indices that cleanframeis() removes, to ignore in shuffles too:
+        badframei = np.setdiff1d([65535, 16383], badframei)
+        # batches of at most 25 shuffles each:
+        shuffleis = np.arange(self.nshuffles)
+        batches = np.array_split(shuffleis, int(np.ceil(self.nshuffles / 25)))
+        args = [ (self.movie.fullfname, self.experiment.din, spikes, self.trange, self.tis,
+                  self.ndinperframe, badframei, self.shuffle, self.jitter, self.seed,
+                  batch) for batch in batches ]
+        if self.nprocs == 1:
+            results = (sta_shuffle_moments(arg) for arg in args)
+        else:
+            pool = multiprocessing.Pool(self.nprocs)
+            results = pool.imap(sta_shuffle_moments, args) # ordered, for reproducible sums
+        npix = self.height * self.width
+        s, ss = np.zeros((self.nt, npix)), np.zeros((self.nt, npix))
+        try:
+            for bs, bss in results:
+                s += bs
+                ss += bss
+        finally:
+            if self.nprocs != 1:
+                pool.close()
+                pool.join()
+        shape = self.nt, self.height, self.width
+        self.nullmean = (s / self.nshuffles).reshape(shape)
+        self.nullstd = np.sqrt(np.maximum(ss.reshape(shape) / self.nshuffles -
+                                          self.nullmean**2, 0))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            self.zrf = (self.rf - self.nullmean) / self.nullstd
 
     def plot(self, interp='nearest', normed=True, scale=2.0):
         win = RevCorr.plot(self, interp=interp, normed=normed, title=lastcmd(),
@@ -807,27 +946,154 @@ class STA(RevCorr):
     plot.__doc__ = RevCorr.plot.__doc__
 
 
+def sta_shuffle_moments(args):
+    """Return sums of STAs and of their squares over a batch of shuffled spike trains,
+    at each timepoint. Takes a single tuple of args, for multiprocessing.Pool.imap().
+    Each shuffle gets its own random number generator, seeded by (seed, shufflei)"""
+    (fullfname, din, spikes, trange, tis, ndinperframe, badframei, shuffle, jitter, seed,
+     shuffleis) = args
+    frames = memmapmovie(fullfname)[-1]
+    t0, t1 = trange
+    nt = len(tis)
+    frameis, rowis = [], []
+    for shufflii, shufflei in enumerate(shuffleis):
+        rng = np.random.RandomState([seed, shufflei])
+        if shuffle == 'circular':
+            offset = rng.randint(0, t1 - t0)
+            shuffled = t0 + (spikes - t0 + offset) % (t1 - t0)
+        else: # shuffle == 'jitter'
+            shuffled = spikes + intround(rng.uniform(-jitter, jitter, size=len(spikes)))
+        shuffled.sort()
+        rcdini = din[:, 0].searchsorted(shuffled) - 1
+        for tii, ti in enumerate(tis):
+            shiftedrcdini = rcdini - ti*ndinperframe
+            shiftedrcdini = shiftedrcdini[shiftedrcdini >= 0] # remove any -ve indices
+            fis = din[shiftedrcdini, 1]
+            fis = fis[~np.in1d(fis, badframei)]
+            frameis.append(fis)
+            rowis.append(np.tile(shufflii*nt + tii, len(fis)))
+    nrows = len(shuffleis) * nt
+    sums, nspikes = framesums(frames, np.hstack(rowis), np.hstack(frameis), nrows)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        rfs = sums / nspikes[:, None]
+    rfs = rfs.reshape(len(shuffleis), nt, -1)
+    return rfs.sum(axis=0), (rfs**2).sum(axis=0)
+
+
+def calc_stas(stas, chunksize=1024):
+    """Calculate many STAs of the same movie at once, from the counts of each frame at each
+    timepoint of each STA. See core.framesums()"""
+    if len(stas) == 0:
+        return
+    frames = stas[0].movie.frames
+    nframes, height, width = frames.shape
+    frameis, rowis = [], []
+    rowi = 0
+    for sta in stas:
+        assert sta.movie is stas[0].movie
+        RevCorr.calc(sta) # run the base calc() steps first
+        for ti in sta.tis:
+            fis = sta.frameis(ti)
+            frameis.append(fis)
+            rowis.append(np.tile(rowi, len(fis)))
+            rowi += 1
+    nrows = rowi # one row per timepoint per STA
+    sums, nspikes = framesums(frames, np.hstack(rowis), np.hstack(frameis), nrows,
+                              chunksize)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        rfs = sums / nspikes[:, None] # nan for no spikes
+    rowi = 0
+    for sta in stas:
+        # 3D matrix of the STA at each timepoint. rf == 'receptive field':
+        sta.rf = rfs[rowi:rowi+sta.nt].reshape(sta.nt, height, width)
+        rowi += sta.nt
+        if sta.nshuffles:
+            sta.calc_null()
+        sta.done = True
+
 class STC(RevCorr):
-    """Spike-triggered correlation revcorr object"""
+    """Spike-triggered covariance revcorr object. For each timepoint, the spike-triggered
+    covariance of the frames is found relative to the prior covariance of all frames shown
+    during trange, and eigendecomposed. The eigenvalues are sorted by decreasing magnitude,
+    and only the neig eigenvectors with the greatest magnitude eigenvalues are kept. rf holds
+    the first eigenvector at each timepoint"""
+    PARAMS = ['neig']
+    CACHEATTRS = ['rf', 'mean', 'eigvals', 'eigvecs']
+
+    def __init__(self, neuron=None, experiment=None, trange=None, nt=10, neig=4,
+                 chunksize=1024):
+        RevCorr.__init__(self, neuron=neuron, experiment=experiment, trange=trange, nt=nt)
+        self.neig = neig # number of eigenvectors to keep per timepoint
+        self.chunksize = chunksize # number of frames to process at a time
+
     def calc(self):
-        print 'INCOMPLETE'
-        super(STC, self).calc() # run the general calc() steps
+        RevCorr.calc(self) # run the base calc() steps first
+        din = self.experiment.din
+        # all frames shown during trange, for the prior:
+        i0, i1 = din[:, 0].searchsorted(self.trange)
+        priorframeis = self.cleanframeis(din[i0:i1, 1])
+        priormean, priorcov = self.calc_cov(priorframeis)
+        npix = self.height * self.width
+        self.mean = np.zeros((self.nt, npix)) # spike-triggered mean
+        self.eigvals = np.zeros((self.nt, npix))
+        self.eigvecs = np.zeros((self.nt, npix, self.neig))
+        for ti in self.tis:
+            mean, cov = self.calc_cov(self.frameis(ti))
+            if np.isnan(cov).any(): # no spikes at this timepoint
+                self.mean[ti] = self.eigvals[ti] = self.eigvecs[ti] = np.nan
+                continue
+            vals, vecs = np.linalg.eigh(cov - priorcov)
+            # sort by decreasing eigenvalue magnitude:
+            sortis = abs(vals).argsort()[::-1]
+            self.mean[ti] = mean
+            self.eigvals[ti] = vals[sortis]
+            self.eigvecs[ti] = vecs[:, sortis[:self.neig]]
+        self.rf = self.eigvecs[:, :, 0].reshape(self.nt, self.height, self.width)
+        self.done = True
 
-    def plot(self):
-        print 'INCOMPLETE'
-        vals = super(STC, self).plot()
-        return vals
+    def calc_cov(self, frameis):
+        """Return mean and covariance of the frames at frameis, streaming through the movie
+        in chunks, accumulating sums of x and xx^T weighted by how many times each frame
+        occurs in frameis. Both are nan if there are no frames"""
+        frames = self.movie.frames
+        nframes = len(frames)
+        npix = self.height * self.width
+        counts = np.bincount(frameis, minlength=nframes)[:nframes] # drop out of range
+        n = counts.sum()
+        sx = np.zeros(npix)
+        sxx = np.zeros((npix, npix))
+        for f0 in range(0, nframes, self.chunksize):
+            f1 = min(f0 + self.chunksize, nframes)
+            w = counts[f0:f1]
+            fis, = np.nonzero(w) # only frames that occur in frameis
+            if len(fis) == 0:
+                continue
+            x = np.float64(frames[f0:f1].take(fis, axis=0)).reshape(len(fis), npix)
+            wx = x * w[fis, None]
+            sx += wx.sum(axis=0)
+            sxx += np.dot(wx.T, x)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = sx / n # nan if n == 0
+            cov = sxx / n - np.outer(mean, mean)
+        return mean, cov
+
+    def plot(self, interp='nearest', normed=True, scale=2.0):
+        win = RevCorr.plot(self, interp=interp, normed=normed, title=lastcmd(),
+                           scale=scale)
+        return win # necessary in IPython
     plot.__doc__ = RevCorr.plot.__doc__
 
 
 class NeuronRevCorr(object):
     """Mix-in class that defines the reverse correlation related Neuron methods"""
-    def sta(self, experiment=None, **kwargs):
-        """Returns an existing STA RevCorr object, or creates a new one if necessary"""
+    def sta(self, experiment=None, calc=True, **kwargs):
+        """Returns an existing STA RevCorr object, from memory or from the disk cache, or
+        creates a new one if necessary. If not calc, a new one is returned without being
+        calculated or kept"""
         try:
             self._stas
         except AttributeError: # self._stas doesn't exist yet
-            self._stas = [] # create a list that'll hold STA objects
+            self._stas = {} # create a dict that'll hold STA objects, indexed by key
         if experiment == None: # no Experiment was passed, use the first experiment this Neuron was involved in
             experiment = self.sort.r.e[0]
         else:
@@ -836,26 +1102,32 @@ class NeuronRevCorr(object):
                 experiment = self.sort.r.e[experiment]
             # else: experiment is probably an Experiment object
         stao = STA(neuron=self, experiment=experiment, **kwargs) # init a new STA object
-        for sta in self._stas:
-            if stao == sta: # need to define special == method for RevCorr class
-                if sta.done:
-                    return sta # returns the first STA object whose attributes match what's desired, and whose calculation done flag is set. This saves on calc() time and avoids wasting memory with unnecessary sta objects
-                else:
-                    sta.calc() # re-run its calc()
-                    return sta
+        try:
+            sta = self._stas[stao.key]
+            if sta.done:
+                return sta # returns the STA object whose attributes match what's desired, and whose calculation done flag is set. This saves on calc() time and avoids wasting memory with unnecessary sta objects
+        except KeyError:
+            pass
+        if stao.loadcache(): # calculated in a previous session
+            self._stas[stao.key] = stao
+            return stao
+        if not calc:
+            return stao
         stao.calc() # no matching STA was found, calculate it
         if stao.done: # if calc() was allowed to go to completion
-            self._stas.append(stao) # add it to the STA object list
+            self._stas[stao.key] = stao # add it to the STA object dict
+            stao.savecache()
         return stao # return it, even if it isn't done
     sta.__doc__ += '\n\n**kwargs:\n'
     sta.__doc__ += getargstr(STA.__init__)
 
     def stc(self, experiment=None, **kwargs):
-        """Returns an existing STC RevCorr object, or creates a new one if necessary"""
+        """Returns an existing STC RevCorr object, from memory or from the disk cache, or
+        creates a new one if necessary"""
         try:
             self._stcs
         except AttributeError: # self._stcs doesn't exist yet
-            self._stcs = [] # create a list that'll hold STC objects
+            self._stcs = {} # create a dict that'll hold STC objects, indexed by key
         if experiment == None: # no Experiment was passed, use the first experiment this Neuron was involved in
             experiment = self.sort.r.e[0]
         else:
@@ -864,11 +1136,14 @@ class NeuronRevCorr(object):
             except KeyError: # experiment is probably an Experiment object
                 pass
         stco = STC(neuron=self, experiment=experiment, **kwargs) # init a new STC object
-        for stc in self._stcs:
-            if stco == stc: # need to define special == method for class STC
-                return stc # returns the first STC object whose attributes match what's desired. This saves on calc() time and avoids duplicates in self._stcs
-        stco.calc() # no matching STC was found, calculate it
-        self._stcs.append(stco) # add it to the STC object list
+        try:
+            return self._stcs[stco.key] # saves on calc() time and avoids duplicates
+        except KeyError:
+            pass
+        if not stco.loadcache(): # not calculated in a previous session
+            stco.calc() # no matching STC was found, calculate it
+            stco.savecache()
+        self._stcs[stco.key] = stco # add it to the STC object dict
         return stco
     stc.__doc__ += '\n\n**kwargs:\n'
     stc.__doc__ += getargstr(STC.__init__)
@@ -884,35 +1159,26 @@ class Tune(object):
     def calc(self, tdelay=None):
         """tdelay: time delay in us to use between stimulus and response"""
         spikes = self.neuron.spikes
-        din = self.experiment.din
-        ndin = len(din)
-        sweepis = np.unique(din[:, 1]) # all possible sweep indices
+        dinindex = self.experiment.dinindex
         if tdelay == None:
             if 'flash' in self.experiment.name: # flashgrating or flashbar
                 tdelay = 40000 # akin to a revcorr timepoint for STA
             else:
                 tdelay = 0
         self.tdelay = tdelay
-        # find positions of each sweep index in the din, and generate array of tranges
-        # during which that stimulus condition was on
+        # get tranges of all blocks of consecutive identical sweep indices in the din,
+        # grouped by sweep index, during which that stimulus condition was on
+        tranges = dinindex.tranges(endinclusive=True, tdelay=tdelay)
+        # find which spike indices the start and end of each trange would fall
+        # between. Take difference between those two spike indices to get spike
+        # count for each trange
+        counts = np.diff(spikes.searchsorted(tranges), axis=1).flatten()
         self.tranges = {} # index into using sweepi
         self.counts = {} # index into using sweepi
-        for sweepi in sweepis:
-            dinis = np.where(din[:, 1] == sweepi)[0] # screen refresh indices
-            deltaiis = np.where(np.diff(dinis) != 1)[0] # look for non-consecutive values
-            startiis = np.insert(deltaiis+1, 0, 0) # prepend with 0
-            endiis = np.append(deltaiis, len(dinis)-1)
-            rangeiis = np.vstack([startiis, endiis]).T
-            rangeis = dinis[rangeiis]
-            rangeis[:, 1] += 1 # end inclusive
-            rangeis[-1, 1] = min(rangeis[-1, 1], ndin-1) # except for very end
-            tranges = din[rangeis, 0] + tdelay
-            self.tranges[sweepi] = tranges
-            # find which spike indices the start and end of each trange would fall
-            # between. Take difference between those two spike indices to get spike
-            # count for that trange. Repeat for all tranges for this sweepi to get
-            # array of spike counts, one for each trange.
-            self.counts[sweepi] = np.diff(spikes.searchsorted(tranges), axis=1).flatten()
+        for sweepi, lo, hi in zip(dinindex.usweepis, dinindex.offsets[:-1],
+                                  dinindex.offsets[1:]):
+            self.tranges[sweepi] = tranges[lo:hi]
+            self.counts[sweepi] = counts[lo:hi]
         self.done = True
         
     def plot(self, var='ori', fixed=None):
@@ -983,6 +1249,62 @@ class Tune(object):
         return self
 
 
+class Tunes(object):
+    """Stimulus tuning analysis of many neurons at many time delays between stimulus and
+    response. After calc(), counts is an nneurons x nsweepis x ntdelays array of total spike
+    counts during each stimulus condition, with conditions in sweepis order"""
+    def __init__(self, neurons=None, experiment=None, tdelays=None):
+        self.neurons = neurons
+        self.nids = [ neuron.id for neuron in neurons ]
+        self.experiment = experiment
+        if tdelays is None:
+            tdelays = np.arange(0, 200001, 10000) # 0 to 200 ms in 10 ms steps
+        self.tdelays = np.asarray(tdelays, dtype=np.int64)
+        self.done = False
+
+    def calc(self):
+        dinindex = self.experiment.dinindex
+        self.sweepis = dinindex.usweepis
+        # tranges of all blocks of the din, grouped by sweepi, same as in Tune.calc():
+        tranges = dinindex.tranges(endinclusive=True)
+        # total duration (us) of each condition:
+        self.durations = np.add.reduceat(tranges[:, 1] - tranges[:, 0],
+                                         dinindex.offsets[:-1])
+        # nblocks x ntdelays x 2 table of delayed tranges, shared by all neurons:
+        dtranges = tranges[:, None, :] + self.tdelays[None, :, None]
+        nn, nsweepis, ntdelays = len(self.neurons), len(self.sweepis), len(self.tdelays)
+        self.counts = np.zeros((nn, nsweepis, ntdelays), dtype=np.int64)
+        for nii, neuron in enumerate(self.neurons):
+            # spike counts of every block at every tdelay, in one searchsorted call:
+            counts = np.diff(neuron.spikes.searchsorted(dtranges), axis=2)[:, :, 0]
+            # sum over each condition's contiguous run of blocks:
+            self.counts[nii] = np.add.reduceat(counts, dinindex.offsets[:-1], axis=0)
+        self.done = True
+
+    def rates(self):
+        """Return nneurons x nsweepis x ntdelays array of mean firing rates (Hz) during
+        each stimulus condition"""
+        return self.counts / (self.durations[None, :, None] / 1e6)
+
+    def bestdelays(self):
+        """Return each neuron's best tdelay (us), the one with the greatest variance in
+        firing rate across stimulus conditions. Rates, unlike counts, don't depend on how
+        long each condition was shown. NULLDIN (blank) periods are excluded"""
+        NULLDIN = get_ipython().user_ns['NULLDIN']
+        stimis = self.sweepis != NULLDIN
+        return self.tdelays[self.rates()[:, stimis].var(axis=1).argmax(axis=1)]
+
+    def tune(self, nid, tdelay=None):
+        """Return a calculated single neuron Tune object, at tdelay, or at the neuron's best
+        tdelay if None"""
+        nii = self.nids.index(nid)
+        if tdelay == None:
+            tdelay = self.bestdelays()[nii]
+        tuneo = Tune(self.neurons[nii], self.experiment)
+        tuneo.calc(tdelay)
+        return tuneo
+
+
 class NeuronTune(object):
     """Mix-in class that defines stimulus tuning analysis method"""
     def tune(self, eid=0, tdelay=None):
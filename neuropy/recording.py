@@ -5,6 +5,7 @@ from __future__ import division
 import os
 import StringIO
 import random
+import multiprocessing
 
 import numpy as np
 import scipy.stats
@@ -20,10 +21,13 @@ import util # .pyx file
 import core
 from core import (LFP, SpatialPopulationRaster, DensePopulationRaster, Codes, SpikeCorr,
                   binarray2int, nCrsamples, iterable, entropy_no_sing, lastcmd, intround,
-                  tolist, rstrip, dictattr, warn, pmf, TAB)
+                  tolist, rstrip, dictattr, warn, pmf, TAB, RecordingCache, TrialSpikes,
+                  TrangeSet, framesums, toiter)
 from colour import CLUSTERCOLOURDICT
 from experiment import Experiment
 from sort import Sort
+from neuron import Tunes, REVCORRCACHEVERSION
+from dimstimskeletal import memmapmovie
 '''
 # Good global setting for presentation plots:
 pl.rcParams['axes.labelsize'] = 30
@@ -92,65 +96,79 @@ class BaseRecording(object):
         if self.tr != None:
             self.tr.writetree(string)
 
-    def load(self):
+    def load(self, cache=None):
+        """Load sorts, experiments and LFP of this recording. If cache, load them all from
+        an up to date RecordingCache file instead, if there is one. Defaults to
+        RECORDINGCACHE"""
         treestr = self.level*TAB + self.name + '/'
         # print string to tree hierarchy and screen
         self.writetree(treestr + '\n')
         print(treestr)
 
-        # Sorts from .ptcs files and .sort folders, and Experiments from .din files:
-        allfdnames = os.listdir(self.path) # all file and dir names in self.path
-        sortfdnames = []
-        dinfnames = []
-        lfpfnames = []
-        for fdname in allfdnames:
-            fullname = os.path.join(self.path, fdname)
-            if os.path.isfile(fullname):
-                if fdname.endswith('.ptcs'):
-                    sortfdnames.append(fdname)
-                elif fdname.endswith('.din'):
-                    dinfnames.append(fdname)
-                elif fdname.endswith('.lfp.zip'):
-                    lfpfnames.append(fdname)
-            elif os.path.isdir(fullname) and fdname.endswith('.sort'):
-                sortfdnames.append(fdname)
-        # sort filenames alphabetically, which should also be chronologically:
-        sortfdnames.sort()
-        dinfnames.sort()
-        lfpfnames.sort()
-
-        # load all Sorts, or just the most recent one:
         uns = get_ipython().user_ns
-        if not uns['LOADALLSORTS']:
-            sortfdnames = [sortfdnames[-1]] # just the most recent one
-        for sortid, fdname in enumerate(sortfdnames):
-            path = os.path.join(self.path, fdname)
-            sort = Sort(path, id=sortid, recording=self)
-            sort.load()
-            self.sorts[sort.name] = sort # save it
-            self.__setattr__('sort' + str(sort.id), sort) # add shortcut attrib
-        # make last sort the default one
-        self.sort = self.sorts[sortfdnames[-1]]
-
-        # load all .din as Experiments:
-        for expid, fname in enumerate(dinfnames): # expids follow order in dinfnames
-            path = os.path.join(self.path, fname)
-            experiment = Experiment(path, id=expid, recording=self)
-            experiment.load()
-            self.e[experiment.id] = experiment
-            self.__setattr__('e' + str(experiment.id), experiment) # add shortcut attrib
-
-        # load any LFP data from a .lfp.zip file:
-        nlfpfiles = len(lfpfnames)
-        if nlfpfiles == 0:
-            pass
-        elif nlfpfiles == 1:
-            fullname = os.path.join(self.path, lfpfnames[0])
-            self.lfp = LFP(self, fullname)
-            #self.lfp.load() # for speed, don't load LFP data automatically
+        if cache == None:
+            cache = uns['RECORDINGCACHE']
+        rc = RecordingCache(self.path)
+        # source files, as of just before loading them, for Track.reload():
+        self.sources = rc.sources()
+        if cache and rc.load() and rc.meta['loadallsorts'] == uns['LOADALLSORTS']:
+            self.loadcache(rc)
+            # RECNEURONPERIOD that the cached neuron mean rates were calculated with:
+            cachedperiod = rc.meta['recneuronperiod']
         else:
-            raise RuntimeError("%d .lfp.zip files in %s, don't know which one to load"
-                               % (nlfpfiles, self.path))
+            cachedperiod = None
+            # Sorts from .ptcs files and .sort folders, and Experiments from .din files:
+            allfdnames = os.listdir(self.path) # all file and dir names in self.path
+            sortfdnames = []
+            dinfnames = []
+            lfpfnames = []
+            for fdname in allfdnames:
+                fullname = os.path.join(self.path, fdname)
+                if os.path.isfile(fullname):
+                    if fdname.endswith('.ptcs'):
+                        sortfdnames.append(fdname)
+                    elif fdname.endswith('.din'):
+                        dinfnames.append(fdname)
+                    elif fdname.endswith('.lfp.zip'):
+                        lfpfnames.append(fdname)
+                elif os.path.isdir(fullname) and fdname.endswith('.sort'):
+                    sortfdnames.append(fdname)
+            # sort filenames alphabetically, which should also be chronologically:
+            sortfdnames.sort()
+            dinfnames.sort()
+            lfpfnames.sort()
+
+            # load all Sorts, or just the most recent one:
+            if not uns['LOADALLSORTS']:
+                sortfdnames = [sortfdnames[-1]] # just the most recent one
+            for sortid, fdname in enumerate(sortfdnames):
+                path = os.path.join(self.path, fdname)
+                sort = Sort(path, id=sortid, recording=self)
+                sort.load()
+                self.sorts[sort.name] = sort # save it
+                self.__setattr__('sort' + str(sort.id), sort) # add shortcut attrib
+            # make last sort the default one
+            self.sort = self.sorts[sortfdnames[-1]]
+
+            # load all .din as Experiments:
+            for expid, fname in enumerate(dinfnames): # expids follow order in dinfnames
+                path = os.path.join(self.path, fname)
+                experiment = Experiment(path, id=expid, recording=self)
+                experiment.load()
+                self.e[experiment.id] = experiment
+                self.__setattr__('e' + str(experiment.id), experiment) # add shortcut attrib
+
+            # load any LFP data from a .lfp.zip file:
+            nlfpfiles = len(lfpfnames)
+            if nlfpfiles == 0:
+                pass
+            elif nlfpfiles == 1:
+                fullname = os.path.join(self.path, lfpfnames[0])
+                self.lfp = LFP(self, fullname)
+                #self.lfp.load() # for speed, don't load LFP data automatically
+            else:
+                raise RuntimeError("%d .lfp.zip files in %s, don't know which one to load"
+                                   % (nlfpfiles, self.path))
 
         if len(self.e) > 0:
             eids = list(self.e)
@@ -169,7 +187,55 @@ class BaseRecording(object):
         self.dtmin = self.dtsec / 60
         self.dthour = self.dtmin / 60
 
-        self.calc_meanrates()
+        if cachedperiod != uns['RECNEURONPERIOD']:
+            self.calc_meanrates()
+
+    def loadcache(self, rc):
+        """Load sorts, experiments and LFP from a loaded RecordingCache"""
+        meta, arrays = rc.meta, rc.arrays
+        for sortmeta in meta['sorts']:
+            path = os.path.join(self.path, sortmeta['name'])
+            sort = Sort(path, id=sortmeta['id'], recording=self)
+            prefix = 'sort%d.' % sort.id
+            sortarrays = dict([ (name[len(prefix):], a) for name, a in arrays.items()
+                                if name.startswith(prefix) ])
+            sort.loadcache(sortmeta, sortarrays)
+            self.sorts[sort.name] = sort # save it
+            self.__setattr__('sort' + str(sort.id), sort) # add shortcut attrib
+        # make last sort the default one
+        self.sort = self.sorts[meta['sorts'][-1]['name']]
+        for expmeta in meta['experiments']:
+            path = os.path.join(self.path, expmeta['name'])
+            experiment = Experiment(path, id=expmeta['id'], recording=self)
+            din = arrays['e%d.din' % experiment.id]
+            experiment.load(din=din, textheader=expmeta['textheader'])
+            self.e[experiment.id] = experiment
+            self.__setattr__('e' + str(experiment.id), experiment) # add shortcut attrib
+        if meta['lfp'] != None:
+            self.lfp = LFP(self, os.path.join(self.path, meta['lfp']))
+
+    def save_cache(self):
+        """Save sorts, experiment din and textheaders and neuron mean rates to a single
+        flat .cache file in the recording's folder, which load() memory-maps instead of
+        parsing the source files. The cache is ignored once any source file changes"""
+        uns = get_ipython().user_ns
+        meta = {'loadallsorts': uns['LOADALLSORTS'],
+                'recneuronperiod': uns['RECNEURONPERIOD'],
+                'sorts': [], 'experiments': [], 'lfp': None}
+        arrays = []
+        for sort in sorted(self.sorts.values(), key=lambda sort: sort.id):
+            sortmeta, sortarrays = sort.tocache()
+            meta['sorts'].append(sortmeta)
+            prefix = 'sort%d.' % sort.id
+            arrays += [ (prefix+name, a) for name, a in sortarrays ]
+        for eid in sorted(self.e):
+            e = self.e[eid]
+            meta['experiments'].append({'name': e.name, 'id': e.id,
+                                        'textheader': e.rawtextheader})
+            arrays.append(('e%d.din' % e.id, e.din))
+        if hasattr(self, 'lfp'):
+            meta['lfp'] = os.path.split(self.lfp.fname)[-1]
+        RecordingCache(self.path).save(meta, arrays)
 
     def get_ordnids(self):
         """Return nids of active neurons in vertical spatial order, superficial to deep"""
@@ -211,10 +277,14 @@ class BaseRecording(object):
                     nidi += 1
         return np.sort(nids) # may as well sort them
 
-    def mua(self, width=None, tres=None, neurons=None, smooth=False, plot=True):
+    def mua(self, width=None, tres=None, neurons=None, smooth=False, plot=True,
+            tranges=None):
         """Calculate and optionally plot multiunit activity as a function of time. neurons can
         be None, 'quiet', 'all', or a dict. `width' and `tres' of time bins are in seconds. If
-        `smooth' is True, convolve with a smoothing window of width `width'"""
+        `smooth' is True, convolve with a smoothing window of width `width'. tranges, such as
+        a TrangeSet, restricts time bins to fall within them. Defaults to self.trange. When
+        smoothing, that's done over the whole recording, and then only the bins whose
+        midpoints fall within tranges are kept"""
         if neurons == None:
             neurons = self.n # use active neurons
         elif neurons == 'quiet':
@@ -255,15 +325,24 @@ class BaseRecording(object):
         midspikes.sort() # sorted spikes from middle neurons
         deepspikes.sort() # sorted spikes from deep neurons
 
+        keep = None # bools of which smoothed bins to keep
         if smooth:
             t0, t1 = self.trange
             # non-overlapping bin edges, including rightmost bin:
             edges = np.arange(t0, t1+tres, tres) # in us
             # get midpoint of each bin, convert from us to sec:
-            t = (edges[:-1] + tres/2) / 1000000
+            mids = edges[:-1] + tres/2
+            t = mids / 1000000
+            if tranges is not None:
+                if not isinstance(tranges, TrangeSet):
+                    tranges = TrangeSet(tranges)
+                keep = tranges.contains(mids)
+                t = t[keep]
+        elif tranges is None:
+            tranges = [self.trange]
         else:
             # potentially overlapping bin time ranges:
-            tranges = core.split_tranges([self.trange], width, tres) # in us
+            tranges = core.split_tranges(tranges, width, tres) # in us
             # get midpoint of each trange, convert from us to sec:
             t = tranges.mean(axis=1) / 1000000
 
@@ -273,6 +352,9 @@ class BaseRecording(object):
             suprates = self.calc_mua_smooth(supspikes, nsup, edges, width)
             midrates = self.calc_mua_smooth(midspikes, nmid, edges, width)
             deeprates = self.calc_mua_smooth(deepspikes, ndeep, edges, width)
+            if keep is not None:
+                allrates, suprates = allrates[keep], suprates[keep]
+                midrates, deeprates = midrates[keep], deeprates[keep]
         else:
             allrates = self.calc_mua(allspikes, nn, tranges)
             suprates = self.calc_mua(supspikes, nsup, tranges)
@@ -300,8 +382,8 @@ class BaseRecording(object):
         spikehist = np.histogram(spikes, bins=edges)[0]
         tres = edges[1] - edges[0] # bin width (us)
         tressec = tres / 1000000
-        nw = width / tres # window width, in number of bins
-        window = np.hanning(nw)[nw/2:] # half a hanning window, causal (convolve flips it)
+        nw = intround(width / tres) # window width, in number of bins
+        window = np.hanning(nw)[nw//2:] # half a hanning window, causal (convolve flips it)
         if nn == 0:
             nn = 1 # prevent div by 0, 0 neurons result in 0 rates anyway
         # normalize by bin width and window area and nn to get spikes/sec (Hz) per neuron:
@@ -655,6 +737,33 @@ class RecordingRaster(BaseRecording):
             return SpatialPopulationRaster(trange=trange, neurons=neurons, norder=norder,
                                            units=units, text=self.name)
 
+    def trialspikes(self, nids=None, tranges=None, events=None, pre=0, post=None,
+                    tres=None):
+        """Return a calculated TrialSpikes object of all spikes of neurons nids in trials
+        given either by tranges (us), or by event times (us) with pre and post windows (us)
+        on either side of each event, to which spike times are then aligned. tres (us), if
+        given, is the bin width for trial-aligned spike counts"""
+        if nids == None:
+            nids = sorted(self.n.keys()) # use active neurons
+        elif nids == 'quiet':
+            nids = sorted(self.qn.keys()) # use quiet neurons
+        elif nids == 'all':
+            nids = sorted(self.alln.keys()) # use all neurons
+        else:
+            nids = tolist(nids) # use specified neurons
+        t0s = None
+        if events is not None:
+            if tranges is not None:
+                raise ValueError("specify either tranges or events, not both")
+            if post == None:
+                raise ValueError("post window required for events")
+            t0s = np.asarray(events, dtype=np.int64)
+            tranges = np.column_stack((t0s - pre, t0s + post))
+        neurons = [ self.alln[nid] for nid in nids ]
+        ts = TrialSpikes(neurons=neurons, tranges=tranges, t0s=t0s, tres=tres)
+        ts.calc()
+        return ts
+
     def traster(self, nids=None, eid=0, t0=None, dt=None, blank=True, s=20,
                 figsize=(7.5, None)):
         """Create a trial spike raster plot for given neurons, based on stimulus info
@@ -698,18 +807,12 @@ class RecordingRaster(BaseRecording):
             tranges = np.column_stack((t0s, t1s))
         elif trialtype == 'dinrange':
             sw0, sw1 = usweepis[0], usweepis[-1] # first and last sweep index in each trial
-            i0s, = np.where(sweepis == sw0) # screen refresh indices for sw0
-            # indices into i0s of start of each trange, prepend i0s with a value (-2)
-            # guaranteed to be non-consecutive with the first value in i0s:
-            i0is, = np.where(np.diff(np.hstack(([-2], i0s))) != 1)
-            i0s = i0s[i0is]
+            dinindex = e.dinindex
+            i0s = dinindex.i0s[dinindex.blocks(sw0)] # first screen refresh of each sw0 block
             t0s = times[i0s]
             if not blank:
-                i1s, = np.where(sweepis == sw1) # screen refresh indices for sw1
-                # indices into i1s of end of each trange, append i1s with a value (-2)
-                # guaranteed to be non-consecutive with the last value in i1s:
-                i1is, = np.where(np.diff(np.hstack((i1s, [-2]))) != 1)
-                i1s = i1s[i1is]
+                # last screen refresh of each sw1 block:
+                i1s = dinindex.i1s[dinindex.blocks(sw1)]
             else: # include blank frames
                 # alternate method: only use sw0 to designate start and end of each trial,
                 # and therefore include any blank periods at the end of each trial as a
@@ -722,24 +825,13 @@ class RecordingRaster(BaseRecording):
             t1s = times[i1s]
             tranges = np.column_stack((t0s, t1s))
         elif trialtype == 'dinval':
-            t0s, t1s = [], []
-            for sweepi in usweepis: # ordered by sweepi
-                i, = np.where(sweepis == sweepi) # screen refresh indices
-                # indices into i of start of each trange, prepend i with a value (-2)
-                # guaranteed to be non-consecutive with the first value in i:
-                i0is, = np.where(np.diff(np.hstack(([-2], i))) != 1)
-                # indices into i of end of each trange, append i with a value (-2)
-                # guaranteed to be non-consecutive with the last value in i:
-                i1is, = np.where(np.diff(np.hstack((i, [-2]))) != 1)
-                i0s = i[i0is]
-                i1s = i[i1is]
-                t0s.append(times[i0s])
-                t1s.append(times[i1s])
-                # each sweepi's tranges could also be saved into a dict, indexed by sweepi,
-                # as in the tuning curve code
-            t0s = np.hstack(t0s)
-            t1s = np.hstack(t1s)
-            tranges = np.column_stack((t0s, t1s))
+            # one trial per block of consecutive identical sweep indices, ordered by
+            # sweepi, then by time:
+            dinindex = e.dinindex
+            tranges = dinindex.tranges()
+            sweepis = dinindex.sweepis[dinindex.blockis]
+            tranges = tranges[sweepis != NULLDIN]
+            t0s, t1s = tranges[:, 0], tranges[:, 1]
         dts = t1s - t0s
         maxdt = max(dts) # max trial duration
         # depth of nids from top of electrode
@@ -748,22 +840,13 @@ class RecordingRaster(BaseRecording):
         nn = len(nids)
         ntrials = len(tranges)
         figsize = figsize[0], 1 + ntrials / 36 # ~1/36th vertical inch per trial
+        ts = self.trialspikes(nids=nids, tranges=tranges)
         for nidi, nid in enumerate(nids):
-            spikes = self.alln[nid].spikes
-            trials = []
-            trialis = []
-            for triali, trange in enumerate(tranges):
-                si0, si1 = spikes.searchsorted(trange)
-                # slice out spikes that fall within trials, make them relative to start of
-                # each trial, convert from us to sec
-                ts = (spikes[si0:si1] - trange[0]) / 1e6
-                nspikes = len(ts)
-                if nspikes == 0:
-                    continue
-                trials.append(ts) # x values for this trial
-                trialis.append(np.tile(triali+1, nspikes)) # 1-based y values for this trial
-            trials = np.hstack(trials)
-            trialis = np.hstack(trialis)
+            # spike times relative to start of each trial, converted from us to sec, and
+            # 1-based y values for each trial:
+            trials, trialis = ts.raster(nid)
+            trials = trials / 1e6
+            trialis = trialis + 1
             if supis[nidi]: c = 'r'
             elif midis[nidi]: c = 'g'
             elif deepis[nidi]: c = 'b'
@@ -800,6 +883,22 @@ class RecordingRaster(BaseRecording):
             n = self.alln[nid]
             t = n.tune(eid=eid, tdelay=tdelay)
             t.plot(var=var, fixed=fixed)
+
+    def tunes(self, nids=None, eid=0, tdelays=None):
+        """Return a calculated Tunes object, with spike counts of the given neurons in
+        all stimulus conditions of experiment eid, at all tdelays (us)"""
+        if nids == None:
+            nids = sorted(self.n.keys()) # use active neurons
+        elif nids == 'quiet':
+            nids = sorted(self.qn.keys()) # use quiet neurons
+        elif nids == 'all':
+            nids = sorted(self.alln.keys()) # use all neurons
+        else:
+            nids = tolist(nids) # use specified neurons
+        neurons = [ self.alln[nid] for nid in nids ]
+        tuneso = Tunes(neurons=neurons, experiment=self.e[eid], tdelays=tdelays)
+        tuneso.calc()
+        return tuneso
         
 
 class RecordingCode(BaseRecording):
@@ -880,9 +979,18 @@ class BaseNetstate(object):
     def codes(self, nids=None, shufflecodes=False):
         """Returns the appropriate Codes object, depending on the recording
         and experiments defined for this Netstate object"""
-        ## TODO: codes are not currently constrained to when stimuli are on the screen,
-        ## although this shouldn't be a big deal most of the time...
-        return self.r.codes(nids=nids, experiments=self.e, shufflecodes=shufflecodes)
+        tranges = None
+        if get_ipython().user_ns['CODESTIMON']:
+            experiments = self.e
+            if experiments == None: # use all of the Recording's experiments
+                experiments = [ self.r.e[eid] for eid in sorted(self.r.e) ]
+            if len(experiments) > 0:
+                # constrain codes to when stimuli are on the screen:
+                tranges = TrangeSet()
+                for e in experiments:
+                    tranges |= e.stimon()
+        return self.r.codes(nids=nids, tranges=tranges, experiments=self.e,
+                            shufflecodes=shufflecodes)
 
     def get_wordts(self, nids=None, mids=None):
         """Returns word times, ie the times of the left bin edges for which all the
@@ -898,8 +1006,8 @@ class BaseNetstate(object):
         notmids = [ nid for nid in nids if nid not in mids ] # nids not in mids
         # take product down all rows, only synchronous events across all mids cells will
         # survive, boolean array:
-        mids_high = cs.c[nids2niis(mids)].prod(axis=0) == 1
-        notmids_low = cs.c[nids2niis(notmids)].sum(axis=0) == 0 # boolean array
+        mids_high = cs.rows(nids2niis(mids)).prod(axis=0) == 1
+        notmids_low = cs.rows(nids2niis(notmids)).sum(axis=0) == 0 # boolean array
         # indices where mids are 1 and all the others are 0:
         i = (mids_high * notmids_low).nonzero()[0]
         return cs.t[i] # return the times at those indices
@@ -917,7 +1025,7 @@ class BaseNetstate(object):
         if nids == None:
             # randomly sample CODEWORDLEN bits of the nids
             nids = random.sample(self.cs.nids, uns['CODEWORDLEN'])
-        return binarray2int(self.codes(nids=nids, shufflecodes=shufflecodes).c)
+        return self.codes(nids=nids, shufflecodes=shufflecodes).intcodes()
 
     def intcodesPDF(self, nids=None):
         """Returns the observed pdf across all possible population binary code words,
@@ -1709,8 +1817,8 @@ class NetstateNNplus1(BaseNetstate):
                     # push it through toiter()
                     niis = np.array([ nids2niis(s) for s in toiter(sample) ])
                     IdivS[ni, Nplus1i, samplei] = (
-                        MIbinarrays(Nbinarray=self.cs.c[niis],
-                                    Mbinarray=self.cs.c[mii]).IdivS) # do it
+                        MIbinarrays(Nbinarray=self.cs.rows(niis),
+                                    Mbinarray=self.cs.rows(mii)).IdivS) # do it
         # reshape such that you collapse all Nplus1s and samples into a single dimension
         # (columns). The N are still in the rows:
         self.IdivS = IdivS.reshape(maxN, nNplus1s*maxnsamples)
@@ -1815,8 +1923,8 @@ class NetstateCheckcells(BaseNetstate):
         nothers = len(othernids)
 
         # 0s and 1s, this picks out the row in the binary code array that corresponds to ni:
-        nicode = self.cs.c[nii]
-        othercodes = self.cs.c[otherniis]
+        nicode = self.cs.rows(nii)
+        othercodes = self.cs.rows(otherniis)
         if shufflecodes:
             nicode = np.asarray(shuffle(nicode))
             othercodes = np.asarray(shuffle(othercodes))
@@ -1938,108 +2046,143 @@ class NetstateTriggeredAverage(BaseNetstate):
     """Analysis that reverse correlates the occurence of a specific netstate
     to the stimuli in the Experiments in this Recording to build up a netstate
     triggered average"""
-    def cut(self, trange):
-        """Cuts network state word times according to trange"""
-        lo, hi = self.wordts.searchsorted([trange[0], trange[1]]) # returns indices where tstart and tend would fit in wordts
-        if trange[1] == self.wordts[min(hi, len(self.wordts)-1)]: # if tend matches a word time (protect from going out of index bounds when checking)
+    def cut(self, trange, wordts):
+        """Cuts network state word times wordts according to trange"""
+        lo, hi = wordts.searchsorted([trange[0], trange[1]]) # returns indices where tstart and tend would fit in wordts
+        if trange[1] == wordts[min(hi, len(wordts)-1)]: # if tend matches a word time (protect from going out of index bounds when checking)
             hi += 1 # inc to include a word time if it happens to exactly equal tend. This gives us end inclusion
-            hi = min(hi, len(self.wordts)) # limit hi to max slice index (==max value index + 1)
-        cutwordts = self.wordts[lo:hi] # slice it
+            hi = min(hi, len(wordts)) # limit hi to max slice index (==max value index + 1)
+        cutwordts = wordts[lo:hi] # slice it
         return cutwordts
 
-    def calc(self, intcode=None, nt=9, ti0=-4):
-        """Calculate the network state triggered average for word intcode, using nt revcorr timepoints,
-        starting at revcorr timepoint index ti0.
+    def calc(self, intcodes=None, nt=9, ti0=-4, nprocs=1, callback=None):
+        """Calculate the network state triggered average for each word in intcodes, using
+        nt revcorr timepoints, starting at revcorr timepoint index ti0. Experiments are
+        processed in nprocs processes in parallel. 1 processes them serially, None uses one
+        process per CPU core. callback, if any, is called as callback(ndone, ntotal) as each
+        experiment is done, to report progress.
 
         For now, this uses the Codes object created across the entire Recording
         """
-        self.intcode = intcode
+        self.intcodes = toiter(intcodes)
         self.nt = nt # number of revcorr timepoints
         self.ti0 = ti0
         self.tis = range(ti0, ti0+nt, 1) # revcorr timepoint indices, can be -ve. these will be multiplied by the movie frame time
-        words = binarray2int(self.cs.c)
-        i = (words == intcode)
-        assert i.any(), 'netstate intcode %d never occured'
-        self.wordts = self.cs.t[i] # netstate intcode word times
+        words = self.cs.intcodes()
+        self.wordts = [] # netstate word times, one array per intcode
+        for intcode in self.intcodes:
+            i = (words == intcode)
+            assert i.any(), 'netstate intcode %d never occured' % intcode
+            self.wordts.append(self.cs.t[i])
 
         if self.e == None:
-            self.e = self.r.e # if no specific experiments were specified to revcorr to in __init__, revcorr to all of them
-        self.frames = {} # accumulates movie frames separately for each timepoint across all Experiments' movies
-        for ti in self.tis:
-            self.frames[ti] = []
-        tstart = time.clock()
-        pd = wx.ProgressDialog(title='NSTA progress: loading movies, collecting frames', message='',
-                               maximum=len(self.e), style=1) # create a progress dialog
-        for ei, e in enumerate(self.e.values()):
-            cont, skip = pd.Update(ei-1, newmsg='experiment %d\nelapsed: %.1fs' % (e.id,
-                                   time.clock()-tstart))
-            if not cont:
-                pd.Destroy()
-                return
-            # for now, we're using the Codes object created across the entire Recording. It might be slightly more correct to generate a separate codes object for each Experiment. That way, the wordts for would be aligned to the start of each Experiment, as opposed to the start of the Recording, as they are now.
-            cutwordts = self.cut(e.trange) # get wordts that were active during this experiment. This isn't really necessary is it??????????????????????????? Might speed things up for the next searchsorted call, since cutwordts is shorter than wordts
-            rcdini = e.din[:, 0].searchsorted(cutwordts) - 1 # revcorr dini. Find where the cutwordts times fall in the din, dec so you get indices that point to the most recent din value for each cutwordt
-            #self.din = e.din[rcdini, 1] # get the din (frame indices) at the rcdini
-            # for now, only do revcorr if experiment.stims has only one entry. Stims no longer exists in dimstim >= 0.16 anyway
-            assert len(e.stims) == 1
-            movie = e.stims[0] # this will have to change for dimstim >= 0.16
-            movie.load() # ensure movie is loaded
-            data = movie.data
+            # if no specific experiments were specified to revcorr to in __init__, revcorr
+            # to all of them
+            self.e = [ self.r.e[eid] for eid in sorted(self.r.e) ]
+        # check disk cache, keyed on the codes themselves, since they depend on many
+        # BaseNetstate args:
+        sources = getattr(self.r, 'sources', None) # fingerprint of recording's source files
+        key = core.cachekey(REVCORRCACHEVERSION, 'NSTA', self.r.path, sources, self.cs.hash,
+                            [ e.id for e in self.e ], self.intcodes, nt, ti0,
+                            [ e.e.static.fname for e in self.e ])
+        if sources != None:
+            d = core.loadcache('revcorr', key)
+            if d != None:
+                self.__dict__.update(d)
+                self.rf = self.rfs[0]
+                return self
+        nrows = len(self.intcodes) * nt # one row per timepoint per intcode
+        args = []
+        for e in self.e:
+            movie = e.e
+            try:
+                movie.frames
+            except AttributeError:
+                movie.load(asarray=True, flip=False)
+            nframes, height, width = movie.frames.shape
+            sweepSec = movie.dynamic.sweepSec
             try:
                 self.width
             except AttributeError: # init stuff
-                self.width = movie.data.shape[-1]
-                self.height = movie.data.shape[-2] # dims are nframes, height, width
-                self.sweeptimeMsec = movie.sweeptimeMsec # changes in dimstim >= 0.16
-                self.ndinperframe = intround(movie.sweeptimeMsec / float(e.REFRESHTIME / 1000.)) # changes in dimstim >= 0.16
-                self.regionwidthDeg = movie.regionwidthDeg
-                self.regionheightDeg = movie.regionheightDeg
-                self.origDeg = e.origDeg
-            # assert that all movies are the same size and in the same spot. that way you can just accumulate frames in a single array
-            assert self.width == movie.data.shape[-1] # dims are nframes, height, width
-            assert self.height == movie.data.shape[-2]
-            assert self.sweeptimeMsec == movie.sweeptimeMsec # changes in dimstim >= 0.16
-            assert self.regionwidthDeg == movie.regionwidthDeg
-            assert self.regionheightDeg == movie.regionheightDeg
-            assert self.origDeg == e.origDeg
-            for ti in self.tis:
-                shiftedrcdini = rcdini - ti*self.ndinperframe # this can unintentionally introduce -ve valued indices at the left boundary, or out of range values at right boundary
-                shiftedrcdini = shiftedrcdini[shiftedrcdini >= 0] # remove any -ve valued indices. Is this the most efficient way to do this?
-                shiftedrcdini = shiftedrcdini[shiftedrcdini <= len(e.din)-1] # remove any out of range values
-                frameis = e.din[shiftedrcdini, 1] # get the din values (frame indices) at the rcdini for this timepoint
-                # in Cat 15, we erroneously duplicated the first frame of the mseq movies at the end, giving us one more frame (0 to 65535 for mseq32) than we should have had (0 to 65534 for mseq32). We're now using the correct movies, but the din for Cat 15 mseq experiments still have those erroneous frame indices (65535 and 16383 for mseq32 and mseq16 respectively), so we'll just ignore them for revcorr purposes.
-                if movie.oname == 'mseq32':
-                    frameis = frameis[frameis != 65535] # remove all occurences of 65535
-                elif movie.oname == 'mseq16':
-                    frameis = frameis[frameis != 16383] # remove all occurences of 16383
-                frames = data.take(frameis.astype(np.int32), axis=0) # collect the relevant frames for this timepoint, take is much faster than direct indexing, but have to typecast indices to int32, maybe cuz this machine is 32bit?
-                self.frames[ti].append(frames)
-            pd.Destroy()
-
-
-        # now that we're outside the experiment loop, get the mean for each timepoint across all experiments
-        self.rf = zeros([self.nt, self.height, self.width], dtype=np.float64) # 3D matrix to store the NSTA at each timepoint. rf == 'receptive field'
-        self.t = [ ti*intround(self.sweeptimeMsec) for ti in self.tis ]
-        pd = wx.ProgressDialog(title='NSTA progress: averaging frames', message='',
-                               maximum=self.nt, style=1) # create a progress dialog
-        for tii, ti in enumerate(self.tis):
-            cont, skip = pd.Update(tii-1, newmsg='timepoint: %dms\nelapsed: %.1fs' % (self.t[tii], time.clock()-tstart))
-            if not cont:
-                pd.Destroy()
-                return
-            self.frames[ti] = np.concatenate(tuple(self.frames[ti])) # need to concatenate all lists for this ti into a single array
-            self.rf[tii] = mean_accum(self.frames[ti]) # this is much faster than frames.mean()
-            #self.rf[ti] = mean_accum2(data, frameis)
-        pd.Destroy()
+                self.width, self.height, self.sweepSec = width, height, sweepSec
+            # assert that all movies are the same size and have the same frame time. That
+            # way you can just accumulate frames in a single array
+            assert (self.width, self.height) == (width, height)
+            assert self.sweepSec == sweepSec
+            ndinperframe = intround(sweepSec * 1000000 / e.REFRESHTIME)
+            # for now, we're using the Codes object created across the entire Recording.
+            # It might be slightly more correct to generate a separate codes object for
+            # each Experiment. That way, the wordts for would be aligned to the start of
+            # each Experiment, as opposed to the start of the Recording, as they are now.
+            frameis, rowis = [], []
+            rowi = 0
+            for wordts in self.wordts:
+                cutwordts = self.cut(e.trange, wordts) # wordts active during this experiment
+                # revcorr dini. Find where the cutwordts times fall in the din, dec so you
+                # get indices that point to the most recent din value for each cutwordt:
+                rcdini = e.din[:, 0].searchsorted(cutwordts) - 1
+                for ti in self.tis:
+                    # this can unintentionally introduce -ve valued indices at the left
+                    # boundary, or out of range values at right boundary:
+                    shiftedrcdini = rcdini - ti*ndinperframe
+                    shiftedrcdini = shiftedrcdini[(shiftedrcdini >= 0) *
+                                                  (shiftedrcdini <= len(e.din)-1)]
+                    # get the din values (frame indices) at the rcdini for this timepoint:
+                    fis = e.din[shiftedrcdini, 1]
+                    # in Cat 15, we erroneously duplicated the first frame of the mseq
+                    # movies at the end. Ignore those erroneous frame indices:
+                    fname = movie.static.fname.lower()
+                    if 'mseq32' in fname:
+                        fis = fis[fis != 65535] # remove all occurences of 65535
+                    elif 'mseq16' in fname:
+                        fis = fis[fis != 16383] # remove all occurences of 16383
+                    frameis.append(fis)
+                    rowis.append(np.tile(rowi, len(fis)))
+                    rowi += 1
+            args.append((movie.fullfname, np.hstack(rowis), np.hstack(frameis), nrows))
+
+        # accumulate frame sums and counts for each timepoint across all experiments:
+        sums = np.zeros((nrows, self.height*self.width), dtype=np.float64)
+        counts = np.zeros(nrows, dtype=np.int64)
+        if nprocs == 1:
+            results = (nsta_framesums(arg) for arg in args)
+        else:
+            pool = multiprocessing.Pool(nprocs)
+            results = pool.imap(nsta_framesums, args) # ordered, for reproducible sums
+        try:
+            for ei, (esums, ecounts) in enumerate(results):
+                sums += esums
+                counts += ecounts
+                if callback != None:
+                    callback(ei+1, len(args))
+        finally:
+            if nprocs != 1:
+                pool.close()
+                pool.join()
+        with np.errstate(invalid='ignore', divide='ignore'):
+            rfs = sums / counts[:, None] # nan for words that never occur at a timepoint
+        # 4D matrix to store the NSTA of each intcode at each timepoint. rf == 'receptive
+        # field':
+        self.rfs = rfs.reshape(len(self.intcodes), nt, self.height, self.width)
+        self.counts = counts.reshape(len(self.intcodes), nt)
+        self.rf = self.rfs[0]
+        self.t = [ ti*intround(self.sweepSec*1000) for ti in self.tis ] # ms
+        if sources != None:
+            core.savecache('revcorr', key, dict(rfs=self.rfs, counts=self.counts,
+                                                width=self.width, height=self.height,
+                                                sweepSec=self.sweepSec, t=self.t))
         return self
 
     def plot(self, intcode=None, nt=10, ti0=-4, interp='nearest', normed=True, scale=2.0):
         """Plots the spatiotemporal RF as bitmaps in a wx.Frame"""
         try:
-            self.rf
+            self.rfs
         except AttributeError:
-            self.calc(intcode=intcode, nt=nt, ti0=ti0)
-        rf = self.rf.copy() # create a copy to manipulate for display purposes, (nt, width, height)
+            self.calc(intcodes=intcode, nt=nt, ti0=ti0)
+        if intcode == None:
+            intcode = self.intcodes[0]
+        rf = self.rfs[list(self.intcodes).index(intcode)]
+        rf = rf.copy() # create a copy to manipulate for display purposes, (nt, width, height)
         if normed: # normalize across the timepoints for this RevCorr
             norm = mpl.colors.normalize(vmin=rf.min(), vmax=rf.max(), clip=True) # create a single normalization object to map luminance to the range [0,1]
             rf = norm(rf) # normalize the rf the same way across all timepoints
@@ -2051,7 +2194,7 @@ class NetstateTriggeredAverage(BaseNetstate):
         rf = cmap(rf)[::, ::, ::, 0:3] # convert luminance to RGB via the colormap, throw away alpha channel (not used for now in ReceptiveFieldFrame)
         rf = rf * 255 # scale up to 8 bit values
         rf = rf.round().astype(np.uint8) # downcast from float to uint8 for feeding to ReceptiveFieldFrame
-        self.rfframe = NetstateReceptiveFieldFrame(title=lastcmd(), rfs=[rf], intcodes=self.intcode, t=self.t, scale=scale)
+        self.rfframe = core.NetstateReceptiveFieldFrame(title=lastcmd(), rfs=[rf], intcodes=intcode, t=self.t, scale=scale)
         self.rfframe.Show()
         return self
 
@@ -2103,6 +2246,15 @@ class RecordingNetstate(BaseRecording):
         return NetstateTriggeredAverage(recording=self, experiments=experiments, nids=nids)
 
 
+def nsta_framesums(args):
+    """Return frame sums and counts for one experiment of a NetstateTriggeredAverage. Takes
+    a single tuple of args, for multiprocessing.Pool.imap(). The movie is memory-mapped
+    here, instead of sending its frames to worker processes"""
+    fullfname, rowis, frameis, nrows = args
+    frames = memmapmovie(fullfname)[-1]
+    return framesums(frames, rowis, frameis, nrows)
+
+
 class Recording(RecordingRevCorr,
                 RecordingRaster,
                 RecordingCode,
@@ -9,7 +9,9 @@ import datetime
 import numpy as np
 
 import core
-from core import dictattr, rstrip, eof, TAB, PTCSHeader, SPKHeader, EPOCH, td2usec
+from core import dictattr, rstrip, eof, warn, TAB, BufferReader, PTCSHeader, PTCSIndex
+from core import PTCSNeuronRecord, PTCSWriter, SPKHeader
+from core import EPOCH, td2usec
 from neuron import Neuron, TrackNeuron
 
 
@@ -67,7 +69,10 @@ class Sort(object):
         self.treebuf.write(string)
         self.r.writetree(string)
     
-    def load(self):
+    def load(self, lazy=None, lazywaves=None):
+        """Load neurons. If lazy, don't read in spikes and template waveforms of .ptcs
+        files, memory-map them on first access instead. If lazywaves, do the same for just
+        the template waveforms. Default to LAZYPTCS and LAZYWAVES respectively"""
         treestr = self.level*TAB + self.name + '/'
         # print string to tree hierarchy and screen
         self.writetree(treestr + '\n')
@@ -77,31 +82,142 @@ class Sort(object):
             ext = os.path.splitext(self.path)[1]
             assert ext == '.ptcs'
             # it's a single .ptcs file
-            self.loadptcs()
+            if lazy == None:
+                lazy = get_ipython().user_ns['LAZYPTCS']
+            if lazywaves == None:
+                lazywaves = get_ipython().user_ns['LAZYWAVES']
+            self.loadptcs(lazy=lazy, lazywaves=lazywaves)
         elif os.path.isdir(self.path):
             # it's a directory of .spk files
             self.loadspk()
         else:
             raise RuntimeError
 
-    def loadptcs(self):
-        """Load neurons from a single .ptcs file"""
+    def loadptcs(self, lazy=False, lazywaves=False):
+        """Load neurons from a single .ptcs file. The whole file is read into a single
+        buffer which is then parsed, with spikes and template waveforms as zero-copy views
+        into it. If lazy, the buffer is a memmap of the file, so nothing but the record
+        headers is read from disk until accessed, and even those are skipped if there's
+        an up to date .ptcs.idx index file. If lazywaves, the buffer is also a memmap, and
+        the index is also used, but spikes are copied out of it into memory, leaving only
+        the template waveforms to be read from disk on first access"""
+        if lazy or lazywaves:
+            buf = np.memmap(self.path, dtype=np.uint8, mode='r')
+        else:
+            with open(self.path, 'rb') as f:
+                buf = np.fromfile(f, dtype=np.uint8)
+        f = BufferReader(buf, name=self.path)
         self.header = PTCSHeader()
-        with open(self.path, 'rb') as f:
-            self.header.read(f)
+        self.header.read(f)
+        useindex = get_ipython().user_ns['PTCSINDEX']
+        index = PTCSIndex(self.path)
+        if (lazy or lazywaves) and useindex and index.load(nneurons=self.header.nneurons):
             for i in range(self.header.nneurons):
                 neuron = Neuron(self.path, sort=self)
-                neuron.loadptcs(f, self.header)
+                neuron.loadptcsindex(f, self.header, index, i)
+                if not lazy:
+                    neuron.record.loadspikes()
                 self.alln[neuron.id] = neuron # save it
-            assert eof(f), 'File %s has unexpected length' % self.path
+            return
+        records = []
+        for i in range(self.header.nneurons):
+            neuron = Neuron(self.path, sort=self)
+            neuron.loadptcs(f, self.header)
+            if lazywaves and not lazy:
+                neuron.record.loadspikes()
+            self.alln[neuron.id] = neuron # save it
+            records.append(neuron.record)
+        assert eof(f), 'File %s has unexpected length' % self.path
+        # only write into the data folder when lazy loading, which the index is for:
+        if ((lazy or lazywaves) and useindex and
+            not index.load(nneurons=self.header.nneurons)):
+            # missing or stale index, (re)write it for quick lazy loading next time:
+            index.build(records)
+            try:
+                index.save()
+            except IOError:
+                warn("couldn't write index file %r" % index.idxfname)
+
+    def tocache(self):
+        """Return meta dict and list of (name, array) pairs to save to a RecordingCache.
+        Spikes, chans and template waveforms of all neurons are concatenated into single
+        arrays, each indexed by an array of per-neuron offsets (CSR layout)"""
+        if not isinstance(self.header, PTCSHeader):
+            raise ValueError("can't cache sort %r, not loaded from a .ptcs file" % self.name)
+        nids = sorted(self.alln)
+        recs = [ self.alln[nid].record for nid in nids ]
+        index = PTCSIndex(self.path)
+        index.build(recs) # per-neuron scalar fields
+        header = dict([ (name, val) for name, val in self.header.__dict__.items()
+                        if name not in ['VER2FUNC', 'chanpos'] ])
+        meta = {'name': self.name, 'id': self.id, 'header': header,
+                'descrs': [ rec.descr for rec in recs ]}
+        arrays = [('chanpos', self.header.chanpos), ('records', index.records)]
+        for name in ['spikes', 'chans', 'wavedata', 'wavestd']:
+            xs = [ getattr(rec, name).ravel() for rec in recs ]
+            offsets = np.cumsum([0] + [ x.size for x in xs ])
+            arrays.append((name, np.concatenate(xs)))
+            arrays.append((name+'i', offsets))
+        meanrates = np.asarray([ self.alln[nid].meanrate for nid in nids ])
+        arrays.append(('meanrates', meanrates))
+        return meta, arrays
+
+    def loadcache(self, meta, arrays):
+        """Load neurons from meta dict and arrays of a RecordingCache, as returned by
+        tocache(). All arrays are views into the memory-mapped cache file"""
+        treestr = self.level*TAB + self.name + '/'
+        # print string to tree hierarchy and screen
+        self.writetree(treestr + '\n')
+        print(treestr)
+        self.header = PTCSHeader()
+        self.header.__dict__.update(meta['header'])
+        self.header.chanpos = arrays['chanpos']
+        records = arrays['records']
+        for i, descr in enumerate(meta['descrs']):
+            rec = PTCSNeuronRecord(self.header)
+            entry = records[i]
+            for name in records.dtype.names:
+                rec.__setattr__(name, entry[name].item())
+            rec.descr = descr
+            for name in ['spikes', 'chans', 'wavedata', 'wavestd']:
+                offsets = arrays[name+'i']
+                x = arrays[name][offsets[i]:offsets[i+1]]
+                if name.startswith('wave') and x.size != 0:
+                    x.shape = rec.nchans, rec.nt
+                rec.__setattr__(name, x)
+            neuron = Neuron(self.path, sort=self)
+            neuron.record = rec
+            neuron.post_load()
+            neuron.meanrate = arrays['meanrates'][i]
+            self.alln[neuron.id] = neuron # save it
+
+    def save(self, fname, nids=None, compress=False):
+        """Write neurons to a version 2 .ptcs file, one at a time, or to a version 3 file
+        with delta-encoded spikes if compress. nids defaults to all neurons, pass e.g.
+        self.n.keys() to save only those that meet MINRATE"""
+        if not isinstance(self.header, PTCSHeader):
+            raise ValueError("can't save sort %r, not loaded from a .ptcs file" % self.name)
+        if nids == None:
+            nids = self.alln.keys()
+        h = self.header
+        w = PTCSWriter(fname, h.pttype, h.chanpos, h.samplerate, h.datetime,
+                       nsamplebytes=h.nsamplebytes, srcfname=h.srcfname, descr=h.descr,
+                       compress=compress)
+        for nid in sorted(nids):
+            rec = self.alln[nid].record
+            w.write(nid, rec.spikes, rec.chans, rec.maxchan, rec.wavedata, rec.wavestd,
+                    (rec.xpos, rec.ypos, rec.zpos), descr=rec.descr,
+                    clusterscore=rec.clusterscore)
+        w.close()
 
     def loadspk(self):
-        """Load neurons from multiple .spk files"""
+        """Load neurons from multiple .spk files, concurrently in NLOADTHREADS threads"""
         self.header = SPKHeader(self.path)
-        for spkfname in self.header.spkfnames:
-            path = os.path.join(self.path, spkfname)
-            neuron = Neuron(path, sort=self)
-            self.header.read(neuron)
+        neurons = [ Neuron(os.path.join(self.path, spkfname), sort=self)
+                    for spkfname in self.header.spkfnames ]
+        nthreads = get_ipython().user_ns['NLOADTHREADS']
+        self.header.readall(neurons, nthreads=nthreads)
+        for neuron in neurons:
             self.alln[neuron.id] = neuron # save it
 
 
@@ -147,6 +263,28 @@ class TrackSort(object):
 
     def load(self):
         """Load TrackNeurons by concatenating spikes from neurons from all recordings"""
+        self.init_recs()
+        self.alln = self.calc_neurons(self.tr.get_allnids())
+        self.nspikes = sum([ tn.nspikes for tn in self.alln.values() ])
+
+    def update(self, nids):
+        """Rebuild only the TrackNeurons in nids, after the recordings they're in have been
+        reloaded, added or removed. If the track's first recording changed its start time,
+        the time offsets of all recordings change, so all TrackNeurons are rebuilt"""
+        datetime = self.datetime
+        self.init_recs()
+        if self.datetime != datetime:
+            self.load()
+            return
+        allnids = set(self.tr.get_allnids())
+        for nid in nids:
+            self.alln.pop(nid, None)
+        self.alln.update(self.calc_neurons([ nid for nid in nids if nid in allnids ]))
+        self.nspikes = sum([ tn.nspikes for tn in self.alln.values() ])
+
+    def init_recs(self):
+        """Copy some attribs from the first recording's sort, and store each recording's
+        time delta from the start of the track"""
         tr = self.tr
         rids = sorted(tr.r.keys()) # all recording ids in tr
         recs = [ tr.r[rid] for rid in rids ]
@@ -156,28 +294,34 @@ class TrackSort(object):
         self.datetime = datetime0
         self.pttype = sort.pttype
         self.chanpos = sort.chanpos
-        # get the union of all nids in recs:
-        nids = tr.get_allnids()
-        spikes = {}
-        for nid in nids:
-            spikes[nid] = [] # init each value to empty list
-        alln = {} # dict of first Neurons encountered across recordings
         for rec in recs:
             # store time delta between start of track and start of rec:
             rec.td = td2usec(rec.sort.datetime - datetime0) # (us)
             rec.tdsec = rec.td / 1e6
             rec.tdmin = rec.tdsec / 60
             rec.tdhour = rec.tdmin / 60
+
+    def calc_neurons(self, nids):
+        """Return dict of TrackNeurons with nids, built by concatenating the offset spikes
+        of the neurons with those nids in all recordings. Requires init_recs()"""
+        tr = self.tr
+        recs = [ tr.r[rid] for rid in sorted(tr.r.keys()) ]
+        spikes = {}
+        for nid in nids:
+            spikes[nid] = [] # init each value to empty list
+        alln = {} # dict of first Neurons encountered across recordings
+        for rec in recs:
             # for each neuron in this recording append appropriately offset spikes
             # array to entry in spikes dict:
             for n in rec.alln.values():
+                if n.id not in spikes:
+                    continue
                 spikes[n.id].append(n.spikes + rec.td)
                 # for each nid, store the first neuron encountered when iterating over
                 # recordings;
                 if n.id not in alln:
                     alln[n.id] = n
 
-        nspikes = 0 # add them up
         for nid in nids:
             spikes[nid] = np.hstack(spikes[nid]) # concatenate each nid's spikes arrays:
             assert (np.sort(spikes[nid]) == spikes[nid]).all() # should come out sorted
@@ -201,9 +345,24 @@ class TrackSort(object):
             tn.dtsec = tn.dt / 1e6
             tn.dtmin = tn.dtsec / 60
             tn.dthour = tn.dtmin / 60
-            
+
             alln[nid] = tn # replace
-            nspikes += tn.nspikes
+        return alln
 
-        self.nspikes = nspikes
-        self.alln = alln # save it
+    def save(self, fname, nids=None, compress=False):
+        """Write TrackNeurons to a version 2 .ptcs file, one at a time, so the track-wide
+        spike trains can be loaded back as a regular Sort. nids defaults to all neurons.
+        If compress, write a version 3 file with delta-encoded spikes"""
+        if nids == None:
+            nids = self.alln.keys()
+        rids = sorted(self.tr.r.keys())
+        h = self.tr.r[rids[0]].sort.header # header of first recording's sort
+        days = (self.datetime - EPOCH).total_seconds() / (24 * 3600) # since EPOCH
+        w = PTCSWriter(fname, self.pttype, self.chanpos, h.samplerate, days,
+                       nsamplebytes=h.nsamplebytes,
+                       descr={'track': self.tr.name, 'rids': rids}, compress=compress)
+        for nid in sorted(nids):
+            tn = self.alln[nid]
+            w.write(nid, tn.spikes, tn.chans, tn.maxchan, tn.wavedata, tn.wavestd, tn.pos,
+                    descr=tn.descr)
+        w.close()
@@ -4,6 +4,8 @@ from __future__ import division
 
 import os
 import StringIO
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 
 import numpy as np
 
@@ -12,7 +14,7 @@ import pylab as pl
 from pylab import get_current_fig_manager as gcfm
 
 import core
-from core import dictattr, TAB, td2usec, lastcmd, intround
+from core import dictattr, TAB, td2usec, lastcmd, intround, RecordingCache
 from recording import Recording
 from sort import TrackSort
 
@@ -66,38 +68,76 @@ class Track(object):
         if self.animal != None:
             self.animal.writetree(string)
 
-    def load(self):
+    def load(self, nthreads=None):
+        """Load all recordings in this track. If nthreads != 1, load them concurrently in a
+        pool of nthreads threads, or one per CPU core if nthreads is None, and then add them
+        to self in rid order. Defaults to NLOADTHREADS"""
         treestr = self.level*TAB + self.name + '/'
         # print string to tree hierarchy and screen
         self.writetree(treestr + '\n')
         print(treestr)
+        paths = [ os.path.join(self.path, rname) for rname in self.list_rnames() ]
+        if nthreads == None:
+            nthreads = get_ipython().user_ns['NLOADTHREADS']
+        if nthreads == None:
+            nthreads = multiprocessing.cpu_count()
+        if nthreads == 1 or len(paths) < 2:
+            recordings = []
+            for path in paths:
+                recording = Recording(path, track=self)
+                recording.load()
+                recordings.append(recording)
+        else:
+            # most of the work is file I/O, which releases the GIL. Load each recording
+            # detached from self, so that concurrent loads don't interleave their output
+            # in self's tree buffer:
+            pool = ThreadPool(processes=min(nthreads, len(paths)))
+            try:
+                recordings = pool.map(load_recording, paths)
+            finally:
+                pool.close()
+                pool.join()
+            for recording in recordings: # in rid order
+                recording.tr = self # attach to self
+                self.writetree(recording.treebuf.getvalue())
+        for recording in recordings:
+            self.r[recording.id] = recording
+            self.__setattr__('r' + str(recording.id), recording) # add shortcut attrib
+        self.post_load()
+
+    def list_rnames(self):
+        """Return sorted names of all recording folders in self.path"""
         # collect recording names: 1st char of each name must be a digit, that's all:
         rnames = [ name for name in os.listdir(self.path)
                    if os.path.isdir(os.path.join(self.path, name))
                    and name[0].isdigit() ]
         rnames.sort() # alphabetical order
+        return rnames
+
+    def post_load(self, nids=None):
+        """Calculate track-wide attribs and TrackSort from all recordings in self.r. If nids
+        is given, keep the existing TrackSort and only update the TrackNeurons in nids"""
+        rids = sorted(self.r.keys()) # all recording ids in self
         dt = 0 # calculate total track duration by summing durations of all recordings
-        for rname in rnames:
-            path = os.path.join(self.path, rname)
-            recording = Recording(path, track=self)
-            recording.load()
-            self.r[recording.id] = recording
-            self.__setattr__('r' + str(recording.id), recording) # add shortcut attrib
-            dt += recording.dt
-        self.rnames = rnames # easy way to print out all recording names
+        for rid in rids:
+            dt += self.r[rid].dt
+        # easy way to print out all recording names:
+        self.rnames = [ self.r[rid].name for rid in rids ]
         self.dt = dt
         self.dtsec = self.dt / 1e6
         self.dtmin = self.dtsec / 60
         self.dthour = self.dtmin / 60
 
-        # create a TrackSort with TrackNeurons:
-        self.sort = TrackSort(self)
-        self.sort.load()
+        if nids is None:
+            # create a TrackSort with TrackNeurons:
+            self.sort = TrackSort(self)
+            self.sort.load()
+        else:
+            self.sort.update(nids)
         # one way of calculating self.trange:
         #tranges = np.asarray([ n.trange for n in self.alln.values() ])
         #self.trange = min(tranges[:, 0]), max(tranges[:, 1])
         # better way of calculating self.trange:
-        rids = sorted(self.r.keys()) # all recording ids in self
         r0 = self.r[rids[0]]
         r1 = self.r[rids[-1]]
         assert r0.datetime == self.datetime
@@ -115,6 +155,44 @@ class Track(object):
                 raise ValueError("inconsistent polytrode types %r and %r in track %s"
                                  % (pttype, r.pttype, self.id))
 
+    def reload(self):
+        """Reload only those recordings whose source files have changed in size or
+        modification time since they were loaded, load any new ones, and drop any that
+        have been removed. Then update the trange, mean rates, and only those TrackNeurons
+        that are in the affected recordings. Return ids of reloaded recordings"""
+        rnames = self.list_rnames()
+        changed = False
+        nids = set() # nids of neurons in affected recordings, before and after
+        for rid, recording in self.r.items():
+            if recording.name not in rnames: # recording folder has been removed
+                nids.update(recording.alln)
+                del self.r[rid]
+                self.__delattr__('r' + str(rid))
+                changed = True
+        loaded = dict([ (recording.name, recording) for recording in self.r.values() ])
+        rids = []
+        for rname in rnames:
+            path = os.path.join(self.path, rname)
+            if rname in loaded and loaded[rname].sources == RecordingCache(path).sources():
+                continue # unchanged
+            if rname in loaded:
+                nids.update(loaded[rname].alln)
+            recording = load_recording(path)
+            nids.update(recording.alln)
+            recording.tr = self # attach to self
+            self.r[recording.id] = recording
+            self.__setattr__('r' + str(recording.id), recording) # add shortcut attrib
+            rids.append(recording.id)
+        if not changed and not rids:
+            return rids
+        # rebuild tree buffer, in rid order:
+        self.treebuf = StringIO.StringIO()
+        self.treebuf.write(self.level*TAB + self.name + '/\n')
+        for rid in sorted(self.r):
+            self.treebuf.write(self.r[rid].treebuf.getvalue())
+        self.post_load(nids=sorted(nids))
+        return rids
+
     def calc_meanrates(self):
         """Calculate mean firing rates of all TrackNeurons in this track"""
         TRACKNEURONPERIOD = get_ipython().user_ns['TRACKNEURONPERIOD']
@@ -403,3 +481,10 @@ class Track(object):
                  handlelength=1, handletextpad=0.5, labelspacing=0.1)
         f.tight_layout(pad=0.3) # crop figure to contents
         return scs, sis, c
+
+
+def load_recording(path):
+    """Create and load a Recording with no parent track"""
+    recording = Recording(path)
+    recording.load()
+    return recording
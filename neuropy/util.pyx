@@ -9,7 +9,7 @@ cimport cython
 from cython.parallel import prange
 import numpy as np
 cimport numpy as np
-from numpy cimport int8_t, int64_t, float64_t
+from numpy cimport int8_t, int64_t, uint64_t, float64_t
 from libc.math cimport sqrt
 # import_array() is required for access to NumPy's C API, otherwise calls to something
 # like `np.PyArray_EMPTY` segfault. See:
@@ -39,6 +39,8 @@ cdef extern from "float.h":
 '''
 cdef extern from "stdio.h" nogil:
     int printf(char *, ...)
+
+cdef extern int __builtin_popcountll(unsigned long long) nogil # gcc builtin
 '''
 cdef extern from "string.h":
     cdef void *memset(void *, int, size_t) nogil # sets n bytes in memory to constant
@@ -220,6 +222,195 @@ def sct(int8_t[:, ::1] c,
 
     return np.asarray(corrs.T), np.asarray(counts.T) # pairs in rows, tranges in columns
 
+def sct_packed(uint64_t[:, ::1] p,
+               int64_t[::1] t,
+               int64_t[:, ::1] tranges):
+    """Same as sct(), but for bit-packed binary codes in 2D array p, where bin j of neuron i
+    is bit j%64 of p[i, j//64]. Means, stds and sums of products are all calculated from
+    popcounts of high and coincident high bins, without unpacking"""
+    cdef int64_t nn = p.shape[0] # number of neurons
+    cdef int64_t ntranges = tranges.shape[0]
+    cdef int64_t i, j, trangei, lo, hi, nst
+    cdef int64_t[:, ::1] tis = np.searchsorted(t, tranges) # ntranges x 2 array
+    cdef int64_t npairs = nn * (nn - 1) / 2
+    cdef int64_t[:, ::1] nhigh = np.zeros((ntranges, nn), dtype=np.int64)
+    cdef float64_t[:, ::1] means = np.zeros((ntranges, nn))
+    cdef float64_t[:, ::1] stds = np.zeros((ntranges, nn))
+    cdef float64_t[:, ::1] corrs = np.empty((ntranges, npairs))
+    cdef int64_t[:, ::1] counts = np.empty((ntranges, npairs), dtype=np.int64)
+    cdef int64_t pairi
+    cdef float64_t numer, denom
+    # see sct() for why pairi isn't incremented in place:
+    for trangei in prange(ntranges, nogil=True, schedule='dynamic'):
+        lo, hi = tis[trangei, 0], tis[trangei, 1]
+        nst = hi - lo
+        for i in range(nn):
+            nhigh[trangei, i] = popcount_and_range(p, i, i, lo, hi)
+            means[trangei, i] = <float64_t>nhigh[trangei, i] / nst
+            # std of binary values is sqrt(mean of squares - square of mean):
+            stds[trangei, i] = sqrt(means[trangei, i] - means[trangei, i]*means[trangei, i])
+        pairi = 0
+        for i in range(nn):
+            for j in range(i+1, nn):
+                # (mean of product - product of means) / product of stds:
+                numer = (<float64_t>popcount_and_range(p, i, j, lo, hi) / nst
+                         - means[trangei, i] * means[trangei, j])
+                denom = stds[trangei, i] * stds[trangei, j]
+                if denom == 0.0:
+                    corrs[trangei, pairi] = 0.0
+                else:
+                    corrs[trangei, pairi] = numer / denom
+                counts[trangei, pairi] = nhigh[trangei, i] + nhigh[trangei, j]
+                pairi = pairi + 1 # inc for next loop
+
+    return np.asarray(corrs.T), np.asarray(counts.T) # pairs in rows, tranges in columns
+
+cdef int64_t popcount_and_range(uint64_t[:, ::1] p, int64_t i, int64_t j,
+                                int64_t lo, int64_t hi) nogil:
+    """Return number of bins in bin range [lo, hi) that are high in both rows i and j of
+    bit-packed 2D array p. i == j counts the high bins in row i"""
+    cdef int64_t wi, w0, w1
+    cdef uint64_t lomask, himask
+    cdef int64_t n = 0
+    if hi <= lo:
+        return 0
+    w0, w1 = lo >> 6, (hi-1) >> 6 # first and last word indices
+    lomask = (~(<uint64_t>0)) << (lo & 63) # excludes bits below lo in first word
+    himask = (~(<uint64_t>0)) >> (63 - ((hi-1) & 63)) # excludes bits from hi in last word
+    if w0 == w1:
+        return __builtin_popcountll(p[i, w0] & p[j, w0] & lomask & himask)
+    n = __builtin_popcountll(p[i, w0] & p[j, w0] & lomask)
+    for wi in range(w0+1, w1):
+        n += __builtin_popcountll(p[i, wi] & p[j, wi])
+    n += __builtin_popcountll(p[i, w1] & p[j, w1] & himask)
+    return n
+
+def coincidences(uint64_t[:, ::1] p):
+    """Return nn x nn array of the number of coincident high bins of each pair of
+    bit-packed binary codes in 2D array p. The diagonal holds the number of high bins of each
+    code. Padding bits beyond the last bin must be 0"""
+    cdef int64_t nn = p.shape[0] # number of neurons
+    cdef int64_t nw = p.shape[1] # number of 64 bit words per neuron
+    cdef int64_t i, j, wi, n
+    cdef int64_t[:, ::1] counts = np.zeros((nn, nn), dtype=np.int64)
+    for i in prange(nn, nogil=True, schedule='dynamic'):
+        for j in range(i, nn):
+            n = 0
+            for wi in range(nw):
+                n = n + __builtin_popcountll(p[i, wi] & p[j, wi])
+            counts[i, j] = n
+            counts[j, i] = n
+    return np.asarray(counts)
+
+def sct_sparse(int64_t[::1] i,
+               int64_t[::1] ptr,
+               int64_t[::1] t,
+               int64_t[:, ::1] tranges):
+    """Same as sct(), but for sparse binary codes, where the sorted indices of the high bins
+    of neuron ni are i[ptr[ni]:ptr[ni+1]]. Means, stds and sums of products are all
+    calculated from counts of high and coincident high bins, found by binary search and
+    sorted array intersection"""
+    cdef int64_t nn = ptr.shape[0] - 1 # number of neurons
+    cdef int64_t ntranges = tranges.shape[0]
+    cdef int64_t ni, nj, trangei, lo, hi, nst
+    cdef int64_t[:, ::1] tis = np.searchsorted(t, tranges) # ntranges x 2 array
+    cdef int64_t npairs = nn * (nn - 1) / 2
+    # start and end indices into i of each neuron's high bins in each trange:
+    cdef int64_t[:, ::1] starts = np.empty((ntranges, nn), dtype=np.int64)
+    cdef int64_t[:, ::1] ends = np.empty((ntranges, nn), dtype=np.int64)
+    cdef float64_t[:, ::1] means = np.zeros((ntranges, nn))
+    cdef float64_t[:, ::1] stds = np.zeros((ntranges, nn))
+    cdef float64_t[:, ::1] corrs = np.empty((ntranges, npairs))
+    cdef int64_t[:, ::1] counts = np.empty((ntranges, npairs), dtype=np.int64)
+    cdef int64_t pairi
+    cdef float64_t numer, denom
+    # see sct() for why pairi isn't incremented in place:
+    for trangei in prange(ntranges, nogil=True, schedule='dynamic'):
+        lo, hi = tis[trangei, 0], tis[trangei, 1]
+        nst = hi - lo
+        for ni in range(nn):
+            starts[trangei, ni] = lowerbound(i, ptr[ni], ptr[ni+1], lo)
+            ends[trangei, ni] = lowerbound(i, starts[trangei, ni], ptr[ni+1], hi)
+            means[trangei, ni] = (<float64_t>(ends[trangei, ni] - starts[trangei, ni])
+                                  / nst)
+            # std of binary values is sqrt(mean of squares - square of mean):
+            stds[trangei, ni] = sqrt(means[trangei, ni] - means[trangei, ni]*means[trangei, ni])
+        pairi = 0
+        for ni in range(nn):
+            for nj in range(ni+1, nn):
+                # (mean of product - product of means) / product of stds:
+                numer = (<float64_t>intersect_count(i, starts[trangei, ni], ends[trangei, ni],
+                                                   starts[trangei, nj], ends[trangei, nj])
+                         / nst - means[trangei, ni] * means[trangei, nj])
+                denom = stds[trangei, ni] * stds[trangei, nj]
+                if denom == 0.0:
+                    corrs[trangei, pairi] = 0.0
+                else:
+                    corrs[trangei, pairi] = numer / denom
+                counts[trangei, pairi] = (ends[trangei, ni] - starts[trangei, ni]
+                                          + ends[trangei, nj] - starts[trangei, nj])
+                pairi = pairi + 1 # inc for next loop
+
+    return np.asarray(corrs.T), np.asarray(counts.T) # pairs in rows, tranges in columns
+
+cdef int64_t lowerbound(int64_t[::1] a, int64_t lo, int64_t hi, int64_t x) nogil:
+    """Return index of first value >= x in sorted a[lo:hi], or hi if there isn't one"""
+    cdef int64_t mid
+    while lo < hi:
+        mid = (lo + hi) >> 1
+        if a[mid] < x:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+cdef int64_t intersect_count(int64_t[::1] a, int64_t a0, int64_t a1,
+                             int64_t b0, int64_t b1) nogil:
+    """Return number of values common to sorted unique a[a0:a1] and a[b0:b1]"""
+    cdef int64_t n = 0
+    while a0 < a1 and b0 < b1:
+        if a[a0] < a[b0]:
+            a0 += 1
+        elif a[a0] > a[b0]:
+            b0 += 1
+        else:
+            n += 1
+            a0 += 1
+            b0 += 1
+    return n
+
+def sparse_coincidences(int64_t[::1] i, int64_t[::1] ptr):
+    """Return nn x nn array of the number of coincident high bins of each pair of sparse
+    binary codes, where the sorted indices of the high bins of neuron ni are
+    i[ptr[ni]:ptr[ni+1]]. The diagonal holds the number of high bins of each code"""
+    cdef int64_t nn = ptr.shape[0] - 1 # number of neurons
+    cdef int64_t ni, nj, n
+    cdef int64_t[:, ::1] counts = np.zeros((nn, nn), dtype=np.int64)
+    for ni in prange(nn, nogil=True, schedule='dynamic'):
+        counts[ni, ni] = ptr[ni+1] - ptr[ni]
+        for nj in range(ni+1, nn):
+            n = intersect_count(i, ptr[ni], ptr[ni+1], ptr[nj], ptr[nj+1])
+            counts[ni, nj] = n
+            counts[nj, ni] = n
+    return np.asarray(counts)
+
+def packedints(uint64_t[:, ::1] p, int64_t nbins):
+    """Return the integer representation of each of the first nbins population words in
+    bit-packed 2D array p, with rows LSB to MSB from top to bottom. Equivalent to
+    core.binarray2int() on the unpacked codes"""
+    cdef int64_t nn = p.shape[0] # number of neurons
+    cdef int64_t i, bi
+    cdef uint64_t word
+    cdef int64_t[::1] ints = np.empty(nbins, dtype=np.int64)
+    if nn > 63:
+        raise ValueError("can't represent words of more than 63 neurons as int64")
+    for bi in prange(nbins, nogil=True, schedule='static'):
+        word = 0
+        for i in range(nn):
+            word = word | (((p[i, bi >> 6] >> (bi & 63)) & 1) << i)
+        ints[bi] = word
+    return np.asarray(ints)
+
 '''
 cdef double mean_int8(int8_t[::1] x) nogil:
     """Return mean of 1D int8 array"""